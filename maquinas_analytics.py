@@ -0,0 +1,221 @@
+"""
+Detección de degradación y anomalías sobre el historial de criticidad
+- todas las series máquina/herramienta se analizan en una pasada vectorizada (numpy)
+- EWMA (saltos sobre la línea base), pendiente (degradación sostenida) y cambio de nivel
+- las alertas se guardan en la tabla alerts; corre completa (batch) o solo para las series tocadas
+"""
+
+import os
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+
+# last N points of each series that the detectors look at
+WINDOW = int(os.environ.get("MAQUINAS_TREND_WINDOW", "12"))
+MIN_POINTS = 3
+EWMA_ALPHA = 0.3
+# criticality points per 30 days
+SLOPE_ALERT = float(os.environ.get("MAQUINAS_SLOPE_ALERT", "0.5"))
+JUMP_ALERT = 2.5
+SHIFT_ALERT = 2.0
+# calendar notes carry a severity but no criticality; put them on the same 0-10 scale
+SEVERITY_SCORES = {'verde': 1, 'amarillo': 5, 'naranja': 7, 'rojo': 9}
+ALERT_LABELS = {'degradacion': 'Degradación sostenida', 'salto': 'Salto sobre la línea base', 'cambio': 'Cambio de nivel'}
+
+SeriesBatch = namedtuple("SeriesBatch", "machine_id tool_id last_id starts ends t y")
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS alerts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        machine_id INTEGER NOT NULL,
+        tool_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        score REAL,
+        detail TEXT,
+        -- open | closed (no longer triggers) | dismissed (by a user, until new data arrives)
+        status TEXT NOT NULL DEFAULT 'open',
+        last_measurement_id INTEGER,
+        created_at TEXT,
+        updated_at TEXT,
+        closed_at TEXT
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_alerts_open ON alerts(machine_id, tool_id, kind) WHERE status = 'open';
+    CREATE INDEX IF NOT EXISTS idx_alerts_status_score ON alerts(status, score);
+    """)
+
+
+def _series_value_sql():
+    cases = ' '.join(f"WHEN '{sev}' THEN {score}" for sev, score in SEVERITY_SCORES.items())
+    return f"COALESCE(m.criticality, CASE m.severity {cases} END)"
+
+
+def load_series(conn, pairs=None):
+    # every (machine, tool) series as flat arrays sorted by series then time;
+    # `pairs` restricts the load to the series touched by new data
+    value = _series_value_sql()
+    base = f"""
+        SELECT m.machine_id, m.tool_id, m.id, julianday(m.date) AS t, {value} AS y
+        FROM measurements m
+        {{join}}
+        WHERE m.date IS NOT NULL AND {value} IS NOT NULL AND julianday(m.date) IS NOT NULL
+        ORDER BY m.machine_id, m.tool_id, m.date, m.id
+    """
+    if pairs is not None:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS _series (machine_id INTEGER, tool_id INTEGER, PRIMARY KEY (machine_id, tool_id))")
+        conn.execute("DELETE FROM temp._series")
+        conn.executemany("INSERT OR IGNORE INTO temp._series VALUES (?,?)", pairs)
+        rows = conn.execute(base.format(join="JOIN temp._series s ON s.machine_id = m.machine_id AND s.tool_id = m.tool_id")).fetchall()
+    else:
+        rows = conn.execute(base.format(join="")).fetchall()
+
+    if not rows:
+        empty_i = np.zeros(0, dtype=np.int64)
+        return SeriesBatch(empty_i, empty_i, empty_i, empty_i, empty_i, np.zeros(0), np.zeros(0))
+    arr = np.array([tuple(r) for r in rows], dtype=float)
+    mid = arr[:, 0].astype(np.int64)
+    tid = arr[:, 1].astype(np.int64)
+    ids = arr[:, 2].astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, (mid[1:] != mid[:-1]) | (tid[1:] != tid[:-1])])
+    ends = np.r_[starts[1:], len(arr)]
+    return SeriesBatch(mid[starts], tid[starts], ids[ends - 1], starts, ends, arr[:, 3], arr[:, 4])
+
+
+def window_matrix(batch, window=WINDOW):
+    # last `window` points of every series, right-aligned in a (series x window) matrix
+    k = np.minimum(batch.ends - batch.starts, window)
+    col = np.arange(window)
+    mask = col[None, :] >= (window - k)[:, None]
+    idx = np.where(mask, batch.ends[:, None] - window + col[None, :], 0)
+    return np.where(mask, batch.y[idx], 0.0), np.where(mask, batch.t[idx], 0.0), mask
+
+
+def detect(batch, window=WINDOW):
+    # one vectorized pass; returns [(machine_id, tool_id, kind, score, detail, last_measurement_id)]
+    if len(batch.starts) == 0:
+        return []
+    Y, T, mask = window_matrix(batch, window)
+    w = mask.astype(float)
+    n = w.sum(axis=1)
+    last = Y[:, -1]
+
+    # least-squares slope over the window (per 30 days)
+    t_mean = (T * w).sum(axis=1) / n
+    y_mean = (Y * w).sum(axis=1) / n
+    tc = np.where(mask, T - t_mean[:, None], 0.0)
+    yc = np.where(mask, Y - y_mean[:, None], 0.0)
+    sxx = (tc ** 2).sum(axis=1)
+    slope = np.where(sxx > 0, (tc * yc).sum(axis=1) / np.where(sxx > 0, sxx, 1), 0.0) * 30
+
+    # EWMA baseline of everything before the last point
+    ewma = np.zeros(len(n))
+    started = np.zeros(len(n), dtype=bool)
+    for j in range(window - 1):
+        v = mask[:, j]
+        ewma = np.where(v & ~started, Y[:, j], np.where(v, EWMA_ALPHA * Y[:, j] + (1 - EWMA_ALPHA) * ewma, ewma))
+        started |= v
+    jump = np.where(started, last - ewma, 0.0)
+
+    # change point: best upward shift in mean between two segments of >= 2 points
+    cs = np.cumsum(Y * w, axis=1)
+    cc = np.cumsum(w, axis=1)
+    shift = np.zeros(len(n))
+    before_mean = np.zeros(len(n))
+    after_mean = np.zeros(len(n))
+    for j in range(1, window):
+        nb, sb = cc[:, j - 1], cs[:, j - 1]
+        na, sa = n - nb, cs[:, -1] - sb
+        ok = (nb >= 2) & (na >= 2)
+        mb = np.where(ok, sb / np.maximum(nb, 1), 0.0)
+        ma = np.where(ok, sa / np.maximum(na, 1), 0.0)
+        better = ok & ((ma - mb) > shift)
+        shift = np.where(better, ma - mb, shift)
+        before_mean = np.where(better, mb, before_mean)
+        after_mean = np.where(better, ma, after_mean)
+
+    enough = n >= MIN_POINTS
+    rules = [
+        ('degradacion', enough & (slope >= SLOPE_ALERT) & (last >= 3), slope,
+         lambda i: f"pendiente +{slope[i]:.2f} por mes (último {last[i]:g})"),
+        ('salto', enough & (jump >= JUMP_ALERT), jump,
+         lambda i: f"último {last[i]:g}, {jump[i]:+.1f} sobre la línea base {ewma[i]:.1f}"),
+        ('cambio', (shift >= SHIFT_ALERT) & (after_mean >= 5), shift,
+         lambda i: f"nivel {before_mean[i]:.1f} → {after_mean[i]:.1f}"),
+    ]
+    found = []
+    for kind, hit, score, detail in rules:
+        for i in np.flatnonzero(hit):
+            found.append((int(batch.machine_id[i]), int(batch.tool_id[i]), kind, float(score[i]), detail(i), int(batch.last_id[i])))
+    return found
+
+
+def persist_alerts(conn, found, analyzed=None, now=None):
+    # open/refresh detected alerts and close the ones that no longer trigger;
+    # analyzed=None means the whole fleet was scanned
+    now = (now or datetime.now()).strftime("%Y-%m-%d %H:%M")
+    current = {(mid, tid, kind) for mid, tid, kind, _, _, _ in found}
+    opened = 0
+    for mid, tid, kind, score, detail, last_id in found:
+        cur = conn.execute("UPDATE alerts SET score=?, detail=?, last_measurement_id=?, updated_at=? WHERE machine_id=? AND tool_id=? AND kind=? AND status='open'",
+                           (score, detail, last_id, now, mid, tid, kind))
+        if cur.rowcount:
+            continue
+        dismissed = conn.execute("SELECT 1 FROM alerts WHERE machine_id=? AND tool_id=? AND kind=? AND status='dismissed' AND last_measurement_id>=?",
+                                 (mid, tid, kind, last_id)).fetchone()
+        if dismissed:
+            continue
+        conn.execute("INSERT INTO alerts (machine_id, tool_id, kind, score, detail, status, last_measurement_id, created_at, updated_at) VALUES (?,?,?,?,?,'open',?,?,?)",
+                     (mid, tid, kind, score, detail, last_id, now, now))
+        opened += 1
+    if analyzed is None:
+        open_rows = conn.execute("SELECT id, machine_id, tool_id, kind FROM alerts WHERE status='open'").fetchall()
+    else:
+        open_rows = []
+        for mid, tid in analyzed:
+            open_rows += conn.execute("SELECT id, machine_id, tool_id, kind FROM alerts WHERE status='open' AND machine_id=? AND tool_id=?",
+                                      (mid, tid)).fetchall()
+    stale = [(now, r[0]) for r in open_rows if (r[1], r[2], r[3]) not in current]
+    conn.executemany("UPDATE alerts SET status='closed', closed_at=? WHERE id=?", stale)
+    conn.commit()
+    return opened, len(stale)
+
+
+def close_alerts(conn, machine_id=None, tool_id=None, alert_id=None, status='closed', now=None):
+    # machine/tool deletes, and dismissals from the alerts page (status='dismissed')
+    now = (now or datetime.now()).strftime("%Y-%m-%d %H:%M")
+    where, params = ["status='open'"], [status, now]
+    for col, value in (('machine_id', machine_id), ('tool_id', tool_id), ('id', alert_id)):
+        if value is not None:
+            where.append(f"{col}=?")
+            params.append(value)
+    conn.execute(f"UPDATE alerts SET status=?, closed_at=? WHERE {' AND '.join(where)}", params)
+
+
+def open_alerts(conn, limit=500):
+    return conn.execute("""
+        SELECT a.id, a.machine_id, a.tool_id, a.kind, a.score, a.detail, a.created_at, a.updated_at,
+               mac.name AS machine, mac.hac_code, mac.machine_type, mac.color_hex, t.name AS tool
+        FROM alerts a
+        LEFT JOIN machines mac ON mac.id = a.machine_id
+        LEFT JOIN tools t ON t.id = a.tool_id
+        WHERE a.status = 'open'
+        ORDER BY a.score DESC, a.updated_at DESC
+        LIMIT ?
+    """, (limit,)).fetchall()
+
+
+def run_detection(conn):
+    # nightly / after bulk imports: the whole fleet in one batch
+    batch = load_series(conn)
+    return persist_alerts(conn, detect(batch))
+
+
+def detect_series(conn, pairs):
+    # after data entry: only the (machine_id, tool_id) series that just changed
+    pairs = list({(int(m), int(t)) for m, t in pairs})
+    if not pairs:
+        return 0, 0
+    # series that lost all their points (deleted measurements) still get their alerts closed
+    return persist_alerts(conn, detect(load_series(conn, pairs)), analyzed=pairs)
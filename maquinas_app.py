@@ -5,118 +5,115 @@ Monitor de Condición - Seguimiento de máquinas con herramientas de diagnóstic
 - Resumen por máquina
 """
 
-from flask import Flask, request, redirect, url_for, render_template_string, flash
+from flask import Flask, request, redirect, url_for, render_template_string, flash, Response, stream_with_context, jsonify, g, session, has_request_context, send_file
 from werkzeug.security import generate_password_hash
-import sqlite3, os
+import sqlite3, os, threading, gzip, json
 from datetime import datetime
-import pandas as pd
 import math
-from openpyxl import load_workbook
+from urllib.parse import quote
+import maquinas_analytics
+import maquinas_archive
+import maquinas_assets
+import maquinas_attachments
+import maquinas_db
+import maquinas_events
+import maquinas_export
+import maquinas_fleet
+import maquinas_forecast
+import maquinas_import
+import maquinas_jobs
+import maquinas_match
+import maquinas_notes
+import maquinas_orders
+import maquinas_plan
+import maquinas_refcache
+import maquinas_sites
+import maquinas_sparklines
+import maquinas_sync
 
 app = Flask(__name__)
-app.secret_key = "secret_key"
+# production launches (maquinas_server.py) refuse to start without MAQUINAS_SECRET_KEY
+app.secret_key = os.environ.get("MAQUINAS_SECRET_KEY", "secret_key")
 
-DB_FILE = "machines.db"
+# one database per plant (maquinas_sites); with no site configuration this is machines.db
+DB_FILE = maquinas_sites.db_file()
 
 # ---- Database ----
-def get_db():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def init_db():
-    conn = get_db()
-    
-    # Create tables if they don't exist
-    conn.executescript("""
-    CREATE TABLE IF NOT EXISTS machines (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL UNIQUE,
-        notes TEXT,
-        priority INTEGER DEFAULT 3,
-        machine_group INTEGER DEFAULT 1
-    );
-    CREATE TABLE IF NOT EXISTS tools (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL UNIQUE,
-        description TEXT
-    );
-    CREATE TABLE IF NOT EXISTS measurements (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        machine_id INTEGER,
-        tool_id INTEGER,
-        date TEXT,
-        criticality INTEGER,
-        note TEXT,
-        FOREIGN KEY(machine_id) REFERENCES machines(id),
-        FOREIGN KEY(tool_id) REFERENCES tools(id)
-    );
-    """)
-    
-    # Migration: Add missing columns to existing machines table
-    cursor = conn.execute("PRAGMA table_info(machines)")
-    machines_columns = {row[1] for row in cursor.fetchall()}
-    
-    if 'priority' not in machines_columns:
-        conn.execute("ALTER TABLE machines ADD COLUMN priority INTEGER DEFAULT 3")
-        print("✓ Columna priority agregada")
-    
-    if 'machine_group' not in machines_columns:
-        conn.execute("ALTER TABLE machines ADD COLUMN machine_group INTEGER DEFAULT 1")
-        print("✓ Columna machine_group agregada")
-    
-    if 'notes' not in machines_columns:
-        conn.execute("ALTER TABLE machines ADD COLUMN notes TEXT")
-        print("✓ Columna notes agregada")
-    if 'hac_code' not in machines_columns:
-      conn.execute("ALTER TABLE machines ADD COLUMN hac_code TEXT")
-      print("✓ Columna hac_code agregada")
-      machines_columns.add('hac_code')
-    
-    # Migration: Add missing columns to existing measurements table
-    cursor = conn.execute("PRAGMA table_info(measurements)")
-    measurements_columns = {row[1] for row in cursor.fetchall()}
-    
-    if 'criticality' not in measurements_columns:
-        conn.execute("ALTER TABLE measurements ADD COLUMN criticality INTEGER")
-        print("✓ Columna criticality agregada")
-    
-    if 'note' not in measurements_columns:
-        conn.execute("ALTER TABLE measurements ADD COLUMN note TEXT")
-        print("✓ Columna note agregada")
-    if 'severity' not in measurements_columns:
-      conn.execute("ALTER TABLE measurements ADD COLUMN severity TEXT")
-      print("✓ Columna severity agregada")
-    if 'repair_time' not in measurements_columns:
-      conn.execute("ALTER TABLE measurements ADD COLUMN repair_time TEXT")
-      print("✓ Columna repair_time agregada")
-    
-    # Migration: Add missing columns to existing tools table
-    cursor = conn.execute("PRAGMA table_info(tools)")
-    tools_columns = {row[1] for row in cursor.fetchall()}
-    
-    if 'description' not in tools_columns:
-        conn.execute("ALTER TABLE tools ADD COLUMN description TEXT")
-        print("✓ Columna description agregada")
-    # Migration: add color and color_hex columns to machines
-    if 'color' not in machines_columns:
-      conn.execute("ALTER TABLE machines ADD COLUMN color TEXT")
-      print("✓ Columna color agregada")
-      machines_columns.add('color')
-    if 'color_hex' not in machines_columns:
-      conn.execute("ALTER TABLE machines ADD COLUMN color_hex TEXT")
-      print("✓ Columna color_hex agregada")
-      machines_columns.add('color_hex')
-    if 'machine_type' not in machines_columns:
-      conn.execute("ALTER TABLE machines ADD COLUMN machine_type TEXT")
-      print("✓ Columna machine_type agregada")
-      machines_columns.add('machine_type')
-    
+def current_site():
+    # set per request from ?site= / the session; CLI and warm-up use the default site
+    if has_request_context() and getattr(g, 'site', None):
+        return g.site
+    return maquinas_sites.DEFAULT_SITE
+
+def get_db(site=None):
+    return maquinas_db.connect(site or current_site())
+
+def measurements_written(conn, touched):
+    # after inserting readings for these (machine, tool) series: derived tables, commit, then alerts and forecasts
+    machine_ids = {int(m) for m, _ in touched}
+    maquinas_sparklines.invalidate(conn, machine_ids)
+    maquinas_assets.refresh_rollups(conn, machine_ids)
+    # red / orange / yellow notes open work orders, later readings close them
+    maquinas_orders.process(conn)
     conn.commit()
-    conn.close()
-    print("✓ Base de datos inicializada")
+    maquinas_analytics.detect_series(conn, touched)
+    maquinas_forecast.refit(conn)
 
-init_db()
+for _site in maquinas_sites.SITES:
+    maquinas_db.init_db(_site)
+
+@app.before_request
+def select_site():
+    site = request.args.get('site')
+    if site in maquinas_sites.SITES:
+        session['site'] = site
+    else:
+        site = session.get('site')
+        if site not in maquinas_sites.SITES:
+            site = maquinas_sites.DEFAULT_SITE
+    g.site = site
+
+# ---- Warm-up / graceful shutdown ----
+_imports_lock = threading.Condition()
+_imports_in_flight = 0
+
+def warm_caches():
+    # touch every table and index once so the first requests after a deploy
+    # hit the OS page cache instead of the disk
+    for site in maquinas_sites.SITES:
+        conn = get_db(site)
+        try:
+            names = [r['name'] for r in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table','index') AND name NOT LIKE 'sqlite_%'")]
+            for name in names:
+                try:
+                    conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()
+                except sqlite3.OperationalError:
+                    # indexes can't be selected from directly; the table scan loads them
+                    pass
+            conn.execute("PRAGMA optimize")
+        finally:
+            conn.close()
+
+def start_jobs():
+    # production workers only: nightly jobs run in their own processes, one worker claims each run
+    if os.environ.get("MAQUINAS_JOBS", "1") != "0":
+        maquinas_jobs.start([maquinas_sites.db_file(site) for site in maquinas_sites.SITES])
+
+def begin_import():
+    global _imports_in_flight
+    with _imports_lock:
+        _imports_in_flight += 1
+
+def end_import():
+    global _imports_in_flight
+    with _imports_lock:
+        _imports_in_flight -= 1
+        _imports_lock.notify_all()
+
+def drain_imports(timeout=None):
+    # block until running Excel imports have committed; returns False on timeout
+    with _imports_lock:
+        return _imports_lock.wait_for(lambda: _imports_in_flight == 0, timeout=timeout)
 
 # ---- Base Template ----
 BASE = """
@@ -149,6 +146,7 @@ body { background:var(--bg); color:var(--text); font-family: Inter, system-ui, -
 .card-hover:hover{transform:translateY(-4px);transition:all .18s ease}
 .machine-card { border-left: 6px solid transparent; }
 .small-muted{color:var(--muted);font-size:0.85rem}
+.sparkline{display:block}
 </style>
 </head>
 <body>
@@ -157,8 +155,22 @@ body { background:var(--bg); color:var(--text); font-family: Inter, system-ui, -
     <a class="navbar-brand fw-bold" href="/">📊 Monitor</a>
     <div class="navbar-nav ms-auto">
       <a class="nav-link" href="/">Máquinas</a>
+      <a class="nav-link" href="/assets">Áreas</a>
       <a class="nav-link" href="/tools">Herramientas</a>
       <a class="nav-link" href="/calendar">Calendario</a>
+      <a class="nav-link" href="/alerts">Alertas</a>
+      <a class="nav-link" href="/orders">Órdenes</a>
+      <a class="nav-link" href="/plan">Plan</a>
+      <a class="nav-link" href="/match/reviews">Asociaciones</a>
+      {% if sites|length > 1 %}
+      <a class="nav-link" href="/fleet">Flota</a>
+      <div class="nav-item dropdown">
+        <a class="nav-link dropdown-toggle" href="#" data-bs-toggle="dropdown">🏭 {{ current_site }}</a>
+        <ul class="dropdown-menu dropdown-menu-end">
+          {% for s in sites %}<li><a class="dropdown-item {% if s == current_site %}active{% endif %}" href="/?site={{ s }}">{{ s }}</a></li>{% endfor %}
+        </ul>
+      </div>
+      {% endif %}
       <button id="theme_toggle" class="btn btn-sm btn-outline-light ms-2" title="Alternar modo" type="button">🌙</button>
     </div>
   </div>
@@ -176,25 +188,38 @@ body { background:var(--bg); color:var(--text); font-family: Inter, system-ui, -
 def render(body_template, **context):
     page_title = context.pop('page_title', 'Monitor')
     full_template = BASE.replace('{{ body }}', body_template)
-    return render_template_string(full_template, page_title=page_title, **context)
+    return render_template_string(full_template, page_title=page_title, sites=list(maquinas_sites.SITES), current_site=current_site(), **context)
 
 # ============ MÁQUINAS ============
 
 MACHINES_LIST = """
 <div class="d-flex justify-content-between align-items-center mb-3">
   <h3>Máquinas</h3>
-  <a class="btn btn-primary" href="/machines/add">+ Agregar</a>
+  <div>
+    <div class="btn-group">
+      <button type="button" class="btn btn-outline-secondary dropdown-toggle" data-bs-toggle="dropdown">Exportar</button>
+      <ul class="dropdown-menu dropdown-menu-end">
+        {% for ds, label in [('machines','Máquinas'),('status','Estado actual'),('measurements','Historial completo')] %}
+        <li><a class="dropdown-item" href="/export/{{ ds }}.csv{{ export_qs }}">{{ label }} (CSV)</a></li>
+        <li><a class="dropdown-item" href="/export/{{ ds }}.xlsx{{ export_qs }}">{{ label }} (XLSX)</a></li>
+        {% endfor %}
+        <li><hr class="dropdown-divider"></li>
+        <li><a class="dropdown-item" href="/export/matriz.xlsx">Matriz de condición (Excel)</a></li>
+      </ul>
+    </div>
+    <a class="btn btn-primary" href="/machines/add">+ Agregar</a>
+  </div>
 </div>
 <div class="mb-2"><small class="text-muted">Agrupado por: Tipo de equipo (según Excel)</small></div>
 
 <div class="card p-4 mb-4" style="background: #f8f9fa;">
   <h6 class="mb-3"><strong>Filtrar Máquinas</strong></h6>
   <form method="get" class="row g-3">
-    <div class="col-md-4">
+    <div class="col-md-3">
       <label class="form-label">Buscar por nombre</label>
       <input type="text" class="form-control" name="search" placeholder="Nombre de máquina..." value="{{ search or '' }}">
     </div>
-    <div class="col-md-3">
+    <div class="col-md-2">
       <label class="form-label">Prioridad</label>
       <select class="form-select" name="priority">
         <option value="">-- Todas --</option>
@@ -205,12 +230,29 @@ MACHINES_LIST = """
         <option value="5" {% if filter_priority == '5' %}selected{% endif %}>5 (Alta)</option>
       </select>
     </div>
+    <div class="col-md-2">
+      <label class="form-label">Color</label>
+      <select class="form-select" name="color">
+        <option value="">-- Todos --</option>
+        {% for value, label in [('red','Rojo'),('yellow','Amarillo'),('blue','Azul'),('green','Verde')] %}
+        <option value="{{ value }}" {% if filter_color == value %}selected{% endif %}>{{ label }}</option>
+        {% endfor %}
+      </select>
+    </div>
       
+    <div class="col-md-3">
+      <label class="form-label">Ordenar</label>
+      <select class="form-select" name="sort">
+        <option value="">Prioridad</option>
+        <option value="red" {% if sort == 'red' %}selected{% endif %}>Tiempo a rojo</option>
+      </select>
+    </div>
+
     <div class="col-md-2 d-flex align-items-end">
       <button type="submit" class="btn btn-primary w-100">Filtrar</button>
     </div>
   </form>
-  {% if search or filter_priority or filter_group %}
+  {% if search or filter_priority or filter_group or filter_color or sort or request.args.get('node') %}
   <div class="mt-2">
     <a href="/" class="btn btn-sm btn-outline-secondary">Limpiar filtros</a>
   </div>
@@ -287,6 +329,13 @@ MACHINES_LIST = """
               {% endif %}
             {% endif %}
           </div>
+          {% set spark, forecast = sparks.get(m.id), forecasts.get(m.id) %}
+          {% if spark %}<div class="mb-2" title="Criticidad en el tiempo">{{ spark|safe }}</div>{% endif %}
+          {% if forecast and forecast.red_at %}
+            <small class="d-block mb-2 {% if forecast.days_to_red <= 30 %}text-danger{% else %}small-muted{% endif %}" title="Proyección de la tendencia de criticidad (banda desde {{ forecast.red_lo }})">
+              {% if forecast.days_to_red <= 0 %}Rojo según tendencia{% else %}Rojo en ~{{ forecast.days_to_red }} días ({{ forecast.red_at }}){% endif %}
+            </small>
+          {% endif %}
           {% if m.notes %}<small class="text-muted d-block mb-2">{{ m.notes }}</small>{% endif %}
           <div class="mt-2">
             <a class="btn btn-sm btn-outline-primary" href="/machines/{{ m.id }}/edit">Editar</a>
@@ -333,6 +382,17 @@ MACHINE_ADD = """
       
       <label class="form-label"><strong>Prioridad (1-5)</strong></label>
       <input type="number" name="priority" min="1" max="5" value="3" class="form-control mb-3" required>
+
+      <div class="row">
+        <div class="col-md-6">
+          <label class="form-label"><strong>Área</strong></label>
+          <input class="form-control mb-3" name="area" placeholder="Ej: 200">
+        </div>
+        <div class="col-md-6">
+          <label class="form-label"><strong>Tipo de equipo</strong></label>
+          <input class="form-control mb-3" name="machine_type" placeholder="Ej: TP">
+        </div>
+      </div>
       
       <label class="form-label"><strong>Notas</strong></label>
       <textarea name="notes" class="form-control mb-3" rows="3" placeholder="Notas adicionales..."></textarea>
@@ -353,9 +413,21 @@ MACHINE_EDIT = """
       
       <label class="form-label"><strong>Prioridad (1-5)</strong></label>
       <input type="number" name="priority" min="1" max="5" value="{{ m.priority }}" class="form-control mb-3" required>
+
+      <div class="row">
+        <div class="col-md-6">
+          <label class="form-label"><strong>Área</strong></label>
+          <input class="form-control mb-3" name="area" value="{{ m.area or '' }}" placeholder="Ej: 200">
+        </div>
+        <div class="col-md-6">
+          <label class="form-label"><strong>Tipo de equipo</strong></label>
+          <input class="form-control mb-3" name="machine_type" value="{{ m.machine_type or '' }}" placeholder="Ej: TP">
+        </div>
+      </div>
       
-      <label class="form-label"><strong>Notas</strong></label>
-      <textarea name="notes" class="form-control mb-3" rows="3">{{ m.notes or '' }}</textarea>
+      <label class="form-label"><strong>Agregar nota</strong></label>
+      {% if m.notes %}<small class="text-muted d-block mb-1">Última: {{ m.notes }}</small>{% endif %}
+      <textarea name="notes" class="form-control mb-3" rows="3" placeholder="Las notas anteriores se conservan en el historial de la máquina"></textarea>
       
       <button class="btn btn-primary w-100">Guardar</button>
     </form>
@@ -387,7 +459,12 @@ MACHINE_DETAIL = """
       {% elif machine['color'] == 'green' %}
         <div class="text-success small">Bien</div>
       {% endif %}
-      {% if machine.notes %}<small class="text-muted d-block mt-2">{{ machine.notes }}</small>{% endif %}
+      {% if machine_spark %}<div class="mt-2" title="Criticidad en el tiempo">{{ machine_spark|safe }}</div>{% endif %}
+      {% if notes %}
+        <details class="mt-2"><summary class="small text-muted">{{ machine.notes }}{% if notes|length > 1 %} ({{ notes|length }} notas){% endif %}</summary>
+          {% for n in notes %}<div class="small border-start ps-2 my-1" style="white-space:pre-line">{{ n.body }}<span class="text-muted d-block">v{{ n.version }} · {{ n.created_at }}{% if n.source %} · {{ n.source }}{% endif %}</span></div>{% endfor %}
+        </details>
+      {% elif machine.notes %}<small class="text-muted d-block mt-2">{{ machine.notes }}</small>{% endif %}
     </div>
   </div>
   <div>
@@ -403,6 +480,13 @@ MACHINE_DETAIL = """
   <div class="col-md-4 mb-3">
     <div class="card p-3">
       <h6>{{ tool_status.tool }}</h6>
+      {% set spark = sparks.get(tool_status.id, {}) %}
+      {% if spark.crit or spark.sev %}
+        <div class="d-flex gap-3 mb-2">
+          {% if spark.crit %}<div><small class="small-muted d-block">Criticidad</small>{{ spark.crit|safe }}</div>{% endif %}
+          {% if spark.sev %}<div><small class="small-muted d-block">Severidad</small>{{ spark.sev|safe }}</div>{% endif %}
+        </div>
+      {% endif %}
       {% if tool_status.criticality %}
         <div class="badge-crit crit-{{ [tool_status.criticality//3, 1]|max|min(4) }} crit-{{ [tool_status.criticality//3, 1]|max|min(4) }}-text">
           Criticidad: {{ tool_status.criticality }}/10
@@ -417,11 +501,19 @@ MACHINE_DETAIL = """
   {% endfor %}
 </div>
 
-<h5 class="mt-5 mb-3">Historial Completo</h5>
+<div class="d-flex justify-content-between align-items-end mt-5 mb-3">
+  <h5 class="mb-0">Historial {% if since or until %}filtrado{% else %}Completo{% endif %}</h5>
+  <form method="get" class="d-flex gap-2 align-items-end">
+    <div><label class="form-label small mb-0">Desde</label><input type="date" name="desde" class="form-control form-control-sm" value="{{ since or '' }}"></div>
+    <div><label class="form-label small mb-0">Hasta</label><input type="date" name="hasta" class="form-control form-control-sm" value="{{ until or '' }}"></div>
+    <button class="btn btn-sm btn-outline-primary">Filtrar</button>
+    {% if since or until %}<a class="btn btn-sm btn-outline-secondary" href="/machines/{{ machine.id }}">Todo</a>{% endif %}
+  </form>
+</div>
 <div class="table-responsive">
   <table class="table">
     <thead>
-      <tr><th>Fecha</th><th>Herramienta</th><th>Criticidad</th><th>Nota</th><th></th></tr>
+      <tr><th>Fecha</th><th>Herramienta</th><th>Criticidad</th><th>Nota</th><th>Adjuntos</th><th></th></tr>
     </thead>
     <tbody>
       {% for record in history %}
@@ -430,12 +522,35 @@ MACHINE_DETAIL = """
         <td>{{ record.tool }}</td>
         <td><span class="badge crit-{{ [record.criticality//3, 1]|max|min(4) }}">{{ record.criticality }}</span></td>
         <td>{{ record.note or '' }}</td>
+        <td>{% if attachment_counts.get(record.id) %}<a href="#adjuntos">📎 {{ attachment_counts[record.id] }}</a>{% endif %}</td>
         <td><a href="/measurements/{{ record.id }}/delete" class="btn btn-sm btn-outline-danger" onclick="return confirm('¿Eliminar?')">X</a></td>
       </tr>
       {% endfor %}
     </tbody>
   </table>
 </div>
+
+<h5 class="mt-5 mb-3" id="adjuntos">Adjuntos ({{ attachments|length }})</h5>
+{% if history %}
+<form method="post" enctype="multipart/form-data" class="d-flex gap-2 align-items-end mb-3"
+      onsubmit="this.action='/measurements/' + this.measurement.value + '/attachments'">
+  <div><label class="form-label small mb-0">Medición</label>
+    <select name="measurement" class="form-select form-select-sm">
+      {% for record in history %}<option value="{{ record.id }}">{{ record.date }} · {{ record.tool }}</option>{% endfor %}
+    </select>
+  </div>
+  <div><input type="file" name="files" class="form-control form-control-sm" accept="image/*,application/pdf" multiple required></div>
+  <button class="btn btn-sm btn-outline-primary">Adjuntar</button>
+</form>
+{% endif %}
+<div class="d-flex flex-wrap gap-2">
+  {% for a in attachments %}
+  <a href="/attachments/{{ a.id }}" target="_blank" class="text-decoration-none text-muted small" title="{{ a.filename or '' }} · {{ a.tool or '' }} · {{ a.created_at }}">
+    <img src="/attachments/{{ a.id }}/thumb" loading="lazy" decoding="async" width="160" height="120"
+         style="object-fit:cover;border-radius:6px;border:1px solid #dee2e6" alt="{{ a.filename or 'adjunto' }}">
+  </a>
+  {% endfor %}
+</div>
 """
 
 CALENDAR_TEMPLATE = """
@@ -529,85 +644,134 @@ document.getElementById('clear_all_btn').addEventListener('click', function(){
 </script>
 """
 
-@app.route("/")
-def machines_list():
-  conn = get_db()
-
-  # Get filter parameters
-  search = request.args.get('search', '').strip().lower()
-  filter_priority = request.args.get('priority', '')
-  filter_group = request.args.get('group', '')
-  filter_color = request.args.get('color', '')
+def machine_filters(args):
+  # shared by the home page and the export endpoints
+  search = args.get('search', '').strip().lower()
+  filter_priority = args.get('priority', '')
+  filter_group = args.get('group', '')
+  filter_color = args.get('color', '')
+  filter_node = args.get('node', '')
 
-  # Build SQL query with filters
-  query = "SELECT * FROM machines WHERE 1=1"
+  where = "1=1"
   params = []
 
   if search:
-    query += " AND LOWER(name) LIKE ?"
+    where += " AND LOWER(name) LIKE ?"
     params.append(f"%{search}%")
 
   if filter_priority:
-    query += " AND priority = ?"
+    where += " AND priority = ?"
     params.append(int(filter_priority))
 
   if filter_group:
-    query += " AND machine_group = ?"
+    where += " AND machine_group = ?"
     params.append(int(filter_group))
 
-  query += " ORDER BY priority DESC, name"
-
-  rows = conn.execute(query, params).fetchall()
-  # Build machines list with latest criticality and color
-  machines = []
-  for r in rows:
-    mid = r['id']
-    latest = conn.execute("SELECT criticality FROM measurements WHERE machine_id=? ORDER BY date DESC LIMIT 1", (mid,)).fetchone()
-    latest_crit = latest['criticality'] if latest and latest['criticality'] is not None else None
-    # determine color: prefer persisted DB color if present
-    if 'color' in r.keys() and r['color']:
-      color = r['color']
-    else:
-      if latest_crit is None:
-        color = 'green'
-      else:
-        try:
-          lc = int(latest_crit)
-        except Exception:
-          lc = 0
-        if lc >= 8:
-          color = 'red'
-        elif lc >= 5:
-          color = 'yellow'
-        elif lc >= 3:
-          color = 'blue'
-        else:
-          color = 'green'
-    machines.append({
-      'id': r['id'],
-      'name': r['name'],
-      'notes': r['notes'],
-      'priority': r['priority'],
-      'machine_group': (r['machine_group'] if 'machine_group' in r.keys() else 1),
-      'latest_crit': latest_crit,
-      'color': color,
-      'machine_type': (r['machine_type'] if 'machine_type' in r.keys() and r['machine_type'] else 'Sin tipo'),
-      'color_hex': (r['color_hex'] if 'color_hex' in r.keys() else None),
-      'hac_code': (r['hac_code'] if 'hac_code' in r.keys() else None)
-    })
+  if filter_color:
+    # same effective color as the home page: the Excel color, else the latest criticality's
+    where += " AND " + maquinas_fleet.color_sql("machines.id") + " = ?"
+    params.append(filter_color)
 
-  conn.close()
+  if filter_node:
+    # drill-down from /assets: machines under that area / type
+    where += " AND " + maquinas_assets.subtree_filter_sql("id")
+    params.append(int(filter_node))
+
+  return where, params
 
-  # group machines by Tipo equipo for template
-  groups = {}
-  for m in machines:
-    groups.setdefault(m.get('machine_type','Sin tipo'), []).append(m)
+@app.route("/")
+def machines_list():
+  conn = get_db()
+
+  # Get filter parameters
+  search = request.args.get('search', '').strip().lower()
+  filter_priority = request.args.get('priority', '')
+  filter_group = request.args.get('group', '')
+  filter_color = request.args.get('color', '')
+  sort = request.args.get('sort', '')
+  filter_node = request.args.get('node', '')
+
+  # in-memory snapshot: filters are index lookups, no per-request rows
+  ids = None
+  if filter_node:
+    # drill-down from /assets: machines under that area / type
+    ids = [r[0] for r in conn.execute("SELECT id FROM machines WHERE " + maquinas_assets.subtree_filter_sql("id"), (int(filter_node),))]
+  machines, groups = maquinas_fleet.fleet(conn).select(
+    search=search,
+    priority=int(filter_priority) if filter_priority else None,
+    group=int(filter_group) if filter_group else None,
+    color=filter_color or None,
+    ids=ids)
+
+  # cached per machine; only charts invalidated by new measurements are rebuilt
+  ids = [m.id for m in machines]
+  sparks = maquinas_sparklines.machine_sparklines(conn, ids)
+  forecasts = maquinas_forecast.machine_forecasts(conn, ids)
+  if sort == 'red':
+    # soonest projected red first; machines without a crossing keep their order at the end
+    def red_key(m):
+      fc = forecasts.get(m.id)
+      return (fc is None or fc['red_at'] is None, (fc or {}).get('red_at') or '')
+    machines = sorted(machines, key=red_key)
+    groups = {t: sorted(ms, key=red_key) for t, ms in groups.items()}
+
+  conn.close()
 
   filter_priority_val = filter_priority if filter_priority else None
   filter_group_val = int(filter_group) if filter_group else None
 
-  return render(MACHINES_LIST, page_title="Máquinas", groups=groups, machines=machines,
-          search=search, filter_priority=filter_priority_val, filter_group=filter_group_val, filter_color=filter_color)
+  export_qs = ('?' + request.query_string.decode()) if request.query_string else ''
+
+  return render(MACHINES_LIST, page_title="Máquinas", groups=groups, machines=machines, sparks=sparks, forecasts=forecasts,
+          search=search, filter_priority=filter_priority_val, filter_group=filter_group_val, filter_color=filter_color,
+          sort=sort, export_qs=export_qs)
+
+@app.route("/export/matriz.xlsx")
+def export_matrix():
+  import tempfile
+  conn = get_db()
+  tmp = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+  try:
+    maquinas_export.write_cm_matrix(conn, tmp)
+  finally:
+    conn.close()
+  tmp.seek(0)
+
+  def generate():
+    with tmp:
+      while True:
+        data = tmp.read(64 * 1024)
+        if not data:
+          break
+        yield data
+
+  filename = f"Matriz de condición {datetime.now().strftime('%Y%m%d')}.xlsx"
+  return Response(generate(), mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                  headers={'Content-Disposition': f"attachment; filename=\"matriz_condicion.xlsx\"; filename*=UTF-8''{quote(filename)}"})
+
+@app.route("/export/<dataset>.<fmt>")
+def export_data(dataset, fmt):
+  if dataset not in maquinas_export.DATASETS or fmt not in ('csv', 'xlsx'):
+    return "Exportación no encontrada", 404
+  where, params = machine_filters(request.args)
+  headers = maquinas_export.headers_for(dataset)
+
+  def generate():
+    # the connection lives as long as the response is being streamed
+    conn = get_db()
+    try:
+      rows = maquinas_export.iter_dataset(conn, dataset, where, params)
+      if fmt == 'csv':
+        yield from maquinas_export.csv_stream(rows, headers)
+      else:
+        yield from maquinas_export.xlsx_stream(rows, headers, maquinas_export.SHEET_TITLES[dataset])
+    finally:
+      conn.close()
+
+  mimetype = 'text/csv' if fmt == 'csv' else 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+  filename = f"{dataset}_{datetime.now().strftime('%Y%m%d_%H%M')}.{fmt}"
+  return Response(stream_with_context(generate()), mimetype=mimetype,
+                  headers={'Content-Disposition': f'attachment; filename="{filename}"'})
 
 @app.route("/machines/add", methods=["GET","POST"])
 def machines_add():
@@ -618,8 +782,14 @@ def machines_add():
         machine_group = int(request.form.get("machine_group", "1"))
         conn = get_db()
         try:
-            conn.execute("INSERT INTO machines (name, priority, notes, machine_group) VALUES (?,?,?,?)", (name, priority, notes, machine_group))
+            area = request.form.get("area","").strip() or None
+            machine_type = request.form.get("machine_type","").strip() or None
+            cur = conn.execute("INSERT INTO machines (name, priority, machine_group, area, machine_type) VALUES (?,?,?,?,?)", (name, priority, machine_group, area, machine_type))
+            maquinas_notes.add(conn, cur.lastrowid, notes, source='web')
+            maquinas_events.machine_changed(conn, cur.lastrowid, source='web')
+            maquinas_assets.sync(conn, [cur.lastrowid])
             conn.commit()
+            maquinas_refcache.written(conn, 'machines')
             conn.close()
             return redirect("/")
         except:
@@ -639,8 +809,15 @@ def machines_edit(id):
         name = request.form.get("name","").strip()
         priority = int(request.form.get("priority", "3"))
         notes = request.form.get("notes","").strip()
-        conn.execute("UPDATE machines SET name=?, priority=?, notes=? WHERE id=?", (name, priority, notes, id))
+        area = request.form.get("area","").strip() or None
+        machine_type = request.form.get("machine_type","").strip() or None
+        conn.execute("UPDATE machines SET name=?, priority=?, area=?, machine_type=? WHERE id=?", (name, priority, area, machine_type, id))
+        # the form adds a note entry; earlier entries stay as history
+        maquinas_notes.add(conn, id, notes, source='web')
+        maquinas_events.machine_changed(conn, id, m, source='web')
+        maquinas_assets.sync(conn, [id])
         conn.commit()
+        maquinas_refcache.written(conn, 'machines')
         conn.close()
         return redirect(f"/machines/{id}")
     conn.close()
@@ -649,9 +826,24 @@ def machines_edit(id):
 @app.route("/machines/<int:id>/delete")
 def machines_delete(id):
     conn = get_db()
+    before = conn.execute("SELECT * FROM machines WHERE id=?", (id,)).fetchone()
+    maquinas_events.archived_measurements_deleted(conn, "m.machine_id=?", (id,), source='web')
+    maquinas_events.measurements_deleted(conn, "machine_id=?", (id,), source='web')
     conn.execute("DELETE FROM measurements WHERE machine_id=?", (id,))
     conn.execute("DELETE FROM machines WHERE id=?", (id,))
+    maquinas_attachments.detach(conn, machine_id=id)
+    maquinas_notes.delete_for(conn, id)
+    maquinas_match.forget_machine(conn, id)
+    maquinas_orders.forget(conn, machine_id=id)
+    maquinas_events.machine_changed(conn, id, before, source='web')
+    maquinas_sparklines.invalidate(conn, [id])
+    maquinas_analytics.close_alerts(conn, machine_id=id)
+    maquinas_forecast.invalidate(conn, machine_id=id)
+    maquinas_assets.sync(conn, [id])
     conn.commit()
+    maquinas_refcache.written(conn, 'machines')
+    maquinas_archive.delete_archived(conn, machine_id=id)
+    maquinas_attachments.gc(conn)
     conn.close()
     return redirect("/")
 
@@ -669,7 +861,10 @@ def machines_move(id):
         return redirect("/")
     
     conn = get_db()
+    before = conn.execute("SELECT * FROM machines WHERE id=?", (id,)).fetchone()
     conn.execute("UPDATE machines SET machine_group=? WHERE id=?", (group, id))
+    if before:
+        maquinas_events.machine_changed(conn, id, before, source='web')
     conn.commit()
     conn.close()
     return redirect("/")
@@ -693,17 +888,126 @@ def machine_detail(id):
         ORDER BY t.name
     """, (id, id, id)).fetchall()
     
-    # Historial
-    history = conn.execute("""
-        SELECT m.id, m.date, t.name as tool, m.criticality, m.note
-        FROM measurements m
-        JOIN tools t ON t.id = m.tool_id
-        WHERE m.machine_id = ?
-        ORDER BY m.date DESC
-    """, (id,)).fetchall()
+    # Historial (archived years are attached only when the range reaches them)
+    since = request.args.get('desde', '').strip() or None
+    until = request.args.get('hasta', '').strip() or None
+    history = maquinas_archive.machine_history(conn, id, since, f"{until} 23:59" if until else None)
+
+    sparks = maquinas_sparklines.tool_sparklines(conn, id)
+    machine_spark = maquinas_sparklines.machine_sparklines(conn, [id]).get(id)
+    attachments = maquinas_attachments.for_machine(conn, id)
+    attachment_counts = maquinas_attachments.counts_by_measurement(conn, id)
+    notes = maquinas_notes.entries(conn, id)
     
     conn.close()
-    return render(MACHINE_DETAIL, page_title=machine["name"], machine=machine, current_status=current, history=history)
+    return render(MACHINE_DETAIL, page_title=machine["name"], machine=machine, current_status=current, history=history,
+                  since=since, until=until, sparks=sparks, machine_spark=machine_spark,
+                  attachments=attachments, attachment_counts=attachment_counts, notes=notes)
+
+# ============ ÁREAS ============
+
+ASSETS_VIEW = """
+<nav aria-label="breadcrumb">
+  <ol class="breadcrumb">
+    {% for c in crumbs %}<li class="breadcrumb-item"><a href="/assets/{{ c.id }}">{{ c.name }}</a></li>{% endfor %}
+    <li class="breadcrumb-item active">{{ node.name }}</li>
+  </ol>
+</nav>
+<div class="d-flex justify-content-between align-items-center mb-3">
+  <div>
+    <h3>{{ labels.get(node.kind, '') }}: {{ node.name }}</h3>
+    <small class="text-muted">{{ node.machines or 0 }} máquinas · peor criticidad {{ node.worst_crit if node.worst_crit is not none else '-' }} · {{ node.overdue or 0 }} sin inspección en {{ inspection_days }} días</small>
+  </div>
+  <a class="btn btn-outline-primary" href="/?node={{ node.id }}">Ver máquinas</a>
+</div>
+<div class="row">
+  {% for c in children %}
+  <div class="col-md-4 mb-3">
+    <div class="card p-3 card-hover machine-card" {% if c.color_hex %} style="border-left:6px solid #{{ c.color_hex }}" {% endif %}>
+      {% if c.kind == 'machine' %}
+        <h5><a href="/machines/{{ c.machine_id }}" class="text-decoration-none">{{ c.name }}</a></h5>
+        {% if c.hac_code %}<small class="text-muted">HAC: {{ c.hac_code }}</small>{% endif %}
+      {% else %}
+        <h5><a href="/assets/{{ c.id }}" class="text-decoration-none">{{ c.name }}</a> <small class="text-muted">({{ c.machines or 0 }})</small></h5>
+        <small class="text-muted">{{ labels.get(c.kind, '') }}</small>
+      {% endif %}
+      <div class="d-flex gap-1 flex-wrap mt-2">
+        {% if c.red %}<span class="badge bg-danger">{{ c.red }} rojo</span>{% endif %}
+        {% if c.yellow %}<span class="badge bg-warning text-dark">{{ c.yellow }} amarillo</span>{% endif %}
+        {% if c.blue %}<span class="badge bg-primary">{{ c.blue }} azul</span>{% endif %}
+        {% if c.green %}<span class="badge bg-success">{{ c.green }} verde</span>{% endif %}
+        {% if c.overdue %}<span class="badge bg-secondary">{{ c.overdue }} vencida{{ 's' if c.overdue > 1 else '' }}</span>{% endif %}
+      </div>
+      <small class="small-muted mt-2">Peor criticidad: {{ c.worst_crit if c.worst_crit is not none else '-' }} · Última inspección: {{ (c.last_date or '-')[:10] }}</small>
+    </div>
+  </div>
+  {% endfor %}
+</div>
+{% if not children %}
+<div class="alert alert-info">Sin elementos</div>
+{% endif %}
+"""
+
+@app.route("/assets")
+@app.route("/assets/<int:node_id>")
+def assets_view(node_id=None):
+    conn = get_db()
+    if node_id is None:
+        root = maquinas_assets.root_node(conn)
+        node_id = root['id'] if root else 0
+    node, crumbs, children = maquinas_assets.node_view(conn, node_id)
+    conn.close()
+    if not node:
+        return "No encontrado", 404
+    return render(ASSETS_VIEW, page_title=node['name'], node=node, crumbs=crumbs, children=children,
+                  labels=maquinas_assets.KIND_LABELS, inspection_days=maquinas_assets.INSPECTION_DAYS)
+
+FLEET_VIEW = """
+<h3 class="mb-3">Flota: todas las plantas</h3>
+{% if errors %}
+<div class="alert alert-warning">Sin datos de: {% for site, err in errors.items() %}<strong>{{ site }}</strong> ({{ err }}){% if not loop.last %}, {% endif %}{% endfor %}</div>
+{% endif %}
+<table class="table table-sm align-middle">
+  <thead><tr><th>Planta</th><th>Máquinas</th><th>Rojo</th><th>Amarillo</th><th>Azul</th><th>Verde</th><th>Vencidas</th><th>Alertas</th><th>Peor</th></tr></thead>
+  <tbody>
+  {% for site, s in summaries|dictsort %}
+    <tr>
+      <td><a href="/assets?site={{ site }}">{{ site }}</a></td>
+      <td>{{ s.machines }}</td><td>{{ s.red }}</td><td>{{ s.yellow }}</td><td>{{ s.blue }}</td><td>{{ s.green }}</td>
+      <td>{{ s.overdue }}</td><td><a href="/alerts?site={{ site }}">{{ s.alerts }}</a></td>
+      <td>{{ s.worst_crit if s.worst_crit is not none else '-' }}</td>
+    </tr>
+  {% endfor %}
+  </tbody>
+  <tfoot><tr class="fw-bold">
+    <td>Total</td><td>{{ total.machines }}</td><td>{{ total.red }}</td><td>{{ total.yellow }}</td><td>{{ total.blue }}</td><td>{{ total.green }}</td>
+    <td>{{ total.overdue }}</td><td>{{ total.alerts }}</td><td>{{ total.worst_crit if total.worst_crit is not none else '-' }}</td>
+  </tr></tfoot>
+</table>
+
+<h5 class="mt-4">Máquinas más críticas</h5>
+<table class="table table-sm align-middle">
+  <thead><tr><th>Planta</th><th>Máquina</th><th>Área</th><th>Tipo</th><th>Criticidad</th><th>Última inspección</th></tr></thead>
+  <tbody>
+  {% for m in worst %}
+    <tr>
+      <td>{{ m.site }}</td>
+      <td><a href="/machines/{{ m.machine_id }}?site={{ m.site }}">{{ m.name }}</a>{% if m.hac_code %} <small class="text-muted">{{ m.hac_code }}</small>{% endif %}</td>
+      <td>{{ m.area or '-' }}</td><td>{{ m.machine_type or '-' }}</td>
+      <td><strong>{{ m.worst_crit }}</strong></td><td>{{ (m.last_date or '-')[:10] }}</td>
+    </tr>
+  {% endfor %}
+  </tbody>
+</table>
+"""
+
+@app.route("/fleet")
+def fleet_view():
+    limit = min(request.args.get("limit", 20, type=int), 500)
+    summaries, total, errors = maquinas_sites.fleet_summary()
+    worst, worst_errors = maquinas_sites.fleet_worst(limit)
+    errors.update(worst_errors)
+    return render(FLEET_VIEW, page_title="Flota", summaries=summaries, total=total, worst=worst, errors=errors)
 
 # ============ HERRAMIENTAS ============
 
@@ -769,7 +1073,7 @@ TOOL_EDIT = """
 @app.route("/tools")
 def tools_list():
     conn = get_db()
-    tools = conn.execute("SELECT * FROM tools ORDER BY name").fetchall()
+    tools = maquinas_refcache.tools(conn)
     conn.close()
     return render(TOOLS_LIST, page_title="Herramientas", tools=tools)
 
@@ -777,8 +1081,8 @@ def tools_list():
 @app.route('/calendar', methods=['GET','POST'])
 def calendar():
     conn = get_db()
-    tools = conn.execute("SELECT * FROM tools ORDER BY name").fetchall()
-    machines = conn.execute("SELECT id, name, machine_type FROM machines ORDER BY COALESCE(machine_type,''), name").fetchall()
+    # dropdowns come from the per-process reference cache (one counter read when nothing changed)
+    tools, machines = maquinas_refcache.get(conn, 'tools', 'machines')
 
     if request.method == 'POST':
         date_in = request.form.get('date')
@@ -797,24 +1101,20 @@ def calendar():
 
         severity = request.form.get('severity', 'gris')
         # map severity to repair_time
-        repair_map = {
-          'rojo': '24h',
-          'naranja': '48h',
-          'amarillo': '72h',
-          'verde': 'Sin acción',
-          'gris': 'No aplica'
-        }
-        repair_time = repair_map.get(severity, 'No aplica')
+        repair_time = maquinas_export.REPAIR_TIMES.get(severity, 'No aplica')
 
         inserted = 0
+        touched = []
         for mid in machine_ids:
           for tid in tool_ids:
             try:
-              conn.execute("INSERT INTO measurements (machine_id, tool_id, date, criticality, note, severity, repair_time) VALUES (?,?,?,?,?,?,?)", (int(mid), int(tid), date_val, None, note, severity, repair_time))
+              cur = conn.execute("INSERT INTO measurements (machine_id, tool_id, date, criticality, note, severity, repair_time) VALUES (?,?,?,?,?,?,?)", (int(mid), int(tid), date_val, None, note, severity, repair_time))
+              maquinas_events.measurement_inserted(conn, cur.lastrowid, source='calendar')
               inserted += 1
+              touched.append((int(mid), int(tid)))
             except Exception:
               pass
-        conn.commit()
+        measurements_written(conn, touched)
         conn.close()
         flash(f'Notas añadidas: {inserted}')
         return redirect('/calendar')
@@ -847,8 +1147,10 @@ def tools_add():
         description = request.form.get("description","").strip()
         conn = get_db()
         try:
-            conn.execute("INSERT INTO tools (name, description) VALUES (?,?)", (name, description))
+            cur = conn.execute("INSERT INTO tools (name, description) VALUES (?,?)", (name, description))
+            maquinas_events.tool_changed(conn, cur.lastrowid, source='web')
             conn.commit()
+            maquinas_refcache.written(conn, 'tools')
             conn.close()
             return redirect("/tools")
         except:
@@ -868,7 +1170,9 @@ def tools_edit(id):
         name = request.form.get("name","").strip()
         description = request.form.get("description","").strip()
         conn.execute("UPDATE tools SET name=?, description=? WHERE id=?", (name, description, id))
+        maquinas_events.tool_changed(conn, id, t, source='web')
         conn.commit()
+        maquinas_refcache.written(conn, 'tools')
         conn.close()
         return redirect("/tools")
     conn.close()
@@ -877,9 +1181,22 @@ def tools_edit(id):
 @app.route("/tools/<int:id>/delete")
 def tools_delete(id):
     conn = get_db()
+    before = conn.execute("SELECT * FROM tools WHERE id=?", (id,)).fetchone()
+    maquinas_events.archived_measurements_deleted(conn, "m.tool_id=?", (id,), source='web')
+    maquinas_events.measurements_deleted(conn, "tool_id=?", (id,), source='web')
     conn.execute("DELETE FROM measurements WHERE tool_id=?", (id,))
     conn.execute("DELETE FROM tools WHERE id=?", (id,))
+    maquinas_events.tool_changed(conn, id, before, source='web')
+    maquinas_attachments.detach(conn, tool_id=id)
+    maquinas_orders.forget(conn, tool_id=id)
+    maquinas_sparklines.invalidate(conn)
+    maquinas_analytics.close_alerts(conn, tool_id=id)
+    maquinas_forecast.invalidate(conn, tool_id=id)
+    maquinas_assets.refresh_rollups(conn)
     conn.commit()
+    maquinas_refcache.written(conn, 'tools')
+    maquinas_archive.delete_archived(conn, tool_id=id)
+    maquinas_attachments.gc(conn)
     conn.close()
     return redirect("/tools")
 
@@ -993,7 +1310,7 @@ MEASUREMENT_ADD = """
 <div class="row justify-content-center">
   <div class="col-md-6">
     <h4>Registrar Medición - {{ machine.name }}</h4>
-    <form method="post" class="card p-4">
+    <form method="post" class="card p-4" enctype="multipart/form-data">
       <label class="form-label"><strong>Herramienta</strong></label>
       <select name="tool_id" class="form-select mb-3" required>
         <option value="">-- Seleccionar --</option>
@@ -1008,6 +1325,9 @@ MEASUREMENT_ADD = """
       
       <label class="form-label"><strong>Nota (opcional)</strong></label>
       <textarea name="note" class="form-control mb-3" rows="3"></textarea>
+
+      <label class="form-label"><strong>Fotos / termografías / PDF (opcional)</strong></label>
+      <input type="file" name="files" class="form-control mb-3" accept="image/*,application/pdf" multiple>
       
       <button class="btn btn-primary w-100">Guardar Medición</button>
     </form>
@@ -1030,285 +1350,498 @@ def measurements_add():
         note = request.form.get("note","").strip()
         date = datetime.now().strftime("%Y-%m-%d %H:%M")
         
-        conn.execute(
+        cur = conn.execute(
             "INSERT INTO measurements (machine_id, tool_id, date, criticality, note) VALUES (?,?,?,?,?)",
             (mid, tool_id, date, criticality, note)
         )
-        conn.commit()
+        maquinas_events.measurement_inserted(conn, cur.lastrowid, source='web')
+        stored = save_attachments(conn, cur.lastrowid)
+        measurements_written(conn, [(machine['id'], int(tool_id))])
+        thumbnails_later(conn, stored)
         conn.close()
         return redirect(f"/machines/{mid}")
     
-    tools = conn.execute("SELECT * FROM tools ORDER BY name").fetchall()
+    tools = maquinas_refcache.tools(conn)
     conn.close()
     return render(MEASUREMENT_ADD, page_title="Medición", machine=machine, tools=tools)
 
+def save_attachments(conn, measurement_id):
+    # uploaded files of the current request; bad files are reported and skipped
+    stored = []
+    for f in request.files.getlist("files"):
+        if not f or not f.filename:
+            continue
+        try:
+            stored.append(maquinas_attachments.attach(conn, measurement_id, f.stream, f.filename))
+        except ValueError as e:
+            flash(f"{f.filename}: {e}")
+    return stored
+
+def thumbnails_later(conn, stored):
+    root = maquinas_attachments.store_dir(conn)
+    for _, sha, mime in stored:
+        maquinas_attachments.schedule_thumbnail(root, sha, mime)
+
+@app.route("/measurements/<int:id>/attachments", methods=["POST"])
+def measurements_attach(id):
+    conn = get_db()
+    m = conn.execute("SELECT machine_id FROM measurements WHERE id=?", (id,)).fetchone()
+    if not m:
+        conn.close()
+        return "Medición no encontrada", 404
+    stored = save_attachments(conn, id)
+    conn.commit()
+    thumbnails_later(conn, stored)
+    conn.close()
+    return redirect(f"/machines/{m['machine_id']}#adjuntos")
+
+@app.route("/attachments/<int:id>")
+def attachment_file(id):
+    # content-addressed and immutable: long browser cache, file streamed by the server (sendfile where available)
+    conn = get_db()
+    a = maquinas_attachments.get(conn, id)
+    root = maquinas_attachments.store_dir(conn)
+    conn.close()
+    if not a:
+        return "No encontrado", 404
+    path = maquinas_attachments.blob_path(root, a['sha256'])
+    if not os.path.exists(path):
+        return "Archivo faltante", 404
+    resp = send_file(path, mimetype=a['mime'], download_name=a['filename'] or a['sha256'],
+                     etag=a['sha256'], max_age=maquinas_attachments.CACHE_SECONDS, conditional=True)
+    resp.cache_control.immutable = True
+    return resp
+
+@app.route("/attachments/<int:id>/thumb")
+def attachment_thumb(id):
+    conn = get_db()
+    a = maquinas_attachments.get(conn, id)
+    root = maquinas_attachments.store_dir(conn)
+    conn.close()
+    if not a:
+        return "No encontrado", 404
+    path = maquinas_attachments.thumb_path(root, a['sha256'])
+    if os.path.exists(path):
+        resp = send_file(path, mimetype="image/jpeg", etag=a['sha256'] + "-t",
+                         max_age=maquinas_attachments.CACHE_SECONDS, conditional=True)
+        resp.cache_control.immutable = True
+        return resp
+    # not generated yet (or no Pillow / a PDF): placeholder the browser must not keep
+    maquinas_attachments.schedule_thumbnail(root, a['sha256'], a['mime'])
+    resp = Response(maquinas_attachments.placeholder(a['mime']), mimetype="image/svg+xml")
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
 @app.route("/measurements/<int:id>/delete")
 def measurements_delete(id):
     conn = get_db()
     m = conn.execute("SELECT * FROM measurements WHERE id=?", (id,)).fetchone()
     mid = m["machine_id"] if m else 0
+    if not m:
+        # rows older than the archive horizon live in the per-year files
+        maquinas_events.archived_measurements_deleted(conn, "m.id=?", (id,), source='web')
+    maquinas_events.measurements_deleted(conn, "id=?", (id,), source='web')
     conn.execute("DELETE FROM measurements WHERE id=?", (id,))
+    maquinas_attachments.detach(conn, measurement_id=id)
+    if m:
+        maquinas_sparklines.invalidate(conn, [mid])
+        maquinas_forecast.invalidate(conn, pairs=[(mid, m["tool_id"])])
+        maquinas_assets.refresh_rollups(conn, [mid])
     conn.commit()
+    if m:
+        maquinas_analytics.detect_series(conn, [(mid, m["tool_id"])])
+    if not m:
+        mid = maquinas_archive.delete_archived(conn, measurement_id=id) or 0
+        maquinas_sparklines.invalidate(conn, [mid])
+        conn.commit()
+    maquinas_attachments.gc(conn)
     conn.close()
     return redirect(f"/machines/{mid}")
 
 
-# ---- Importar desde Excel (reglas en hoja 'Criterios') ----
-def detect_header_row(excel_path, sheet_name, max_scan=10):
-    try:
-        xls = pd.read_excel(excel_path, sheet_name=sheet_name, header=None)
-    except Exception:
-        return 0
-    for i in range(min(max_scan, len(xls))):
-        row = xls.iloc[i].astype(str).str.upper().tolist()
-        if any('AREA' == v or (isinstance(v, str) and v.strip().startswith('AREA')) for v in row if v and v != 'nan'):
-            return i
-    for i in range(min(max_scan, len(xls))):
-        row = xls.iloc[i].astype(str).str.upper().tolist()
-        if any('CÓDIGO' in v or 'CODIGO' in v or 'DENOMIN' in v for v in row if v and v != 'nan'):
-            return i
-    return 0
-
-
-def parse_criteria(excel_path):
-    try:
-        crit = pd.read_excel(excel_path, sheet_name='Criterios', header=None)
-    except Exception:
-        return {}
-    mapping = {}
-    for _, row in crit.iterrows():
-        texts = []
-        factors = []
-        for col_idx, val in enumerate(row):
-            if pd.isna(val):
-                continue
-            if isinstance(val, (int, float)) and not isinstance(val, bool):
-                factors.append((col_idx, float(val)))
-            else:
-                s = str(val).strip()
-                if s:
-                    texts.append((col_idx, s))
-        for fcol, fval in factors:
-            best = None
-            best_dist = 999
-            for tcol, tval in texts:
-                dist = abs(tcol - fcol)
-                if dist < best_dist:
-                    best = tval
-                    best_dist = dist
-            if best:
-                mapping[best.upper()] = fval
-    return mapping
-
-
-def score_row_by_criteria(row, criteria_map):
-    score = 0.0
-    matches = []
-    joined = ' '.join([str(x) for x in row.values if not pd.isna(x)])
-    joined_u = joined.upper()
-    for key, factor in criteria_map.items():
-        if key and key in joined_u:
-            score += factor
-            matches.append((key, factor))
-    return score, matches
+# ============ ALERTAS ============
 
+ALERTS_LIST = """
+<div class="d-flex justify-content-between align-items-center mb-3">
+  <h3>Problemas emergentes</h3>
+  <a class="btn btn-outline-secondary" href="/alerts/refresh">Recalcular</a>
+</div>
+<p class="text-muted">Series máquina/herramienta cuya criticidad empeora: pendiente sostenida, salto sobre la línea base (EWMA) o cambio de nivel.</p>
+{% if alerts %}
+<table class="table table-sm align-middle">
+  <thead><tr><th>Máquina</th><th>Herramienta</th><th>Tipo</th><th>Detalle</th><th>Puntaje</th><th>Desde</th><th></th></tr></thead>
+  <tbody>
+  {% for a in alerts %}
+    <tr>
+      <td><a href="/machines/{{ a.machine_id }}" class="text-decoration-none">{{ a.machine or a.machine_id }}</a>
+        {% if a.hac_code %}<br><small class="text-muted">HAC: {{ a.hac_code }}</small>{% endif %}</td>
+      <td>{{ a.tool or '-' }}</td>
+      <td>{{ labels.get(a.kind, a.kind) }}</td>
+      <td><small>{{ a.detail }}</small></td>
+      <td><strong>{{ '%.2f'|format(a.score) }}</strong></td>
+      <td><small class="text-muted">{{ a.created_at }}</small></td>
+      <td><a class="btn btn-sm btn-outline-secondary" href="/alerts/{{ a.id }}/close">Descartar</a></td>
+    </tr>
+  {% endfor %}
+  </tbody>
+</table>
+{% else %}
+<div class="alert alert-success">No hay problemas emergentes.</div>
+{% endif %}
+"""
 
-@app.route('/import_excel', methods=['GET'])
-def import_excel():
-    # Ruta para importar el Excel según reglas de la hoja 'Criterios'
-    excel_path = os.path.join(os.path.dirname(__file__), 'Matriz de condición de equipos principales excel.xlsx')
-    if not os.path.exists(excel_path):
-        return f"Archivo no encontrado: {excel_path}", 404
+@app.route("/alerts")
+def alerts_list():
+    conn = get_db()
+    alerts = maquinas_analytics.open_alerts(conn)
+    conn.close()
+    return render(ALERTS_LIST, page_title="Alertas", alerts=alerts, labels=maquinas_analytics.ALERT_LABELS)
 
-    # parse (dataframe) and openpyxl workbook for formatting
-    header = detect_header_row(excel_path, 'CM Matrix equipos principales')
-    try:
-      df = pd.read_excel(excel_path, sheet_name='CM Matrix equipos principales', header=header)
-      wb = load_workbook(excel_path, data_only=True)
-      ws = wb['CM Matrix equipos principales']
-    except Exception as e:
-      return f"Error leyendo hoja principal: {e}", 500
+@app.route("/alerts/<int:id>/close")
+def alerts_close(id):
+    conn = get_db()
+    maquinas_analytics.close_alerts(conn, alert_id=id, status='dismissed')
+    conn.commit()
+    conn.close()
+    return redirect("/alerts")
 
-    criteria_map = parse_criteria(excel_path)
-    max_single = max(criteria_map.values()) if criteria_map else 0
+# ============ ÓRDENES DE TRABAJO ============
+
+ORDERS_BOARD = """
+<div class="d-flex justify-content-between align-items-center mb-3">
+  <h3>Órdenes de trabajo</h3>
+  <small class="text-muted">Actualizado {{ now }} · se recarga cada minuto</small>
+</div>
+<p class="text-muted">Cada nota roja (24 h), naranja (48 h) o amarilla (72 h) abre una orden. Se cierra con una medición posterior de la misma herramienta en verde o gris (o con criticidad menor a 5), o a mano.</p>
+<div class="d-flex gap-3 mb-4">
+  <div class="card p-3"><strong class="fs-4 text-danger">{{ counts.overdue }}</strong><small>vencidas</small></div>
+  <div class="card p-3"><strong class="fs-4 text-warning">{{ counts.soon }}</strong><small>vencen en 24 h</small></div>
+  <div class="card p-3"><strong class="fs-4">{{ counts.open }}</strong><small>abiertas</small></div>
+</div>
+{% for title, orders in [('Vencidas', overdue), ('Vencen en las próximas 24 h', soon)] %}
+<h5>{{ title }}</h5>
+{% if orders %}
+<table class="table table-sm align-middle">
+  <thead><tr><th>Vence</th><th>Máquina</th><th>Herramienta</th><th>Severidad</th><th>Nota</th><th>Abierta</th><th></th></tr></thead>
+  <tbody>
+  {% for o in orders %}
+    <tr>
+      <td><strong>{{ o.due_at }}</strong></td>
+      <td><a href="/machines/{{ o.machine_id }}" class="text-decoration-none">{{ o.machine or o.machine_id }}</a>
+        {% if o.hac_code %}<br><small class="text-muted">HAC: {{ o.hac_code }}</small>{% endif %}</td>
+      <td>{{ o.tool or '-' }}</td>
+      <td><span class="sev-{{ o.severity }}">{{ o.severity|capitalize }}</span></td>
+      <td><small>{{ o.note or '' }}</small></td>
+      <td><small class="text-muted">{{ o.opened_at }}</small></td>
+      <td>
+        <form method="post" action="/orders/{{ o.id }}/complete" class="d-flex gap-1">
+          <input type="text" class="form-control form-control-sm" name="note" placeholder="Trabajo realizado">
+          <button class="btn btn-sm btn-outline-success">Completar</button>
+        </form>
+      </td>
+    </tr>
+  {% endfor %}
+  </tbody>
+</table>
+{% else %}
+<div class="alert alert-success">Ninguna.</div>
+{% endif %}
+{% endfor %}
+{% if closed %}
+<h5 class="mt-4">Cerradas recientemente</h5>
+<table class="table table-sm align-middle">
+  <thead><tr><th>Cerrada</th><th>Máquina</th><th>Herramienta</th><th>Severidad</th><th>Vencía</th><th>Cierre</th></tr></thead>
+  <tbody>
+  {% for o in closed %}
+    <tr>
+      <td><small>{{ o.closed_at }}</small></td>
+      <td>{{ o.machine or o.machine_id }}</td>
+      <td>{{ o.tool or '-' }}</td>
+      <td><span class="sev-{{ o.severity }}">{{ o.severity|capitalize }}</span></td>
+      <td><small class="{% if o.closed_at > o.due_at %}text-danger{% else %}text-muted{% endif %}">{{ o.due_at }}</small></td>
+      <td><small>{{ 'Medición' if o.closed_by == 'measurement' else 'Manual' }}{% if o.closing_note %}: {{ o.closing_note }}{% endif %}</small></td>
+    </tr>
+  {% endfor %}
+  </tbody>
+</table>
+{% endif %}
+<script>setTimeout(function(){ location.reload(); }, 60000);</script>
+"""
 
+@app.route("/orders")
+def orders_board():
     conn = get_db()
-    # ensure a tool exists to tag imports
-    tool = conn.execute("SELECT * FROM tools WHERE name=?", ('AutoImport',)).fetchone()
-    if not tool:
-        conn.execute("INSERT INTO tools (name, description) VALUES (?,?)", ('AutoImport', 'Mediciones importadas desde Excel'))
+    now = datetime.now()
+    overdue = maquinas_orders.overdue(conn, now)
+    soon = maquinas_orders.due_soon(conn, now)
+    counts = maquinas_orders.counts(conn, now)
+    closed = maquinas_orders.recently_closed(conn)
+    conn.close()
+    return render(ORDERS_BOARD, page_title="Órdenes", overdue=overdue, soon=soon, counts=counts, closed=closed,
+                  now=now.strftime("%H:%M"))
+
+@app.route("/orders/<int:id>/complete", methods=["POST"])
+def orders_complete(id):
+    conn = get_db()
+    if maquinas_orders.complete(conn, id, request.form.get("note", "").strip() or None):
         conn.commit()
-        tool = conn.execute("SELECT * FROM tools WHERE name=?", ('AutoImport',)).fetchone()
-    tool_id = tool['id']
-
-    # find likely column names and tool columns to read colors from
-    cols_upper = [str(c).upper() for c in df.columns]
-    codigo_col = None
-    denom_col = None
-    comments_col = None
-    machine_type_col = None
-    tool_names = ['VOSOA','RUTI','COR','ACEITE','VIB','TERMO','DES','DUREZA','EMD','VT / LP','PM','UT','ESPESOR']
-    tool_cols_idx = []
-    for i, cu in enumerate(cols_upper):
-      if 'CÓDIGO' in cu or 'CODIGO' in cu:
-        codigo_col = df.columns[i]
-      if 'DENOMIN' in cu:
-        denom_col = df.columns[i]
-      if 'TIPO' in cu or 'TIPO EQU' in cu:
-        machine_type_col = df.columns[i]
-      if 'COMENT' in cu or 'OBSERV' in cu:
-        comments_col = df.columns[i]
-      # detect tool columns
-      for tn in tool_names:
-        if tn in cu:
-          tool_cols_idx.append(i)
-          break
+        flash("Orden completada")
+    conn.close()
+    return redirect("/orders")
 
-    inserted = 0
-    # compute excel header row (1-based) and starting data row
-    excel_header_row = header + 1
-    data_start_row = excel_header_row + 1
-    for idx, row in df.iterrows():
-        name = None
-        code = None
-        notes = ''
-        try:
-            if denom_col:
-                name = str(row.get(denom_col, '')).strip()
-            if codigo_col and pd.notna(row.get(codigo_col)):
-                code = str(row.get(codigo_col)).strip()
-            if comments_col and pd.notna(row.get(comments_col)):
-                notes = str(row.get(comments_col)).strip()
-        except Exception:
-            continue
+@app.route("/api/orders")
+def api_orders():
+    # overdue and due-in-24h open orders, for wall displays
+    conn = get_db()
+    now = datetime.now()
+    payload = {"counts": maquinas_orders.counts(conn, now),
+               "overdue": [dict(o) for o in maquinas_orders.overdue(conn, now)],
+               "due_soon": [dict(o) for o in maquinas_orders.due_soon(conn, now)]}
+    conn.close()
+    return jsonify(payload)
 
-        if not name and not code:
-            continue
+PLAN_VIEW = """
+<div class="d-flex justify-content-between align-items-center mb-3">
+  <h3>Plan de inspecciones</h3>
+  {% if period %}<a class="btn btn-secondary" href="/plan">Atrás</a>{% endif %}
+</div>
+{% if period %}
+<h5>{{ plan }} · {{ block }} · {{ period }}</h5>
+<table class="table table-sm align-middle">
+  <thead><tr><th>Código HAC</th><th>Denominación</th><th>Máquina</th><th>Inspeccionada</th></tr></thead>
+  <tbody>
+  {% for it in items %}
+    <tr>
+      <td>{{ it.hac_code }}</td>
+      <td>{{ it.name or '' }}</td>
+      <td>{% if it.machine_id %}<a href="/machines/{{ it.machine_id }}" class="text-decoration-none">{{ it.machine_name }}</a>{% else %}<small class="text-muted">sin máquina con ese HAC</small>{% endif %}</td>
+      <td>{% if it.done_at %}<span class="badge bg-success">{{ it.done_at }}</span>{% else %}<span class="badge bg-danger">Pendiente</span>{% endif %}</td>
+    </tr>
+  {% endfor %}
+  </tbody>
+</table>
+{% elif rows %}
+<p class="text-muted">Una inspección planificada se cumple si la máquina tiene alguna medición dentro del período.</p>
+<table class="table table-sm align-middle">
+  <thead><tr><th>Plan</th><th>Bloque</th><th>Período</th><th>Planificadas</th><th>Realizadas</th><th>Cumplimiento</th><th>Sin máquina</th></tr></thead>
+  <tbody>
+  {% for r in rows %}
+    <tr>
+      <td>{{ r.plan }}</td>
+      <td>{{ r.block }}</td>
+      <td><a href="/plan?plan={{ r.plan|urlencode }}&block={{ r.block|urlencode }}&period={{ r.period }}" class="text-decoration-none">{{ r.period }}</a>{% if r.open %} <small class="text-muted">(en curso)</small>{% endif %}</td>
+      <td>{{ r.planned }}</td>
+      <td>{{ r.done }}</td>
+      <td><span class="badge {{ 'bg-success' if r.pct >= 90 else ('bg-warning text-dark' if r.pct >= 50 else 'bg-danger') }}">{{ r.pct }}%</span></td>
+      <td>{{ r.planned - r.matched }}</td>
+    </tr>
+  {% endfor %}
+  </tbody>
+</table>
+{% else %}
+<div class="alert alert-info">No hay plan cargado. Se importa junto con el Excel (hojas "Plan ...").</div>
+{% endif %}
+"""
 
-        # determine color from excel cell fills if possible
-        detected_color = None
-        detected_hex = None
-        # corresponding excel row number
-        excel_row_num = data_start_row + idx
-        # check all columns for cell fill colors (some headers are merged and show as Unnamed)
-        for col_idx in range(len(df.columns)):
-          try:
-            cell = ws.cell(row=excel_row_num, column=col_idx+1)
-            fg = None
-            if cell.fill and hasattr(cell.fill, 'fgColor'):
-              fg = cell.fill.fgColor.rgb or cell.fill.start_color.index
-            if fg:
-              # normalize hex like 'FF00FF00' or '00FF00'
-              hexv = str(fg)
-              if len(hexv) == 8 and hexv.startswith('FF'):
-                hex6 = hexv[2:]
-              elif len(hexv) >= 6:
-                hex6 = hexv[-6:]
-              else:
-                hex6 = None
-              if hex6:
-                try:
-                  r = int(hex6[0:2], 16)
-                  g = int(hex6[2:4], 16)
-                  b = int(hex6[4:6], 16)
-                except Exception:
-                  r,g,b = 0,0,0
-                # decide color by dominant channel and keep exact hex
-                hex_exact = hex6
-                # ignore pure white/black
-                if (r, g, b) in ((0,0,0),(255,255,255)):
-                  pass
-                elif r > 200 and g < 120 and b < 120:
-                  detected_color = 'red'
-                  detected_hex = hex_exact
-                  break
-                elif r > 200 and g > 150 and b < 150:
-                  detected_color = 'yellow'
-                  detected_hex = hex_exact
-                elif b > max(r,g) and b > 140:
-                  detected_color = 'blue'
-                  detected_hex = hex_exact
-                elif g > max(r,b) and g > 140:
-                  detected_color = 'green'
-                  detected_hex = hex_exact
-          except Exception:
-            continue
+@app.route("/plan")
+def plan_view():
+    plan = request.args.get("plan")
+    block = request.args.get("block")
+    period = request.args.get("period")
+    conn = get_db()
+    if period:
+        items = maquinas_plan.period_items(conn, plan, block, period)
+        conn.close()
+        return render(PLAN_VIEW, page_title="Plan", plan=plan, block=block, period=period, items=items)
+    rows = maquinas_plan.compliance(conn, plan, block)
+    conn.close()
+    return render(PLAN_VIEW, page_title="Plan", rows=rows, period=None)
 
-        # fallback to criteria-based score if no color detected
-        score, matches = score_row_by_criteria(row, criteria_map)
-        # scale to 0-10
-        if max_single > 0:
-          denom = max_single * 3
-          crit_val = int(round((score / denom) * 10)) if denom > 0 else 0
-        else:
-          crit_val = 0
-        crit_val = max(0, min(10, crit_val))
-
-        # map to priority 1-5
-        priority = 1 + (crit_val * 4 // 10)
-        # if detected_color, override priority with color mapping and record hex
-        if detected_color == 'red':
-          priority = 5
-        elif detected_color == 'yellow':
-          priority = 4
-        elif detected_color == 'blue':
-          priority = 3
-        elif detected_color == 'green':
-          priority = 1
-
-        # upsert machine by name or code
-        existing = None
-        if code:
-          existing = conn.execute("SELECT * FROM machines WHERE hac_code=? OR name LIKE ?", (code, f"%{code}%")).fetchone()
-        if not existing and name:
-            existing = conn.execute("SELECT * FROM machines WHERE name=?", (name,)).fetchone()
-
-        # determine machine_type value from the row if present
-        machine_type_val = None
-        try:
-          if machine_type_col and pd.notna(row.get(machine_type_col)):
-            machine_type_val = str(row.get(machine_type_col)).strip()
-        except Exception:
-          machine_type_val = None
-
-        if existing:
-          mid = existing['id']
-          # update priority/notes/color unconditionally to reflect Excel exactly
-          try:
-            conn.execute("UPDATE machines SET priority=?, notes=? WHERE id=?", (priority, (existing['notes'] or '') + ('\n' + notes if notes else ''), mid))
-            # update color and color_hex
-            if detected_color:
-              conn.execute("UPDATE machines SET color=?, color_hex=? WHERE id=?", (detected_color, detected_hex, mid))
-            else:
-              conn.execute("UPDATE machines SET color=?, color_hex=? WHERE id=?", (None, None, mid))
-            # update machine_type if available
-            if machine_type_val:
-              conn.execute("UPDATE machines SET machine_type=? WHERE id=?", (machine_type_val, mid))
-            # update hac_code if present
-            if code:
-              conn.execute("UPDATE machines SET hac_code=? WHERE id=?", (code, mid))
-          except Exception:
-            pass
-        else:
-          # insert
-          name_to_insert = name or code
-          cur = conn.execute("INSERT INTO machines (name, notes, priority, machine_group, color, color_hex, machine_type, hac_code) VALUES (?,?,?,?,?,?,?,?)", (name_to_insert, notes, priority, 1, detected_color, detected_hex, machine_type_val, code))
-          mid = cur.lastrowid
+MATCH_REVIEWS = """
+<div class="d-flex justify-content-between align-items-center mb-3">
+  <h3>Asociaciones dudosas</h3>
+</div>
+<p class="text-muted">Filas del Excel cuya máquina no se pudo decidir (código HAC nuevo y denominación parecida a otra). No se importaron; la elección queda guardada para las próximas importaciones.</p>
+{% if reviews %}
+<table class="table table-sm align-middle">
+  <thead><tr><th>Fila</th><th>Código HAC</th><th>Denominación</th><th>Candidatas</th></tr></thead>
+  <tbody>
+  {% for r in reviews %}
+    <tr>
+      <td>{{ r.source_row or '' }}</td>
+      <td>{{ r.hac_code or '' }}</td>
+      <td>{{ r.name or '' }}</td>
+      <td>
+        <form method="post" action="/match/reviews/{{ r.id }}" class="d-flex flex-wrap gap-2">
+          {% for c in r.candidates %}
+          <button class="btn btn-sm btn-outline-primary" name="machine_id" value="{{ c.id }}">{{ c.name }}{% if c.hac_code %} · {{ c.hac_code }}{% endif %} <span class="badge bg-secondary">{{ '%.0f'|format(c.score * 100) }}%</span></button>
+          {% endfor %}
+          <button class="btn btn-sm btn-outline-success" name="machine_id" value="">Máquina nueva</button>
+        </form>
+      </td>
+    </tr>
+  {% endfor %}
+  </tbody>
+</table>
+{% else %}
+<div class="alert alert-success">No hay filas pendientes de revisión.</div>
+{% endif %}
+"""
 
-        # insert a measurement marking the computed criticity
-        date = datetime.now().strftime("%Y-%m-%d %H:%M")
-        matches_note = ';'.join([f"{m[0]}:{m[1]}" for m in matches])
-        try:
-          conn.execute("INSERT INTO measurements (machine_id, tool_id, date, criticality, note) VALUES (?,?,?,?,?)", (mid, tool_id, date, crit_val, matches_note))
-          inserted += 1
-        except Exception:
-          pass
+@app.route("/match/reviews")
+def match_reviews():
+    conn = get_db()
+    reviews = maquinas_match.pending_reviews(conn)
+    conn.close()
+    return render(MATCH_REVIEWS, page_title="Asociaciones", reviews=reviews)
 
-    conn.commit()
+@app.route("/match/reviews/<int:id>", methods=["POST"])
+def match_resolve(id):
+    machine_id = request.form.get("machine_id") or None
+    conn = get_db()
+    if maquinas_match.resolve(conn, id, int(machine_id) if machine_id else None):
+        conn.commit()
+        flash("Asociación guardada: se aplica en la próxima importación")
     conn.close()
-    return f"Import completado. {inserted} mediciones creadas.", 200
+    return redirect("/match/reviews")
+
+@app.route("/alerts/refresh")
+def alerts_refresh():
+    conn = get_db()
+    opened, closed = maquinas_analytics.run_detection(conn)
+    conn.close()
+    flash(f"Alertas recalculadas: {opened} nuevas, {closed} cerradas")
+    return redirect("/alerts")
+
+
+@app.route("/api/forecasts")
+def api_forecasts():
+    machine_id = request.args.get("machine_id", type=int)
+    tool_id = request.args.get("tool_id", type=int)
+    sort = request.args.get("sort", "red")
+    limit = min(request.args.get("limit", 500, type=int), 5000)
+    conn = get_db()
+    rows = maquinas_forecast.list_forecasts(conn, machine_id, tool_id, sort, limit)
+    conn.close()
+    return jsonify([dict(r) for r in rows])
+
+@app.route("/api/machines/<int:id>/events")
+def api_machine_events(id):
+    # audit trail: every change to the machine and its measurements, newest first
+    limit = min(request.args.get("limit", 200, type=int), 5000)
+    before = request.args.get("before", type=int)
+    conn = get_db()
+    events = maquinas_events.history(conn, id, limit, before)
+    conn.close()
+    return jsonify(events)
+
+@app.route("/api/state")
+def api_state():
+    # fleet as it was at ?at=YYYY-MM-DD[ HH:MM[:SS]] (a bare date means end of that day)
+    at = request.args.get("at", "").strip()
+    if not at:
+        return jsonify({"error": "falta el parámetro at"}), 400
+    if len(at) == 10:
+        at += " 23:59:59"
+    conn = get_db()
+    state = maquinas_events.state_at(conn, at)
+    conn.close()
+    return jsonify(state)
+
+@app.route("/api/jobs")
+def api_jobs():
+    # schedule, lock holder and run-duration metrics per job; ?job=<name> adds its recent runs
+    conn = get_db()
+    payload = {"jobs": maquinas_jobs.status(conn)}
+    name = request.args.get("job")
+    if name:
+        payload["runs"] = [dict(r) for r in maquinas_jobs.runs(conn, name, min(request.args.get("limit", 50, type=int), 200))]
+    conn.close()
+    return jsonify(payload)
+
+@app.route("/api/jobs/<name>/run", methods=["POST"])
+def api_jobs_run(name):
+    # only marks the job due; a worker's scheduler runs it off the request path
+    conn = get_db()
+    ok = maquinas_jobs.run_now(conn, name)
+    conn.close()
+    if not ok:
+        return jsonify({"error": "tarea desconocida o desactivada"}), 404
+    return jsonify({"job": name, "queued": True}), 202
+
+def sync_response(payload):
+    # tablets on a weak signal: gzip the body when the client accepts it
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode()
+    resp = Response(body, mimetype="application/json")
+    if request.accept_encodings['gzip'] and len(body) > 1024:
+        resp.set_data(gzip.compress(body, 6))
+        resp.headers['Content-Encoding'] = 'gzip'
+    resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
+
+@app.route("/api/sync/pull")
+def api_sync_pull():
+    # ?since=<token from the previous pull>; 0 / missing = full download
+    since = request.args.get("since", 0, type=int)
+    conn = get_db()
+    delta = maquinas_sync.pull(conn, since)
+    conn.close()
+    delta['site'] = current_site()
+    return sync_response(delta)
+
+@app.route("/api/sync/push", methods=["POST"])
+def api_sync_push():
+    # {"device_id": "...", "measurements": [{"client_id", "machine_id", "tool_id", "date", "criticality"|"severity", "note"}]}
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get("measurements"), list):
+        return jsonify({"error": "se espera {device_id, measurements: [...]}"}), 400
+    if not all(isinstance(item, dict) for item in payload["measurements"]):
+        return jsonify({"error": "cada medición debe ser un objeto"}), 400
+    device = str(payload.get("device_id") or "").strip()[:64]
+    conn = get_db()
+    try:
+        results, touched = maquinas_sync.push_measurements(conn, payload["measurements"], source=f"sync:{device}" if device else 'sync')
+    except ValueError as e:
+        conn.close()
+        return jsonify({"error": str(e)}), 413
+    if touched:
+        measurements_written(conn, touched)
+    else:
+        conn.commit()
+    conn.close()
+    # no token here: the next pull must still bring other devices' changes
+    return sync_response({'site': current_site(), 'results': results})
+
+# ---- Importar desde Excel (reglas en hoja 'Criterios') ----
+@app.route('/import_excel', methods=['GET'])
+def import_excel():
+    # tracked so a graceful shutdown waits for the import to commit
+    begin_import()
+    try:
+        return _import_excel()
+    finally:
+        end_import()
+
+
+def _import_excel():
+    # Ruta para importar el Excel según reglas de la hoja 'Criterios'
+    excel_path = maquinas_import.DEFAULT_EXCEL
+    if not os.path.exists(excel_path):
+        return f"Archivo no encontrado: {excel_path}", 404
+    conn = get_db()
+    try:
+        result = maquinas_import.import_excel(conn, excel_path)
+    except ValueError as e:
+        return str(e), 500
+    finally:
+        conn.close()
+    for warning in result['warnings']:
+        flash(warning)
+    return (f"Import completado. {result['inserted']} mediciones creadas, {result['planned']} inspecciones planificadas, "
+            f"{result['review']} filas para revisar.", 200)
 
 if __name__ == "__main__":
+    # development server only; use maquinas_server.py for production
     print("🚀 Monitor de Condición")
     print("➜ http://127.0.0.1:5000")
     app.run(debug=True)
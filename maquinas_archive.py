@@ -0,0 +1,218 @@
+"""
+Archivo histórico de mediciones
+- Mueve mediciones más antiguas que el horizonte a un SQLite por año (archive/<base>_measurements_<año>.db)
+- La base principal conserva los datos recientes y la última medición de cada máquina/herramienta
+- Los archivos se adjuntan con ATTACH solo cuando el rango pedido los necesita
+
+Uso:
+    python maquinas_archive.py [machines.db] [--days 730]
+"""
+
+import argparse
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+ARCHIVE_HORIZON_DAYS = int(os.environ.get("MAQUINAS_ARCHIVE_DAYS", "730"))
+# SQLite attaches at most 10 databases per connection by default; keep headroom
+MAX_ATTACH = 8
+
+HISTORY_COLUMNS = "m.id, m.machine_id, m.tool_id, m.date, m.criticality, m.note, m.severity, m.repair_time"
+
+
+def ensure_catalog(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS measurement_archives (
+        year TEXT PRIMARY KEY,
+        path TEXT NOT NULL,
+        min_date TEXT,
+        max_date TEXT,
+        row_count INTEGER DEFAULT 0
+    )""")
+
+
+def db_path(conn):
+    for row in conn.execute("PRAGMA database_list"):
+        if row[1] == "main":
+            return row[2]
+    return ""
+
+
+def archive_dir(conn):
+    default = os.path.join(os.path.dirname(os.path.abspath(db_path(conn))), "archive")
+    return os.environ.get("MAQUINAS_ARCHIVE_DIR", default)
+
+
+def archive_path(conn, year):
+    base = os.path.splitext(os.path.basename(db_path(conn)))[0] or "machines"
+    return os.path.join(archive_dir(conn), f"{base}_measurements_{year}.db")
+
+
+def archive_years(conn, since=None, until=None):
+    # catalog lookup only: years whose date span overlaps [since, until]
+    ensure_catalog(conn)
+    query = "SELECT year, path FROM measurement_archives WHERE 1=1"
+    params = []
+    if since:
+        query += " AND max_date >= ?"
+        params.append(since)
+    if until:
+        query += " AND min_date <= ?"
+        params.append(until)
+    query += " ORDER BY year"
+    return [(r[0], r[1]) for r in conn.execute(query, params).fetchall()]
+
+
+@contextmanager
+def attached(conn, years):
+    # ATTACH/DETACH are not allowed inside a transaction; committing here would
+    # publish the caller's half-done writes, so callers attach before writing
+    if conn.in_transaction:
+        raise RuntimeError("attached() con una transacción abierta: leer los archivos antes de escribir")
+    schemas = []
+    try:
+        for year, path in years:
+            schema = f"arch_{year}"
+            conn.execute("ATTACH DATABASE ? AS " + schema, (path,))
+            schemas.append(schema)
+        yield schemas
+    finally:
+        conn.commit()
+        for schema in schemas:
+            conn.execute("DETACH DATABASE " + schema)
+
+
+def _ensure_archive_table(conn, schema):
+    sql = conn.execute("SELECT sql FROM main.sqlite_master WHERE type='table' AND name='measurements'").fetchone()[0]
+    conn.execute(sql.replace("CREATE TABLE measurements", f"CREATE TABLE IF NOT EXISTS {schema}.measurements", 1))
+    # hot table may have gained columns since this archive was created
+    hot_cols = [r[1] for r in conn.execute("PRAGMA main.table_info(measurements)")]
+    arch_cols = {r[1] for r in conn.execute(f"PRAGMA {schema}.table_info(measurements)")}
+    for col in hot_cols:
+        if col not in arch_cols:
+            conn.execute(f"ALTER TABLE {schema}.measurements ADD COLUMN {col}")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_measurements_machine_date ON measurements(machine_id, date)")
+    return hot_cols
+
+
+def archive_measurements(conn, horizon_days=None, now=None):
+    # the latest measurement of every machine/tool pair stays in the hot table so
+    # current-status queries never touch the archives; returns rows moved per year
+    ensure_catalog(conn)
+    horizon_days = ARCHIVE_HORIZON_DAYS if horizon_days is None else horizon_days
+    cutoff = ((now or datetime.now()) - timedelta(days=horizon_days)).strftime("%Y-%m-%d %H:%M")
+
+    conn.execute("DROP TABLE IF EXISTS temp._archive_ids")
+    conn.execute("CREATE TEMP TABLE _archive_ids (id INTEGER PRIMARY KEY, year TEXT)")
+    conn.execute("""
+        INSERT INTO temp._archive_ids (id, year)
+        SELECT id, substr(date, 1, 4) FROM (
+            SELECT id, date, ROW_NUMBER() OVER (
+                PARTITION BY machine_id, tool_id ORDER BY date DESC, id DESC) AS rn
+            FROM measurements
+            WHERE date IS NOT NULL
+        ) WHERE rn > 1 AND date < ?
+    """, (cutoff,))
+    years = [r[0] for r in conn.execute("SELECT DISTINCT year FROM temp._archive_ids ORDER BY year")]
+    conn.commit()
+    os.makedirs(archive_dir(conn), exist_ok=True)
+
+    moved = {}
+    for year in years:
+        path = archive_path(conn, year)
+        with attached(conn, [(year, path)]) as (schema,):
+            cols = ", ".join(_ensure_archive_table(conn, schema))
+            # ids are preserved, so re-running after a crash between the two
+            # statements just skips rows that already made it to the archive
+            conn.execute(f"""
+                INSERT OR IGNORE INTO {schema}.measurements ({cols})
+                SELECT {cols} FROM main.measurements
+                WHERE id IN (SELECT id FROM temp._archive_ids WHERE year=?)
+            """, (year,))
+            cur = conn.execute("DELETE FROM main.measurements WHERE id IN (SELECT id FROM temp._archive_ids WHERE year=?)", (year,))
+            moved[year] = cur.rowcount
+            span = conn.execute(f"SELECT MIN(date), MAX(date), COUNT(*) FROM {schema}.measurements").fetchone()
+            conn.execute("""
+                INSERT INTO measurement_archives (year, path, min_date, max_date, row_count) VALUES (?,?,?,?,?)
+                ON CONFLICT(year) DO UPDATE SET path=excluded.path, min_date=excluded.min_date,
+                    max_date=excluded.max_date, row_count=excluded.row_count
+            """, (year, path, span[0], span[1], span[2]))
+    conn.execute("DROP TABLE IF EXISTS temp._archive_ids")
+    conn.commit()
+    return moved
+
+
+def machine_history(conn, machine_id, since=None, until=None):
+    # hot rows first; archives are attached only if their span overlaps the range
+    where = "m.machine_id = ?"
+    params = [machine_id]
+    if since:
+        where += " AND m.date >= ?"
+        params.append(since)
+    if until:
+        where += " AND m.date <= ?"
+        params.append(until)
+
+    select = f"SELECT {HISTORY_COLUMNS}, t.name as tool FROM {{schema}}.measurements m JOIN main.tools t ON t.id = m.tool_id WHERE {where}"
+    rows = conn.execute(select.format(schema="main") + " ORDER BY m.date DESC", params).fetchall()
+
+    years = archive_years(conn, since, until)
+    for i in range(0, len(years), MAX_ATTACH):
+        with attached(conn, years[i:i + MAX_ATTACH]) as schemas:
+            query = " UNION ALL ".join(select.format(schema=s) for s in schemas)
+            rows.extend(conn.execute(query, params * len(schemas)).fetchall())
+    if years:
+        rows.sort(key=lambda r: r["date"] or "", reverse=True)
+    return rows
+
+
+def iter_archived(conn, where="1=1", params=(), columns=HISTORY_COLUMNS, chunk_size=1000):
+    # yields archived rows year by year, oldest first, without loading a year at once
+    for year, path in archive_years(conn):
+        with attached(conn, [(year, path)]) as (schema,):
+            cur = conn.execute(f"SELECT {columns} FROM {schema}.measurements m WHERE {where} ORDER BY m.date", params)
+            while True:
+                batch = cur.fetchmany(chunk_size)
+                if not batch:
+                    break
+                yield from batch
+
+
+def delete_archived(conn, machine_id=None, tool_id=None, measurement_id=None):
+    # cascade a delete into every archive file; for a single measurement returns
+    # the machine it belonged to if it was found in an archive
+    if machine_id is not None:
+        where, params = "machine_id=?", (machine_id,)
+    elif tool_id is not None:
+        where, params = "tool_id=?", (tool_id,)
+    else:
+        where, params = "id=?", (measurement_id,)
+
+    found = None
+    for year, path in archive_years(conn):
+        with attached(conn, [(year, path)]) as (schema,):
+            if measurement_id is not None and found is None:
+                row = conn.execute(f"SELECT machine_id FROM {schema}.measurements WHERE id=?", (measurement_id,)).fetchone()
+                if row:
+                    found = row[0]
+            conn.execute(f"DELETE FROM {schema}.measurements WHERE {where}", params)
+            span = conn.execute(f"SELECT MIN(date), MAX(date), COUNT(*) FROM {schema}.measurements").fetchone()
+            conn.execute("UPDATE measurement_archives SET min_date=?, max_date=?, row_count=? WHERE year=?",
+                         (span[0], span[1], span[2], year))
+    conn.commit()
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archivar mediciones antiguas por año")
+    parser.add_argument("db", nargs="?", default="machines.db")
+    parser.add_argument("--days", type=int, default=ARCHIVE_HORIZON_DAYS, help="horizonte en días que queda en la base principal")
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.db)
+    conn.row_factory = sqlite3.Row
+    moved = archive_measurements(conn, args.days)
+    conn.close()
+    for year, count in sorted(moved.items()):
+        print(f"✓ {year}: {count} mediciones archivadas")
+    print(f"Archivado completado ({sum(moved.values())} mediciones)")
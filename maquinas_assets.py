@@ -0,0 +1,259 @@
+"""
+Jerarquía de activos: planta → AREA → tipo de equipo → máquina
+- nodos con ruta materializada (asset_nodes.path), armados a partir de machines.area / machine_type
+- agregados por subárbol precalculados en asset_rollups (peor criticidad, conteo por color, vencidas)
+- los agregados se recalculan solo en la rama de las máquinas que cambiaron
+"""
+
+import os
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+import maquinas_archive
+import maquinas_sites
+
+PLANT_NAME = os.environ.get("MAQUINAS_PLANT", "Planta")
+# same interval the PDF report uses for overdue inspections
+INSPECTION_DAYS = int(os.environ.get("MAQUINAS_INSPECTION_DAYS", "365"))
+NO_AREA = "Sin área"
+NO_TYPE = "Sin tipo"
+KIND_LABELS = {'plant': 'Planta', 'area': 'Área', 'type': 'Tipo de equipo', 'machine': 'Máquina'}
+COLORS = ('red', 'yellow', 'blue', 'green')
+# SQLite's default limit on bound parameters is 999; leaf queries bind the ids twice
+_ID_CHUNK = 400
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS asset_nodes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        parent_id INTEGER,
+        kind TEXT NOT NULL,
+        name TEXT NOT NULL,
+        path TEXT NOT NULL UNIQUE,
+        depth INTEGER NOT NULL,
+        machine_id INTEGER UNIQUE
+    );
+    CREATE INDEX IF NOT EXISTS idx_asset_nodes_parent ON asset_nodes(parent_id);
+    CREATE TABLE IF NOT EXISTS asset_rollups (
+        node_id INTEGER PRIMARY KEY,
+        machines INTEGER NOT NULL DEFAULT 0,
+        worst_crit INTEGER,
+        red INTEGER NOT NULL DEFAULT 0,
+        yellow INTEGER NOT NULL DEFAULT 0,
+        blue INTEGER NOT NULL DEFAULT 0,
+        green INTEGER NOT NULL DEFAULT 0,
+        overdue INTEGER NOT NULL DEFAULT 0,
+        last_date TEXT,
+        updated_at TEXT
+    );
+    """)
+
+
+def _segment(kind, key):
+    # quoted so names with '/' can't break the path
+    return f"{kind}:{quote(str(key), safe='')}/"
+
+
+def crit_color(crit):
+    # same thresholds as the home page
+    if crit is None:
+        return 'green'
+    if crit >= 8:
+        return 'red'
+    if crit >= 5:
+        return 'yellow'
+    if crit >= 3:
+        return 'blue'
+    return 'green'
+
+
+def plant_name(conn):
+    # one database per plant: the root is named after its site
+    if len(maquinas_sites.SITES) > 1:
+        return maquinas_sites.site_for_path(maquinas_archive.db_path(conn)) or PLANT_NAME
+    return PLANT_NAME
+
+
+def sync_tree(conn):
+    # rebuild the node set from machines; existing nodes keep their ids
+    wanted = {}
+    root = plant_name(conn)
+    plant = '/' + _segment('plant', root)
+    wanted[plant] = (None, 'plant', root, 0, None)
+    for mid, name, area, mtype in conn.execute("SELECT id, name, area, machine_type FROM machines"):
+        area = (area or '').strip() or NO_AREA
+        mtype = (mtype or '').strip() or NO_TYPE
+        area_path = plant + _segment('area', area)
+        type_path = area_path + _segment('type', mtype)
+        wanted.setdefault(area_path, (plant, 'area', area, 1, None))
+        wanted.setdefault(type_path, (area_path, 'type', mtype, 2, None))
+        wanted[type_path + _segment('m', mid)] = (type_path, 'machine', name, 3, mid)
+
+    existing = {path: (nid, name) for nid, path, name in conn.execute("SELECT id, path, name FROM asset_nodes")}
+    stale = [existing[p][0] for p in existing if p not in wanted]
+    for i in range(0, len(stale), _ID_CHUNK):
+        chunk = stale[i:i + _ID_CHUNK]
+        marks = ','.join('?' * len(chunk))
+        conn.execute(f"DELETE FROM asset_rollups WHERE node_id IN ({marks})", chunk)
+        conn.execute(f"DELETE FROM asset_nodes WHERE id IN ({marks})", chunk)
+
+    ids = {p: v[0] for p, v in existing.items() if p in wanted}
+    # parents before children
+    for path, (parent, kind, name, depth, mid) in sorted(wanted.items(), key=lambda kv: kv[1][3]):
+        if path in ids:
+            if existing[path][1] != name:
+                conn.execute("UPDATE asset_nodes SET name=? WHERE id=?", (name, ids[path]))
+            continue
+        cur = conn.execute("INSERT INTO asset_nodes (parent_id, kind, name, path, depth, machine_id) VALUES (?,?,?,?,?,?)",
+                           (ids.get(parent), kind, name, path, depth, mid))
+        ids[path] = cur.lastrowid
+    return len(wanted)
+
+
+def _leaf_rows(conn, machine_ids=None):
+    # per machine: worst of the latest criticality of each tool, last inspection, color
+    inner, outer, params = "", "", []
+    if machine_ids is not None:
+        marks = ','.join('?' * len(machine_ids))
+        inner = f"WHERE machine_id IN ({marks})"
+        outer = f"AND n.machine_id IN ({marks})"
+        params = list(machine_ids) * 2
+    return conn.execute(f"""
+        SELECT n.id AS node_id, n.machine_id, mac.color, s.worst, s.last_date
+        FROM asset_nodes n
+        JOIN machines mac ON mac.id = n.machine_id
+        LEFT JOIN (
+            SELECT machine_id,
+                   MAX(CASE WHEN rn = 1 AND criticality IS NOT NULL THEN criticality END) AS worst,
+                   MAX(date) AS last_date
+            FROM (SELECT machine_id, criticality, date,
+                         ROW_NUMBER() OVER (PARTITION BY machine_id, tool_id, criticality IS NULL ORDER BY date DESC, id DESC) AS rn
+                  FROM measurements {inner})
+            GROUP BY machine_id
+        ) s ON s.machine_id = n.machine_id
+        WHERE n.kind = 'machine' {outer}
+    """, params).fetchall()
+
+
+def _write_leaves(conn, rows, now):
+    cutoff = (datetime.now() - timedelta(days=INSPECTION_DAYS)).strftime("%Y-%m-%d %H:%M")
+    out = []
+    for node_id, _, color, worst, last_date in rows:
+        color = color if color in COLORS else crit_color(worst)
+        overdue = 1 if not last_date or last_date < cutoff else 0
+        out.append((node_id, 1, worst, *[1 if color == c else 0 for c in COLORS], overdue, last_date, now))
+    conn.executemany("INSERT OR REPLACE INTO asset_rollups (node_id, machines, worst_crit, red, yellow, blue, green, overdue, last_date, updated_at) "
+                     "VALUES (?,?,?,?,?,?,?,?,?,?)", out)
+
+
+def _roll_up(conn, depth, node_ids, now):
+    # internal nodes = sum / max over their children's rollups
+    if node_ids is None:
+        chunks = [None]
+    else:
+        chunks = [node_ids[i:i + _ID_CHUNK] for i in range(0, len(node_ids), _ID_CHUNK)]
+    for chunk in chunks:
+        _roll_up_chunk(conn, depth, chunk, now)
+
+
+def _roll_up_chunk(conn, depth, node_ids, now):
+    filt, params = "", [now, depth]
+    if node_ids is not None:
+        filt = f"AND n.id IN ({','.join('?' * len(node_ids))})"
+        params += list(node_ids)
+    conn.execute(f"""
+        INSERT OR REPLACE INTO asset_rollups (node_id, machines, worst_crit, red, yellow, blue, green, overdue, last_date, updated_at)
+        SELECT n.id, COALESCE(SUM(r.machines), 0), MAX(r.worst_crit),
+               COALESCE(SUM(r.red), 0), COALESCE(SUM(r.yellow), 0), COALESCE(SUM(r.blue), 0), COALESCE(SUM(r.green), 0),
+               COALESCE(SUM(r.overdue), 0), MAX(r.last_date), ?
+        FROM asset_nodes n
+        LEFT JOIN asset_nodes c ON c.parent_id = n.id
+        LEFT JOIN asset_rollups r ON r.node_id = c.id
+        WHERE n.depth = ? {filt}
+        GROUP BY n.id
+    """, params)
+
+
+def _ancestor_paths(conn, machine_ids):
+    ids = list({int(m) for m in machine_ids})
+    ancestors = set()
+    for i in range(0, len(ids), _ID_CHUNK):
+        chunk = ids[i:i + _ID_CHUNK]
+        for (path,) in conn.execute(f"SELECT path FROM asset_nodes WHERE machine_id IN ({','.join('?' * len(chunk))})", chunk):
+            parts = path.strip('/').split('/')
+            ancestors.update('/' + '/'.join(parts[:k]) + '/' for k in range(1, len(parts)))
+    return ancestors
+
+
+def refresh_rollups(conn, machine_ids=None, ancestors=()):
+    # None = whole plant (after imports / nightly, so "overdue" ages); otherwise
+    # only the touched machines and their ancestors are recomputed, plus any
+    # `ancestors` paths they hung from before an edit
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    if machine_ids is None:
+        _write_leaves(conn, _leaf_rows(conn), now)
+        for depth in (2, 1, 0):
+            _roll_up(conn, depth, None, now)
+        return
+
+    ids = list({int(m) for m in machine_ids})
+    for i in range(0, len(ids), _ID_CHUNK):
+        _write_leaves(conn, _leaf_rows(conn, ids[i:i + _ID_CHUNK]), now)
+    paths = list(_ancestor_paths(conn, ids) | set(ancestors))
+    if not paths:
+        return
+    by_depth = {}
+    for i in range(0, len(paths), _ID_CHUNK):
+        chunk = paths[i:i + _ID_CHUNK]
+        for nid, depth in conn.execute(f"SELECT id, depth FROM asset_nodes WHERE path IN ({','.join('?' * len(chunk))})", chunk):
+            by_depth.setdefault(depth, []).append(nid)
+    for depth in (2, 1, 0):
+        if by_depth.get(depth):
+            _roll_up(conn, depth, by_depth[depth], now)
+
+
+def sync(conn, machine_ids=None):
+    # machine added/edited/deleted or import: node set first, then aggregates;
+    # the old ancestors of an edited or deleted machine are read before the tree changes
+    before = _ancestor_paths(conn, machine_ids) if machine_ids is not None else ()
+    sync_tree(conn)
+    refresh_rollups(conn, machine_ids, before)
+
+
+def root_node(conn):
+    return conn.execute("SELECT id FROM asset_nodes WHERE depth = 0 ORDER BY id LIMIT 1").fetchone()
+
+
+def node_view(conn, node_id):
+    # what the drill-down page needs: node + rollup, breadcrumbs, children + rollups
+    node = conn.execute("""
+        SELECT n.*, r.machines, r.worst_crit, r.red, r.yellow, r.blue, r.green, r.overdue, r.last_date
+        FROM asset_nodes n LEFT JOIN asset_rollups r ON r.node_id = n.id WHERE n.id = ?
+    """, (node_id,)).fetchone()
+    if not node:
+        return None, [], []
+    parts = node['path'].strip('/').split('/')
+    crumbs_paths = ['/' + '/'.join(parts[:k]) + '/' for k in range(1, len(parts))]
+    crumbs = []
+    if crumbs_paths:
+        crumbs = conn.execute(f"SELECT id, name, kind FROM asset_nodes WHERE path IN ({','.join('?' * len(crumbs_paths))}) ORDER BY depth",
+                              crumbs_paths).fetchall()
+    children = conn.execute("""
+        SELECT n.id, n.kind, n.name, n.machine_id, mac.hac_code, mac.color_hex,
+               r.machines, r.worst_crit, r.red, r.yellow, r.blue, r.green, r.overdue, r.last_date
+        FROM asset_nodes n
+        LEFT JOIN asset_rollups r ON r.node_id = n.id
+        LEFT JOIN machines mac ON mac.id = n.machine_id
+        WHERE n.parent_id = ?
+        ORDER BY COALESCE(r.worst_crit, -1) DESC, r.overdue DESC, n.name
+    """, (node_id,)).fetchall()
+    return node, crumbs, children
+
+
+def subtree_filter_sql(column="id"):
+    # machines under a node, for WHERE clauses (home page / exports drill-down);
+    # descendants sort in [path, path with its last '/' bumped to '0'): one range scan on the path index
+    return (f"{column} IN (SELECT c.machine_id FROM asset_nodes p JOIN asset_nodes c "
+            f"ON c.path >= p.path AND c.path < substr(p.path, 1, length(p.path) - 1) || '0' "
+            f"WHERE p.id = ? AND c.machine_id IS NOT NULL)")
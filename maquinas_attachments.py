@@ -0,0 +1,309 @@
+"""
+Adjuntos de mediciones (fotos, termografías, PDF de VT / LP)
+- almacenados por contenido: el nombre del archivo es su sha256, así una misma foto subida dos veces ocupa un solo archivo
+- repartidos en subdirectorios (ab/cd/<sha256>) para no tener miles de archivos en una sola carpeta
+- miniaturas JPEG generadas en segundo plano por un pool de procesos (requiere Pillow; sin Pillow se muestra un ícono)
+- un store por base de datos, así la limpieza de una planta no borra archivos de otra
+- la limpieza respeta un período de gracia: no borra un archivo recién subido o reusado cuya fila todavía
+  no se confirmó; la tarea nocturna también barre los archivos que quedaron sin fila (rollback, caída)
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import maquinas_archive
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+MAX_BYTES = int(os.environ.get("MAQUINAS_ATTACHMENT_MAX_MB", "25")) * 1024 * 1024
+THUMB_SIZE = (320, 240)
+THUMB_WORKERS = int(os.environ.get("MAQUINAS_THUMB_WORKERS", "2"))
+# content never changes under a given attachment id, so browsers may keep it for a year
+CACHE_SECONDS = 365 * 24 * 3600
+_CHUNK = 1024 * 1024
+# an upload writes (or reuses) the file before its row commits; gc leaves anything this recent alone
+GC_GRACE_SECONDS = int(os.environ.get("MAQUINAS_ATTACHMENT_GC_GRACE", "3600"))
+# leading bytes -> type; the extension the client sends is not trusted
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"BM", "image/bmp"),
+    (b"%PDF-", "application/pdf"),
+)
+THUMB_TYPES = {"image/jpeg", "image/png", "image/gif", "image/tiff", "image/bmp", "image/webp"}
+PLACEHOLDER_SVG = ('<svg xmlns="http://www.w3.org/2000/svg" width="160" height="120" viewBox="0 0 160 120">'
+                   '<rect width="160" height="120" rx="6" fill="#e9ecef"/>'
+                   '<text x="80" y="68" font-family="sans-serif" font-size="20" fill="#6c757d" text-anchor="middle">{label}</text></svg>')
+
+_pool = None
+_pool_lock = threading.Lock()
+_pending = set()
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS attachment_blobs (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mime TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS attachments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        measurement_id INTEGER NOT NULL,
+        machine_id INTEGER NOT NULL,
+        tool_id INTEGER,
+        sha256 TEXT NOT NULL,
+        filename TEXT,
+        created_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_attachments_measurement ON attachments(measurement_id);
+    CREATE INDEX IF NOT EXISTS idx_attachments_machine ON attachments(machine_id, id);
+    CREATE INDEX IF NOT EXISTS idx_attachments_sha ON attachments(sha256);
+    """)
+
+
+def sniff(head):
+    for sig, mime in _SIGNATURES:
+        if head.startswith(sig):
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def store_dir(conn):
+    base = os.path.splitext(os.path.basename(maquinas_archive.db_path(conn)))[0] or "machines"
+    default = os.path.join(os.path.dirname(os.path.abspath(maquinas_archive.db_path(conn))), "attachments")
+    return os.path.join(os.environ.get("MAQUINAS_ATTACHMENTS_DIR", default), base)
+
+
+def blob_path(root, sha):
+    return os.path.join(root, "blobs", sha[:2], sha[2:4], sha)
+
+
+def thumb_path(root, sha):
+    return os.path.join(root, "thumbs", sha[:2], sha + ".jpg")
+
+
+def store_stream(root, stream):
+    # hash while copying to a temp file in the same filesystem, then rename into place
+    tmp_dir = os.path.join(root, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size, mime = 0, None
+    fd, tmp = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = stream.read(_CHUNK)
+                if not chunk:
+                    break
+                if mime is None:
+                    mime = sniff(chunk[:16])
+                    if mime is None:
+                        raise ValueError("tipo de archivo no admitido (solo imágenes y PDF)")
+                size += len(chunk)
+                if size > MAX_BYTES:
+                    raise ValueError(f"archivo mayor a {MAX_BYTES // (1024 * 1024)} MB")
+                digest.update(chunk)
+                out.write(chunk)
+        if size == 0:
+            raise ValueError("archivo vacío")
+        sha = digest.hexdigest()
+        dest = blob_path(root, sha)
+        try:
+            # reusing a file: a fresh mtime keeps gc off it until our row commits
+            os.utime(dest)
+            os.remove(tmp)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(tmp, dest)
+        return sha, size, mime
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def attach(conn, measurement_id, stream, filename=None):
+    # -> (attachment id, sha256, mime); the caller commits and then calls schedule_thumbnail
+    m = conn.execute("SELECT machine_id, tool_id FROM measurements WHERE id=?", (measurement_id,)).fetchone()
+    if m is None:
+        raise ValueError("medición inexistente")
+    sha, size, mime = store_stream(store_dir(conn), stream)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute("""
+        INSERT INTO attachment_blobs (sha256, size, mime, created_at) VALUES (?,?,?,?)
+        ON CONFLICT (sha256) DO UPDATE SET created_at=excluded.created_at
+    """, (sha, size, mime, now))
+    cur = conn.execute("INSERT INTO attachments (measurement_id, machine_id, tool_id, sha256, filename, created_at) VALUES (?,?,?,?,?,?)",
+                       (measurement_id, m[0], m[1], sha, os.path.basename(filename or "") or None, now))
+    return cur.lastrowid, sha, mime
+
+
+def get(conn, attachment_id):
+    return conn.execute("""
+        SELECT a.id, a.measurement_id, a.machine_id, a.sha256, a.filename, b.mime, b.size
+        FROM attachments a JOIN attachment_blobs b ON b.sha256 = a.sha256
+        WHERE a.id = ?
+    """, (attachment_id,)).fetchone()
+
+
+def for_machine(conn, machine_id):
+    # newest first; only ids and names, the page pulls thumbnails lazily
+    return conn.execute("""
+        SELECT a.id, a.measurement_id, a.filename, a.created_at, b.mime, b.size, t.name AS tool
+        FROM attachments a
+        JOIN attachment_blobs b ON b.sha256 = a.sha256
+        LEFT JOIN tools t ON t.id = a.tool_id
+        WHERE a.machine_id = ?
+        ORDER BY a.id DESC
+    """, (machine_id,)).fetchall()
+
+
+def counts_by_measurement(conn, machine_id):
+    return {r[0]: r[1] for r in conn.execute(
+        "SELECT measurement_id, COUNT(*) FROM attachments WHERE machine_id=? GROUP BY measurement_id", (machine_id,))}
+
+
+def detach(conn, measurement_id=None, machine_id=None, tool_id=None):
+    # rows only; files go in gc() once the delete has committed
+    if measurement_id is not None:
+        conn.execute("DELETE FROM attachments WHERE measurement_id=?", (measurement_id,))
+    elif machine_id is not None:
+        conn.execute("DELETE FROM attachments WHERE machine_id=?", (machine_id,))
+    elif tool_id is not None:
+        conn.execute("DELETE FROM attachments WHERE tool_id=?", (tool_id,))
+
+
+def _collect(root, sha, cutoff):
+    # moved aside first: an upload that reuses the file after this point finds it gone and writes its own copy
+    path = blob_path(root, sha)
+    aside = path + ".gc"
+    try:
+        os.replace(path, aside)
+    except FileNotFoundError:
+        aside = None
+    if aside is not None and os.path.getmtime(aside) >= cutoff:
+        # touched by an upload since it was listed: put it back
+        os.replace(aside, path)
+        return False
+    for victim in (aside, thumb_path(root, sha)):
+        if victim and os.path.exists(victim):
+            os.remove(victim)
+    return True
+
+
+def _unreferenced_files(root, cutoff):
+    # blob files and upload temp files older than the grace period; the caller filters by row
+    for sub in ("blobs", "tmp"):
+        for dirpath, _, files in os.walk(os.path.join(root, sub)):
+            for name in files:
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        yield sub, name, path
+                except FileNotFoundError:
+                    continue
+
+
+def gc(conn, sweep=False, grace=GC_GRACE_SECONDS):
+    # blobs no attachment points to anymore: drop the row, the file and its thumbnail.
+    # Runs under the write lock, so no upload can commit a row for a blob while it goes;
+    # sweep=True (nightly) also removes files that never got a row
+    root = store_dir(conn)
+    cutoff = time.time() - grace
+    stamp = datetime.fromtimestamp(cutoff).strftime("%Y-%m-%d %H:%M:%S")
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    removed = 0
+    try:
+        for (sha,) in conn.execute("""
+            SELECT sha256 FROM attachment_blobs
+            WHERE created_at < ? AND sha256 NOT IN (SELECT sha256 FROM attachments)
+        """, (stamp,)).fetchall():
+            if _collect(root, sha, cutoff):
+                conn.execute("DELETE FROM attachment_blobs WHERE sha256=?", (sha,))
+                removed += 1
+        if sweep:
+            for sub, name, path in _unreferenced_files(root, cutoff):
+                if sub == "tmp" or name.endswith(".gc"):
+                    # an upload or a collection that died halfway
+                    os.remove(path)
+                elif not conn.execute("SELECT 1 FROM attachment_blobs WHERE sha256=?", (name,)).fetchone():
+                    removed += _collect(root, name, cutoff)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return removed
+
+
+# ---- thumbnails ----
+
+def make_thumbnail(src, dest, size=THUMB_SIZE):
+    # runs in a worker process; writes to a temp name so readers never see half a JPEG
+    with Image.open(src) as im:
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail(size)
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = dest + f".{os.getpid()}.tmp"
+        im.save(tmp, "JPEG", quality=80, optimize=True)
+    os.replace(tmp, dest)
+    return dest
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=THUMB_WORKERS)
+        return _pool
+
+
+def can_thumbnail(mime):
+    return Image is not None and mime in THUMB_TYPES
+
+
+def schedule_thumbnail(root, sha, mime):
+    # fire and forget; a request that arrives first gets the placeholder
+    if not can_thumbnail(mime):
+        return False
+    dest = thumb_path(root, sha)
+    with _pool_lock:
+        if sha in _pending or os.path.exists(dest):
+            return False
+        _pending.add(sha)
+    try:
+        fut = _get_pool().submit(make_thumbnail, blob_path(root, sha), dest)
+    except Exception:
+        with _pool_lock:
+            _pending.discard(sha)
+        raise
+
+    def done(_):
+        with _pool_lock:
+            _pending.discard(sha)
+    fut.add_done_callback(done)
+    return True
+
+
+def placeholder(mime):
+    label = "PDF" if mime == "application/pdf" else "…"
+    return PLACEHOLDER_SVG.format(label=label)
+
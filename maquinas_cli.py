@@ -0,0 +1,272 @@
+"""
+Monitor de Condición - línea de comandos para operaciones masivas, sin servidor web
+- mismos servicios que las rutas (maquinas_import, maquinas_export, maquinas_archive...) sin crear la app Flask
+- cada comando importa solo los módulos que usa, así los cron arrancan rápido
+- --site (repetible) o --all-sites eligen las plantas; --jobs N las procesa en N procesos a la vez
+
+Uso:
+    python maquinas_cli.py import ["<excel>.xlsx"] [--site norte]
+    python maquinas_cli.py rescore [--all-sites] [--jobs 4]
+    python maquinas_cli.py export status --format xlsx [--out estado.xlsx]
+    python maquinas_cli.py archive [--days 730] [--all-sites]
+    python maquinas_cli.py snapshot [--keep 14] [--dir snapshots]
+    python maquinas_cli.py bench [--repeat 20] [--jobs 4]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import maquinas_db
+import maquinas_sites
+
+
+def _sites(args):
+    if args.all_sites:
+        return list(maquinas_sites.SITES)
+    for site in args.site or []:
+        if site not in maquinas_sites.SITES:
+            raise SystemExit(f"Planta desconocida: {site} ({', '.join(maquinas_sites.SITES)})")
+    return args.site or [maquinas_sites.DEFAULT_SITE]
+
+
+def _for_sites(fn, args, sites=None):
+    # one site per process when --jobs > 1; each returns a line to print
+    sites = sites or _sites(args)
+    params = {k: v for k, v in vars(args).items() if k != 'func'}
+    if args.jobs > 1 and len(sites) > 1:
+        with ProcessPoolExecutor(max_workers=min(args.jobs, len(sites))) as pool:
+            results = list(pool.map(fn, sites, [params] * len(sites)))
+    else:
+        results = [fn(site, params) for site in sites]
+    for line in results:
+        print(line)
+    return 0
+
+
+# ---- comandos ----
+
+def cmd_import(args):
+    import maquinas_import
+    sites = _sites(args)
+    if len(sites) != 1:
+        raise SystemExit("import: una sola planta por vez (--site)")
+    if not os.path.exists(args.excel):
+        print(f"Archivo no encontrado: {args.excel}")
+        return 2
+    maquinas_db.ensure(sites[0])
+    conn = maquinas_db.connect(sites[0])
+    started = time.perf_counter()
+    try:
+        result = maquinas_import.import_excel(conn, args.excel)
+    except ValueError as e:
+        print(f"✗ {e}")
+        return 1
+    finally:
+        conn.close()
+    for warning in result['warnings']:
+        print(f"! {warning}")
+    print(f"✓ {sites[0]}: {result['inserted']} mediciones creadas, {result['planned']} inspecciones planificadas, "
+          f"{result['review']} filas para revisar ({time.perf_counter() - started:.1f} s)")
+    return 0
+
+
+def _rescore_site(site, params):
+    # every derived table of the plant from scratch: sparklines, rollups, alerts, forecasts
+    import maquinas_analytics
+    import maquinas_assets
+    import maquinas_forecast
+    import maquinas_sparklines
+    maquinas_db.ensure(site)
+    conn = maquinas_db.connect(site)
+    started = time.perf_counter()
+    try:
+        maquinas_sparklines.invalidate(conn)
+        maquinas_assets.refresh_rollups(conn)
+        conn.commit()
+        opened, closed = maquinas_analytics.run_detection(conn)
+        refitted = maquinas_forecast.refit(conn, full=True)
+    finally:
+        conn.close()
+    return (f"✓ {site}: {opened} alertas nuevas, {closed} cerradas, {refitted} pronósticos "
+            f"({time.perf_counter() - started:.1f} s)")
+
+
+def cmd_rescore(args):
+    return _for_sites(_rescore_site, args)
+
+
+def _export_site(site, params):
+    import maquinas_export
+    dataset, fmt = params['dataset'], params['format']
+    suffix = 'xlsx' if dataset == 'matrix' else fmt
+    out = params['out']
+    if params['out_dir'] is not None or not out:
+        out = os.path.join(params['out_dir'] or '', f"{dataset}_{site}_{datetime.now().strftime('%Y%m%d_%H%M')}.{suffix}")
+    maquinas_db.ensure(site)
+    conn = maquinas_db.connect(site)
+    started = time.perf_counter()
+    try:
+        if dataset == 'matrix':
+            maquinas_export.write_cm_matrix(conn, out)
+        else:
+            headers = maquinas_export.headers_for(dataset)
+            rows = maquinas_export.iter_dataset(conn, dataset)
+            if fmt == 'csv':
+                stream = maquinas_export.csv_stream(rows, headers)
+            else:
+                stream = maquinas_export.xlsx_stream(rows, headers, maquinas_export.SHEET_TITLES[dataset])
+            with open(out, 'wb') as f:
+                for chunk in stream:
+                    f.write(chunk)
+    finally:
+        conn.close()
+    return f"✓ {site}: {out} ({os.path.getsize(out) / 1024:.0f} KB, {time.perf_counter() - started:.1f} s)"
+
+
+def cmd_export(args):
+    sites = _sites(args)
+    # several plants: --out is a folder and each file is named after its plant
+    args.out_dir = None
+    if len(sites) > 1 and args.out:
+        os.makedirs(args.out, exist_ok=True)
+        args.out_dir = args.out
+    return _for_sites(_export_site, args, sites)
+
+
+def _archive_site(site, params):
+    import maquinas_archive
+    maquinas_db.ensure(site)
+    conn = maquinas_db.connect(site)
+    try:
+        moved = maquinas_archive.archive_measurements(conn, params['days'])
+    finally:
+        conn.close()
+    years = ", ".join(f"{year}: {count}" for year, count in sorted(moved.items())) or "nada que archivar"
+    return f"✓ {site}: {sum(moved.values())} mediciones archivadas ({years})"
+
+
+def cmd_archive(args):
+    return _for_sites(_archive_site, args)
+
+
+def _snapshot_site(site, params):
+    import maquinas_snapshot
+    path, archives, removed = maquinas_snapshot.scheduled_snapshot(maquinas_sites.db_file(site), params['keep'], params['dir'])
+    return f"✓ {site}: {path} + {len(archives)} archivos de mediciones ({len(removed)} snapshots viejos eliminados)"
+
+
+def cmd_snapshot(args):
+    return _for_sites(_snapshot_site, args)
+
+
+# ---- bench ----
+
+def _bench_reads():
+    # the read paths behind the busiest pages, through the same service functions
+    import maquinas_analytics
+    import maquinas_assets
+    import maquinas_forecast
+    import maquinas_sync
+    return (
+        ("lista de máquinas", lambda conn: conn.execute(
+            "SELECT id, name, notes, priority, machine_group, color, color_hex, machine_type, hac_code "
+            "FROM machines ORDER BY priority DESC, name").fetchall()),
+        ("estado actual", maquinas_sync.latest_status),
+        ("alertas abiertas", maquinas_analytics.open_alerts),
+        ("pronósticos", maquinas_forecast.list_forecasts),
+        ("árbol de activos", lambda conn: maquinas_assets.node_view(conn, (maquinas_assets.root_node(conn) or [0])[0])),
+    )
+
+
+def _bench_site(site, params):
+    # -> {query: [seconds per run]}; each process has its own connection, like a web worker
+    conn = maquinas_db.connect(site)
+    timings = {}
+    try:
+        for label, read in _bench_reads():
+            runs = []
+            for _ in range(params['repeat']):
+                started = time.perf_counter()
+                read(conn)
+                runs.append(time.perf_counter() - started)
+            timings[label] = runs
+    finally:
+        conn.close()
+    return timings
+
+
+def cmd_bench(args):
+    sites = _sites(args)
+    params = {k: v for k, v in vars(args).items() if k != 'func'}
+    for site in sites:
+        maquinas_db.ensure(site)
+        started = time.perf_counter()
+        if args.jobs > 1:
+            # N concurrent readers on the same plant, like N workers under load
+            with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+                parts = list(pool.map(_bench_site, [site] * args.jobs, [params] * args.jobs))
+        else:
+            parts = [_bench_site(site, params)]
+        wall = time.perf_counter() - started
+        print(f"{site} ({maquinas_sites.db_file(site)}), {args.jobs} proceso(s) x {args.repeat} repeticiones:")
+        total = 0
+        for label, _ in _bench_reads():
+            runs = sorted(t for part in parts for t in part[label])
+            total += len(runs)
+            p95 = runs[min(len(runs) - 1, int(len(runs) * 0.95))]
+            print(f"  {label:<22} mediana {statistics.median(runs) * 1000:8.2f} ms   p95 {p95 * 1000:8.2f} ms   máx {runs[-1] * 1000:8.2f} ms")
+        print(f"  {total} consultas en {wall:.2f} s ({total / wall:.0f} consultas/s)")
+    return 0
+
+
+def build_parser():
+    p = argparse.ArgumentParser(prog="maquinas", description="Operaciones masivas del Monitor de Condición")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--site", action="append", help="planta (repetible); por defecto la primera configurada")
+    common.add_argument("--all-sites", action="store_true", help="todas las plantas configuradas")
+    common.add_argument("--jobs", type=int, default=1, help="procesos en paralelo")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    s = sub.add_parser("import", parents=[common], help="importar la matriz de condición (Excel)")
+    s.add_argument("excel", nargs="?", default=None)
+    s.set_defaults(func=cmd_import)
+
+    s = sub.add_parser("rescore", parents=[common], help="recalcular alertas, pronósticos y agregados de toda la flota")
+    s.set_defaults(func=cmd_rescore)
+
+    s = sub.add_parser("export", parents=[common], help="exportar máquinas, estado, historial o la matriz")
+    s.add_argument("dataset", choices=("machines", "status", "measurements", "matrix"))
+    s.add_argument("--format", choices=("csv", "xlsx"), default="csv")
+    s.add_argument("--out", default=None, help="archivo de salida (con varias plantas, carpeta de salida)")
+    s.set_defaults(func=cmd_export)
+
+    s = sub.add_parser("archive", parents=[common], help="archivar por año las mediciones antiguas")
+    s.add_argument("--days", type=int, default=None, help="horizonte en días que queda en la base principal")
+    s.set_defaults(func=cmd_archive)
+
+    s = sub.add_parser("snapshot", parents=[common], help="snapshot consistente de la base, con retención")
+    s.add_argument("--keep", type=int, default=int(os.environ.get("MAQUINAS_SNAPSHOT_KEEP", "14")))
+    s.add_argument("--dir", default=None, help="carpeta de destino (por defecto snapshots/ junto a la base)")
+    s.set_defaults(func=cmd_snapshot)
+
+    s = sub.add_parser("bench", parents=[common], help="medir las consultas de lectura principales")
+    s.add_argument("--repeat", type=int, default=20)
+    s.set_defaults(func=cmd_bench)
+    return p
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == "import" and args.excel is None:
+        import maquinas_import
+        args.excel = maquinas_import.DEFAULT_EXCEL
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,254 @@
+"""
+Criterios de puntaje (hoja 'Criterios') como modelo versionado en la base
+- categorías (Diseño, Patologías VOSOA, Inspección empresa externa, Tiempo sin revisar, Exposición),
+  opciones con su factor, y bandas de prioridad por puntaje total
+- cada carga de la hoja con contenido distinto crea una versión nueva; la misma hoja no crea nada
+- forma compilada en memoria por proceso, recompilada solo cuando cambia la versión activa
+- las mediciones puntuadas guardan measurements.criteria_version para poder reproducir el puntaje
+
+Uso:
+    python maquinas_criteria.py [machines.db] [excel.xlsx]
+"""
+
+import argparse
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import namedtuple
+from datetime import datetime
+
+import maquinas_archive
+
+SHEET = 'Criterios'
+# options matched in a row's text: (LABEL, factor, category code)
+Compiled = namedtuple('Compiled', 'version options categories max_single bands')
+_RANGE = re.compile(r"(\d+(?:[.,]\d+)?)")
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS criteria_versions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sheet_hash TEXT NOT NULL UNIQUE,
+        source TEXT,
+        created_at TEXT NOT NULL,
+        active INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS criteria_categories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        version_id INTEGER NOT NULL,
+        code TEXT NOT NULL,
+        name TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        UNIQUE (version_id, code)
+    );
+    CREATE TABLE IF NOT EXISTS criteria_options (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        version_id INTEGER NOT NULL,
+        category_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        label TEXT NOT NULL,
+        factor REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_criteria_options_version ON criteria_options(version_id, category_id);
+    CREATE TABLE IF NOT EXISTS criteria_bands (
+        version_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        label TEXT NOT NULL,
+        min_score REAL,
+        max_score REAL,
+        PRIMARY KEY (version_id, position)
+    );
+    """)
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(measurements)")}
+    if 'criteria_version' not in cols:
+        conn.execute("ALTER TABLE measurements ADD COLUMN criteria_version INTEGER")
+        print("✓ Columna criteria_version agregada")
+
+
+def _slug(text):
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode().lower()
+    return re.sub(r"[^a-z0-9]+", "_", text).strip("_")
+
+
+def _is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def _text(v):
+    return v.strip() if isinstance(v, str) else ""
+
+
+def _band_range(text):
+    # "Entre 0 y 70" -> (0, 70); "Media entre 70 y 100" -> (70, 100); "Alta > 100" -> (100, None)
+    nums = [float(n.replace(',', '.')) for n in _RANGE.findall(text or "")]
+    if len(nums) >= 2:
+        return nums[0], nums[1]
+    if len(nums) == 1:
+        return (nums[0], None) if '>' in text else (None, nums[0])
+    return None, None
+
+
+def parse_sheet(rows):
+    # rows: list of cell-value tuples. A block header is a text cell with a 'Factor' cell further
+    # right on the same row; below it: number | label | ... | factor until the number column ends.
+    # 'Prioridad' blocks (number | label | range text) become score bands.
+    rows = [list(r) for r in rows]
+    categories, bands = [], []
+    for r, row in enumerate(rows):
+        for c, v in enumerate(row):
+            head = _text(v)
+            if not head:
+                continue
+            factor_col = next((k for k in range(c + 1, min(c + 4, len(row))) if _text(row[k]).upper() == 'FACTOR'), None)
+            is_bands = head.upper() == 'PRIORIDAD'
+            if factor_col is None and not is_bands:
+                continue
+            if head.upper() == 'FACTOR':
+                continue
+            # texts between the header and 'Factor' qualify it ("VOSOA (inspección interna)" + "Patologías")
+            extra = [_text(row[k]) for k in range(c + 1, factor_col or c + 1) if _text(row[k])]
+            name = " - ".join([head] + extra)
+            options = []
+            for below in rows[r + 1:]:
+                num = below[c] if c < len(below) else None
+                if not _is_number(num):
+                    break
+                label = _text(below[c + 1]) if c + 1 < len(below) else ""
+                if is_bands:
+                    low, high = _band_range(_text(below[c + 2]) if c + 2 < len(below) else "")
+                    bands.append({'position': int(num), 'label': label, 'min_score': low, 'max_score': high})
+                    continue
+                factor = below[factor_col] if factor_col < len(below) else None
+                if label and _is_number(factor):
+                    options.append({'position': int(num), 'label': label, 'factor': float(factor)})
+            if options:
+                code = _slug(head) or "categoria"
+                if any(cat['code'] == code for cat in categories):
+                    code = f"{code}_{len(categories) + 1}"
+                categories.append({'code': code, 'name': name, 'options': options})
+    return categories, bands
+
+
+def sheet_hash(rows):
+    return hashlib.sha256(json.dumps([list(r) for r in rows], default=str, ensure_ascii=False).encode()).hexdigest()
+
+
+def active_version(conn):
+    row = conn.execute("SELECT id FROM criteria_versions WHERE active=1 ORDER BY id DESC LIMIT 1").fetchone()
+    return row[0] if row else None
+
+
+def import_rows(conn, rows, source=None):
+    # -> (version id, created); an unchanged sheet is detected by hash without parsing it
+    rows = [tuple(r) for r in rows]
+    h = sheet_hash(rows)
+    row = conn.execute("SELECT id FROM criteria_versions WHERE sheet_hash=?", (h,)).fetchone()
+    if row:
+        version, created = row[0], False
+    else:
+        categories, bands = parse_sheet(rows)
+        if not categories:
+            raise ValueError(f"La hoja '{SHEET}' no tiene categorías con factores")
+        cur = conn.execute("INSERT INTO criteria_versions (sheet_hash, source, created_at) VALUES (?,?,?)",
+                           (h, source, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        version, created = cur.lastrowid, True
+        for pos, cat in enumerate(categories):
+            cid = conn.execute("INSERT INTO criteria_categories (version_id, code, name, position) VALUES (?,?,?,?)",
+                               (version, cat['code'], cat['name'], pos)).lastrowid
+            conn.executemany("INSERT INTO criteria_options (version_id, category_id, position, label, factor) VALUES (?,?,?,?,?)",
+                             [(version, cid, o['position'], o['label'], o['factor']) for o in cat['options']])
+        conn.executemany("INSERT INTO criteria_bands (version_id, position, label, min_score, max_score) VALUES (?,?,?,?,?)",
+                         [(version, b['position'], b['label'], b['min_score'], b['max_score']) for b in bands])
+    # re-importing an older sheet makes that version active again
+    conn.execute("UPDATE criteria_versions SET active = (id = ?)", (version,))
+    return version, created
+
+
+def import_workbook(conn, wb, source=None):
+    if SHEET not in wb.sheetnames:
+        return None, False
+    return import_rows(conn, wb[SHEET].iter_rows(values_only=True), source)
+
+
+def load(conn, version):
+    cats = conn.execute("SELECT id, code FROM criteria_categories WHERE version_id=? ORDER BY position", (version,)).fetchall()
+    code_of = {cid: code for cid, code in cats}
+    options = [(label.strip().upper(), factor, code_of[cid]) for cid, label, factor in conn.execute(
+        "SELECT category_id, label, factor FROM criteria_options WHERE version_id=? ORDER BY category_id, position", (version,))]
+    bands = conn.execute("SELECT position, label, min_score, max_score FROM criteria_bands WHERE version_id=? ORDER BY position",
+                         (version,)).fetchall()
+    max_single = max((f for _, f, _ in options), default=0)
+    return Compiled(version, tuple(options), tuple(code for _, code in cats), max_single, tuple(tuple(b) for b in bands))
+
+
+def compiled(conn, version=None):
+    # active version unless one is given; one small query per call, the build only on a version change
+    if version is None:
+        version = active_version(conn)
+    if version is None:
+        return Compiled(None, (), (), 0, ())
+    key = (maquinas_archive.db_path(conn), version)
+    with _cache_lock:
+        hit = _cache.get(key)
+    if hit is not None:
+        return hit
+    comp = load(conn, version)
+    with _cache_lock:
+        # keep only the latest version of each database
+        for k in [k for k in _cache if k[0] == key[0]]:
+            del _cache[k]
+        _cache[key] = comp
+    return comp
+
+
+def score_text(comp, text):
+    # one option per category (the worst that appears in the text); -> (score, [(LABEL, factor)])
+    text = (text or "").upper()
+    best = {}
+    for label, factor, code in comp.options:
+        if label and label in text and (code not in best or factor > best[code][1]):
+            best[code] = (label, factor)
+    matches = [best[code] for code in comp.categories if code in best]
+    return sum(f for _, f in matches), matches
+
+
+def criticality(comp, score):
+    # 0-10 on the same scale the importer always used (three worst single factors = 10)
+    denom = comp.max_single * 3
+    if denom <= 0:
+        return 0
+    return max(0, min(10, int(round(score / denom * 10))))
+
+
+def priority_band(comp, score):
+    for position, label, low, high in comp.bands:
+        if (low is None or score >= low) and (high is None or score <= high):
+            return position, label
+    return None
+
+
+def main(argv=None):
+    from openpyxl import load_workbook
+    p = argparse.ArgumentParser(description="Carga la hoja 'Criterios' como una versión de criterios")
+    p.add_argument("db", nargs="?", default="machines.db")
+    p.add_argument("excel", nargs="?", default="Matriz de condición de equipos principales excel.xlsx")
+    args = p.parse_args(argv)
+    conn = sqlite3.connect(args.db, timeout=30)
+    ensure_schema(conn)
+    version, created = import_workbook(conn, load_workbook(args.excel, read_only=True, data_only=True), source=args.excel)
+    conn.commit()
+    comp = compiled(conn, version)
+    print(f"✓ Criterios versión {version} ({'nueva' if created else 'sin cambios'}): "
+          f"{len(comp.categories)} categorías, {len(comp.options)} opciones, {len(comp.bands)} bandas")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Conexión y esquema de las bases de cada planta, sin Flask
+- lo usan la web (maquinas_app), la línea de comandos (maquinas_cli), las tareas programadas y los scripts
+- init_db crea las tablas y corre las migraciones de todos los módulos
+"""
+
+import os
+import sqlite3
+
+import maquinas_sites
+
+# seconds a connection waits on another worker's write lock before failing
+DB_TIMEOUT = float(os.environ.get("MAQUINAS_DB_TIMEOUT", "30"))
+# stored in PRAGMA user_version by init_db; bump it whenever init_db creates or alters something
+SCHEMA_VERSION = 5
+
+
+def connect(site=None, timeout=DB_TIMEOUT):
+    conn = sqlite3.connect(maquinas_sites.db_file(site), timeout=timeout)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_db(site=None):
+    # schema modules are imported here, not at the top: commands that only read
+    # (export, bench) don't pay for numpy/pandas at start-up
+    import maquinas_analytics
+    import maquinas_archive
+    import maquinas_assets
+    import maquinas_attachments
+    import maquinas_criteria
+    import maquinas_events
+    import maquinas_forecast
+    import maquinas_jobs
+    import maquinas_match
+    import maquinas_notes
+    import maquinas_orders
+    import maquinas_plan
+    import maquinas_refcache
+    import maquinas_sparklines
+    import maquinas_sync
+
+    conn = connect(site)
+    # WAL lets readers in other workers proceed while one worker writes
+    conn.execute("PRAGMA journal_mode=WAL")
+    
+    # Create tables if they don't exist
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS machines (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        notes TEXT,
+        priority INTEGER DEFAULT 3,
+        machine_group INTEGER DEFAULT 1
+    );
+    CREATE TABLE IF NOT EXISTS tools (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        description TEXT
+    );
+    CREATE TABLE IF NOT EXISTS measurements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        machine_id INTEGER,
+        tool_id INTEGER,
+        date TEXT,
+        criticality INTEGER,
+        note TEXT,
+        FOREIGN KEY(machine_id) REFERENCES machines(id),
+        FOREIGN KEY(tool_id) REFERENCES tools(id)
+    );
+    """)
+    
+    # Migration: Add missing columns to existing machines table
+    cursor = conn.execute("PRAGMA table_info(machines)")
+    machines_columns = {row[1] for row in cursor.fetchall()}
+    
+    if 'priority' not in machines_columns:
+        conn.execute("ALTER TABLE machines ADD COLUMN priority INTEGER DEFAULT 3")
+        print("✓ Columna priority agregada")
+    
+    if 'machine_group' not in machines_columns:
+        conn.execute("ALTER TABLE machines ADD COLUMN machine_group INTEGER DEFAULT 1")
+        print("✓ Columna machine_group agregada")
+    
+    if 'notes' not in machines_columns:
+        conn.execute("ALTER TABLE machines ADD COLUMN notes TEXT")
+        print("✓ Columna notes agregada")
+    if 'hac_code' not in machines_columns:
+      conn.execute("ALTER TABLE machines ADD COLUMN hac_code TEXT")
+      print("✓ Columna hac_code agregada")
+      machines_columns.add('hac_code')
+    
+    # Migration: Add missing columns to existing measurements table
+    cursor = conn.execute("PRAGMA table_info(measurements)")
+    measurements_columns = {row[1] for row in cursor.fetchall()}
+    
+    if 'criticality' not in measurements_columns:
+        conn.execute("ALTER TABLE measurements ADD COLUMN criticality INTEGER")
+        print("✓ Columna criticality agregada")
+    
+    if 'note' not in measurements_columns:
+        conn.execute("ALTER TABLE measurements ADD COLUMN note TEXT")
+        print("✓ Columna note agregada")
+    if 'severity' not in measurements_columns:
+      conn.execute("ALTER TABLE measurements ADD COLUMN severity TEXT")
+      print("✓ Columna severity agregada")
+    if 'repair_time' not in measurements_columns:
+      conn.execute("ALTER TABLE measurements ADD COLUMN repair_time TEXT")
+      print("✓ Columna repair_time agregada")
+    
+    # Migration: Add missing columns to existing tools table
+    cursor = conn.execute("PRAGMA table_info(tools)")
+    tools_columns = {row[1] for row in cursor.fetchall()}
+    
+    if 'description' not in tools_columns:
+        conn.execute("ALTER TABLE tools ADD COLUMN description TEXT")
+        print("✓ Columna description agregada")
+    # Migration: add color and color_hex columns to machines
+    if 'color' not in machines_columns:
+      conn.execute("ALTER TABLE machines ADD COLUMN color TEXT")
+      print("✓ Columna color agregada")
+      machines_columns.add('color')
+    if 'color_hex' not in machines_columns:
+      conn.execute("ALTER TABLE machines ADD COLUMN color_hex TEXT")
+      print("✓ Columna color_hex agregada")
+      machines_columns.add('color_hex')
+    if 'machine_type' not in machines_columns:
+      conn.execute("ALTER TABLE machines ADD COLUMN machine_type TEXT")
+      print("✓ Columna machine_type agregada")
+      machines_columns.add('machine_type')
+    if 'area' not in machines_columns:
+      conn.execute("ALTER TABLE machines ADD COLUMN area TEXT")
+      print("✓ Columna area agregada")
+      machines_columns.add('area')
+
+    # history, latest-status and delete queries all filter by machine and date
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_measurements_machine_tool_date ON measurements(machine_id, tool_id, date)")
+    maquinas_archive.ensure_catalog(conn)
+    maquinas_sparklines.ensure_schema(conn)
+    maquinas_analytics.ensure_schema(conn)
+    maquinas_forecast.ensure_schema(conn)
+    maquinas_assets.ensure_schema(conn)
+    maquinas_events.ensure_schema(conn)
+    maquinas_sync.ensure_schema(conn)
+    maquinas_attachments.ensure_schema(conn)
+    maquinas_notes.ensure_schema(conn)
+    maquinas_orders.ensure_schema(conn)
+    maquinas_plan.ensure_schema(conn)
+    maquinas_criteria.ensure_schema(conn)
+    maquinas_refcache.ensure_schema(conn)
+    # normalized HAC index + name trigrams; plan matching and imports probe it
+    maquinas_match.ensure_schema(conn)
+    maquinas_jobs.ensure_schema(conn)
+    # first start with the change log: existing rows become its baseline
+    maquinas_events.ensure_baseline(conn)
+    # notes grown by earlier imports -> machine_notes entries + short summary (no-op once done)
+    compacted, _ = maquinas_notes.compact(conn, lambda c, mid, before: maquinas_events.machine_changed(c, mid, before, source='compaction'))
+    if compacted:
+        print(f"✓ Notas compactadas en {compacted} máquinas")
+    if not maquinas_assets.root_node(conn):
+        # first start after the upgrade: build the tree from existing machines
+        maquinas_assets.sync(conn)
+    
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+    conn.close()
+    print(f"✓ Base de datos inicializada ({maquinas_sites.db_file(site)})")
+
+
+def ensure(site=None):
+    # CLI and scripts: one PRAGMA when the schema is current, the full init_db only when it's behind
+    conn = connect(site)
+    try:
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+    if current < SCHEMA_VERSION:
+        init_db(site)
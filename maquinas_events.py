@@ -0,0 +1,291 @@
+"""
+Registro de cambios de máquinas, herramientas y mediciones (solo se agrega)
+- cada alta / cambio / baja se guarda como evento; los cambios guardan solo los campos modificados
+- los datos van en JSON comprimido con zlib y un diccionario de claves comunes (eventos de pocos bytes)
+- checkpoints periódicos del estado de las máquinas y de la última lectura de cada máquina/herramienta:
+  reconstruir una fecha pasada arranca del checkpoint más cercano en lugar de rehacer todo el historial
+"""
+
+import json
+import os
+import zlib
+from datetime import datetime
+
+import maquinas_archive
+
+CHECKPOINT_EVERY = int(os.environ.get("MAQUINAS_CHECKPOINT_EVERY", "500"))
+# first byte of every blob; bump it (and keep the old decoder) if the dictionary changes
+CODEC_ZLIB_V1 = 1
+_ZDICT = (b'null,"notes":"","priority":,"machine_group":,"color":"red""yellow""blue""green",'
+          b'"color_hex":"","machine_type":"","hac_code":"","area":"","name":"",'
+          b'"repair_time":"24h""48h""72h""Sin acci\\u00f3n""No aplica",'
+          b'"severity":"rojo""naranja""amarillo""verde""gris","note":"",'
+          b'"criticality":,"tool_id":,"machine_id":,"date":"2025-"2026-')
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS events (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts TEXT NOT NULL,
+        entity TEXT NOT NULL,
+        entity_id INTEGER NOT NULL,
+        machine_id INTEGER,
+        tool_id INTEGER,
+        op TEXT NOT NULL,
+        source TEXT,
+        data BLOB
+    );
+    CREATE INDEX IF NOT EXISTS idx_events_machine ON events(machine_id, seq);
+    CREATE INDEX IF NOT EXISTS idx_events_entity ON events(entity, entity_id);
+    CREATE INDEX IF NOT EXISTS idx_events_entity_seq ON events(entity, seq);
+    CREATE INDEX IF NOT EXISTS idx_events_ts ON events(ts);
+    CREATE TRIGGER IF NOT EXISTS events_no_update BEFORE UPDATE ON events
+    BEGIN SELECT RAISE(ABORT, 'events is append-only'); END;
+    CREATE TRIGGER IF NOT EXISTS events_no_delete BEFORE DELETE ON events
+    BEGIN SELECT RAISE(ABORT, 'events is append-only'); END;
+    CREATE TABLE IF NOT EXISTS event_checkpoints (
+        seq INTEGER PRIMARY KEY,
+        ts TEXT NOT NULL,
+        machines INTEGER NOT NULL,
+        state BLOB NOT NULL,
+        readings BLOB
+    );
+    """)
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(event_checkpoints)")}
+    if 'readings' not in cols:
+        # older checkpoints keep NULL: reconstructions start from the first one that has readings
+        conn.execute("ALTER TABLE event_checkpoints ADD COLUMN readings BLOB")
+        print("✓ Columna readings agregada a event_checkpoints")
+
+
+def encode(data):
+    comp = zlib.compressobj(9, zdict=_ZDICT)
+    raw = json.dumps(data, separators=(',', ':')).encode()
+    return bytes([CODEC_ZLIB_V1]) + comp.compress(raw) + comp.flush()
+
+
+def decode(blob):
+    if blob is None:
+        return None
+    if blob[0] != CODEC_ZLIB_V1:
+        raise ValueError(f"codec de evento desconocido: {blob[0]}")
+    return json.loads(zlib.decompressobj(zdict=_ZDICT).decompress(blob[1:]))
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _row(conn, table, row_id):
+    cur = conn.execute(f"SELECT * FROM {table} WHERE id=?", (row_id,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return {d[0]: row[i] for i, d in enumerate(cur.description)}
+
+
+def append(conn, entity, op, entity_id, data=None, machine_id=None, tool_id=None, source=None):
+    # runs inside the caller's transaction: the event commits (or not) with the change itself
+    cur = conn.execute("INSERT INTO events (ts, entity, entity_id, machine_id, tool_id, op, source, data) VALUES (?,?,?,?,?,?,?,?)",
+                       (_now(), entity, entity_id, machine_id, tool_id, op, source, None if data is None else encode(data)))
+    seq = cur.lastrowid
+    last = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM event_checkpoints").fetchone()[0]
+    if seq - last >= CHECKPOINT_EVERY:
+        checkpoint(conn, seq)
+    return seq
+
+
+def _row_changed(conn, table, entity, row_id, before, machine_id=None, source=None):
+    # call right after writing the row; `before` = the row as read before the write
+    after = _row(conn, table, row_id)
+    before = dict(before) if before is not None else None
+    if after is None:
+        if before is None:
+            return None
+        return append(conn, entity, 'delete', row_id, None, machine_id, source=source)
+    after.pop('id', None)
+    if before is None:
+        return append(conn, entity, 'insert', row_id, after, machine_id, source=source)
+    delta = {k: v for k, v in after.items() if before.get(k) != v}
+    if not delta:
+        return None
+    return append(conn, entity, 'update', row_id, delta, machine_id, source=source)
+
+
+def machine_changed(conn, machine_id, before=None, source=None):
+    return _row_changed(conn, 'machines', 'machine', machine_id, before, machine_id, source)
+
+
+def tool_changed(conn, tool_id, before=None, source=None):
+    # tools have no machine; they only feed sync deltas
+    return _row_changed(conn, 'tools', 'tool', tool_id, before, source=source)
+
+
+def measurement_inserted(conn, measurement_id, source=None):
+    row = _row(conn, 'measurements', measurement_id)
+    if row is None:
+        return None
+    row.pop('id', None)
+    return append(conn, 'measurement', 'insert', measurement_id, row, row.get('machine_id'), row.get('tool_id'), source)
+
+
+def measurements_deleted(conn, where, params, source=None):
+    # call before the DELETE, with the same WHERE clause
+    rows = conn.execute(f"SELECT id, machine_id, tool_id FROM measurements WHERE {where}", params).fetchall()
+    for mid_row in rows:
+        append(conn, 'measurement', 'delete', mid_row[0], None, mid_row[1], mid_row[2], source)
+    return len(rows)
+
+
+def archived_measurements_deleted(conn, where, params, source=None):
+    # same for rows that already moved to the per-year archive files; call it before
+    # anything else is written in the transaction, reading the archives attaches them
+    rows = list(maquinas_archive.iter_archived(conn, where, params, "m.id, m.machine_id, m.tool_id"))
+    for mid_row in rows:
+        append(conn, 'measurement', 'delete', mid_row[0], None, mid_row[1], mid_row[2], source)
+    return len(rows)
+
+
+def checkpoint(conn, seq=None):
+    # machine state right after event `seq`, taken from the table itself (same transaction)
+    if seq is None:
+        seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM events").fetchone()[0]
+    cur = conn.execute("SELECT * FROM machines")
+    cols = [d[0] for d in cur.description]
+    machines = {}
+    for row in cur.fetchall():
+        rec = dict(zip(cols, row))
+        machines[str(rec.pop('id'))] = rec
+    # latest reading per machine/tool, rolled forward from the previous checkpoint
+    readings = list(readings_at(conn, seq).values())
+    conn.execute("INSERT OR REPLACE INTO event_checkpoints (seq, ts, machines, state, readings) VALUES (?,?,?,?,?)",
+                 (seq, _now(), len(machines), encode(machines), encode(readings)))
+    return seq
+
+
+def ensure_baseline(conn):
+    # first start with the log: record what already exists so reconstructions start complete
+    if conn.execute("SELECT 1 FROM events LIMIT 1").fetchone() or conn.execute("SELECT 1 FROM event_checkpoints LIMIT 1").fetchone():
+        return False
+    for (mid,) in conn.execute("SELECT id FROM machines ORDER BY id").fetchall():
+        machine_changed(conn, mid, source='baseline')
+    for (tid,) in conn.execute("SELECT id FROM tools ORDER BY id").fetchall():
+        tool_changed(conn, tid, source='baseline')
+    for (mid,) in conn.execute("SELECT id FROM measurements ORDER BY id").fetchall():
+        measurement_inserted(conn, mid, source='baseline')
+    checkpoint(conn)
+    return True
+
+
+# ---- reconstruction ----
+
+def seq_at(conn, when):
+    return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM events WHERE ts <= ?", (when,)).fetchone()[0]
+
+
+def machines_at(conn, seq):
+    cp = conn.execute("SELECT seq, state FROM event_checkpoints WHERE seq <= ? ORDER BY seq DESC LIMIT 1", (seq,)).fetchone()
+    machines, start = {}, 0
+    if cp:
+        start = cp[0]
+        machines = {int(k): v for k, v in decode(cp[1]).items()}
+    for entity_id, op, data in conn.execute("""
+        SELECT entity_id, op, data FROM events
+        WHERE entity = 'machine' AND seq > ? AND seq <= ?
+        ORDER BY seq
+    """, (start, seq)):
+        if op == 'delete':
+            machines.pop(entity_id, None)
+        elif op == 'insert':
+            machines[entity_id] = decode(data)
+        else:
+            machines.setdefault(entity_id, {}).update(decode(data))
+    return machines
+
+
+def _newer(rec, cur):
+    return ((rec.get('date') or ''), rec['id']) > ((cur.get('date') or ''), cur['id'])
+
+
+def _latest_from_log(conn, machine_id, tool_id, seq):
+    # one series, straight from its insert events: only needed when its latest reading was deleted
+    best = None
+    for entity_id, data in conn.execute("""
+        SELECT e.entity_id, e.data FROM events e
+        WHERE e.machine_id = ? AND e.tool_id IS ? AND e.entity = 'measurement' AND e.op = 'insert' AND e.seq <= ?
+          AND NOT EXISTS (SELECT 1 FROM events d WHERE d.entity = 'measurement' AND d.op = 'delete'
+                          AND d.entity_id = e.entity_id AND d.seq <= ?)
+    """, (machine_id, tool_id, seq, seq)):
+        rec = decode(data)
+        rec['id'] = entity_id
+        if best is None or _newer(rec, best):
+            best = rec
+    return best
+
+
+def readings_at(conn, seq):
+    # {(machine_id, tool_id): latest reading} at `seq`: nearest checkpoint + the measurement events after it
+    cp = conn.execute("""
+        SELECT seq, readings FROM event_checkpoints WHERE seq <= ? AND readings IS NOT NULL
+        ORDER BY seq DESC LIMIT 1
+    """, (seq,)).fetchone()
+    latest, start = {}, 0
+    if cp:
+        start = cp[0]
+        latest = {(rec['machine_id'], rec.get('tool_id')): rec for rec in decode(cp[1])}
+    dirty = set()
+    for entity_id, op, machine_id, tool_id, data in conn.execute("""
+        SELECT entity_id, op, machine_id, tool_id, data FROM events
+        WHERE entity = 'measurement' AND seq > ? AND seq <= ?
+        ORDER BY seq
+    """, (start, seq)):
+        key = (machine_id, tool_id)
+        if key in dirty:
+            continue
+        cur = latest.get(key)
+        if op == 'delete':
+            # the reading before it may predate the checkpoint: rebuilt from the log below
+            if cur is not None and cur['id'] == entity_id:
+                dirty.add(key)
+        elif op == 'insert':
+            rec = decode(data)
+            rec['id'] = entity_id
+            if cur is None or _newer(rec, cur):
+                latest[key] = rec
+    for key in dirty:
+        rec = _latest_from_log(conn, key[0], key[1], seq)
+        if rec is None:
+            latest.pop(key, None)
+        else:
+            latest[key] = rec
+    return latest
+
+
+def state_at(conn, when):
+    # fleet as it was at `when`: machine fields + latest reading per tool
+    seq = seq_at(conn, when)
+    machines = machines_at(conn, seq)
+    status = {}
+    for (mid, tid), rec in readings_at(conn, seq).items():
+        if mid in machines:
+            status.setdefault(mid, {})[str(tid)] = rec
+    result = [dict(fields, id=mid, status=status.get(mid, {})) for mid, fields in sorted(machines.items())]
+    return {'at': when, 'seq': seq, 'machines': result}
+
+
+def history(conn, machine_id, limit=200, before_seq=None):
+    # audit trail for one machine, newest first
+    params = [machine_id]
+    filt = ""
+    if before_seq:
+        filt = "AND seq < ?"
+        params.append(before_seq)
+    params.append(limit)
+    return [{'seq': seq, 'ts': ts, 'entity': entity, 'entity_id': eid, 'tool_id': tid, 'op': op, 'source': source,
+             'changes': decode(data)}
+            for seq, ts, entity, eid, tid, op, source, data in conn.execute(f"""
+                SELECT seq, ts, entity, entity_id, tool_id, op, source, data FROM events
+                WHERE machine_id = ? {filt}
+                ORDER BY seq DESC LIMIT ?
+            """, params)]
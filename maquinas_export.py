@@ -0,0 +1,250 @@
+"""
+Exportación de datos (CSV / XLSX)
+- máquinas, matriz de estado actual (última medición por máquina y herramienta) e historial completo
+- las filas se leen del cursor por bloques y se escriben directo a la respuesta (memoria constante)
+- matriz "CM Matrix equipos principales" con el mismo formato que lee import_excel
+"""
+
+import csv
+import io
+import os
+import tempfile
+
+import maquinas_archive
+import maquinas_notes
+
+CHUNK_SIZE = int(os.environ.get("MAQUINAS_EXPORT_CHUNK", "2000"))
+
+MACHINE_HEADERS = ["id", "nombre", "hac", "tipo_equipo", "prioridad", "grupo", "color", "color_hex", "notas"]
+STATUS_HEADERS = ["machine_id", "maquina", "hac", "tipo_equipo", "herramienta", "fecha", "criticidad", "severidad", "tiempo_arreglo", "nota"]
+MEASUREMENT_HEADERS = ["id", "machine_id", "maquina", "hac", "herramienta", "fecha", "criticidad", "severidad", "tiempo_arreglo", "nota"]
+
+DATASETS = ("machines", "status", "measurements")
+
+# paired columns per tool in the condition matrix: a colored status cell followed by the note
+EXCEL_TOOL_COLUMNS = ['VOSOA', 'RUTI', 'COR', 'ACEITE', 'VIB', 'TERMO', 'DES', 'DUREZA', 'EMD', 'VT / LP', 'PM', 'UT', 'ESPESOR']
+MATRIX_SHEET = 'CM Matrix equipos principales'
+
+# the legend of the 'Criterios' sheet (reparar < 1 mes / < 6 meses / monitorear / OK / no aplica):
+# the export writes exactly these, so an exported matrix re-imports and compares cell by cell
+SEVERITY_FILLS = {
+    'rojo': 'FF0000',
+    'naranja': 'FF9900',
+    'amarillo': 'FFFF00',
+    'verde': '00FF00',
+    'gris': 'D9D9D9',
+}
+# other shades planners use for the same meaning (and the ones older exports wrote); read, never written
+SEVERITY_ALIASES = {
+    'C00000': 'rojo',
+    'FFC000': 'naranja',
+    'FF6600': 'naranja',
+    'FFD966': 'amarillo',
+    '00B050': 'verde',
+    '92D050': 'verde',
+    'BFBFBF': 'gris',
+    'CCCCCC': 'gris',
+}
+REPAIR_TIMES = {
+    'rojo': '24h',
+    'naranja': '48h',
+    'amarillo': '72h',
+    'verde': 'Sin acción',
+    'gris': 'No aplica',
+}
+SHEET_TITLES = {"machines": "Máquinas", "status": "Estado actual", "measurements": "Historial"}
+
+
+def _fetch_chunks(cur, chunk_size):
+    while True:
+        batch = cur.fetchmany(chunk_size)
+        if not batch:
+            break
+        yield from batch
+
+
+def headers_for(dataset):
+    return {"machines": MACHINE_HEADERS, "status": STATUS_HEADERS, "measurements": MEASUREMENT_HEADERS}[dataset]
+
+
+def iter_dataset(conn, dataset, where="1=1", params=(), chunk_size=CHUNK_SIZE):
+    # `where`/`params` filter the machines table exactly like the home page filters
+    machine_ids = f"SELECT id FROM main.machines WHERE {where}"
+    if dataset == "machines":
+        cur = conn.execute(f"""
+            SELECT id, name, hac_code, machine_type, priority, machine_group, color, color_hex,
+                   COALESCE({maquinas_notes.full_text_sql("machines.id")}, notes)
+            FROM machines WHERE {where}
+            ORDER BY COALESCE(machine_type,''), name
+        """, params)
+        yield from _fetch_chunks(cur, chunk_size)
+    elif dataset == "status":
+        cur = conn.execute(f"""
+            SELECT mac.id, mac.name, mac.hac_code, mac.machine_type, t.name,
+                   l.date, l.criticality, l.severity, l.repair_time, l.note
+            FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY machine_id, tool_id ORDER BY date DESC, id DESC) AS rn
+                FROM measurements WHERE machine_id IN ({machine_ids})
+            ) l
+            JOIN machines mac ON mac.id = l.machine_id
+            LEFT JOIN tools t ON t.id = l.tool_id
+            WHERE l.rn = 1
+            ORDER BY COALESCE(mac.machine_type,''), mac.name, t.name
+        """, params)
+        yield from _fetch_chunks(cur, chunk_size)
+    elif dataset == "measurements":
+        # archived years first (oldest data), then the hot table
+        names = {r[0]: (r[1], r[2]) for r in conn.execute(f"SELECT id, name, hac_code FROM machines WHERE {where}", params)}
+        tools = {r[0]: r[1] for r in conn.execute("SELECT id, name FROM tools")}
+        for r in maquinas_archive.iter_archived(conn, f"m.machine_id IN ({machine_ids})", params, chunk_size=chunk_size):
+            name, hac = names.get(r["machine_id"], (None, None))
+            yield (r["id"], r["machine_id"], name, hac, tools.get(r["tool_id"]), r["date"], r["criticality"],
+                   r["severity"], r["repair_time"], r["note"])
+        cur = conn.execute(f"""
+            SELECT m.id, m.machine_id, mac.name, mac.hac_code, t.name, m.date, m.criticality, m.severity, m.repair_time, m.note
+            FROM measurements m
+            JOIN machines mac ON mac.id = m.machine_id
+            LEFT JOIN tools t ON t.id = m.tool_id
+            WHERE m.machine_id IN ({machine_ids})
+            ORDER BY m.date
+        """, params)
+        yield from _fetch_chunks(cur, chunk_size)
+    else:
+        raise ValueError(f"Conjunto de datos desconocido: {dataset}")
+
+
+def csv_stream(rows, headers, chunk_size=CHUNK_SIZE):
+    # BOM so Excel on Windows opens accents correctly
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(headers)
+    yield ("\ufeff" + buf.getvalue()).encode("utf-8")
+    buf.seek(0)
+    buf.truncate()
+    n = 0
+    for row in rows:
+        writer.writerow(row)
+        n += 1
+        if n % chunk_size == 0:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+def xlsx_stream(rows, headers, title="Datos", read_size=64 * 1024):
+    # write-only mode keeps one row in memory; the zip container can only be
+    # finalized at the end, so the file is spooled and then streamed out
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title[:31])
+    ws.append(headers)
+    for row in rows:
+        ws.append(list(row))
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as tmp:
+        wb.save(tmp)
+        tmp.seek(0)
+        while True:
+            data = tmp.read(read_size)
+            if not data:
+                break
+            yield data
+
+
+def severity_from_hex(hex6, max_dist=80):
+    # nearest matrix fill; white/black/unknown fills are not a severity
+    if not hex6 or len(hex6) != 6 or hex6.upper() in ('000000', 'FFFFFF'):
+        return None
+    try:
+        rgb = tuple(int(hex6[i:i + 2], 16) for i in (0, 2, 4))
+    except ValueError:
+        return None
+    best, best_dist = None, None
+    palette = [(fill, severity) for severity, fill in SEVERITY_FILLS.items()] + list(SEVERITY_ALIASES.items())
+    for fill, severity in palette:
+        ref = tuple(int(fill[i:i + 2], 16) for i in (0, 2, 4))
+        dist = sum((a - b) ** 2 for a, b in zip(rgb, ref)) ** 0.5
+        if best_dist is None or dist < best_dist:
+            best, best_dist = severity, dist
+    return best if best_dist <= max_dist else None
+
+
+def severity_for(severity, criticality):
+    if severity:
+        return severity
+    if criticality is None:
+        return None
+    if criticality >= 8:
+        return 'rojo'
+    if criticality >= 5:
+        return 'amarillo'
+    return 'verde'
+
+
+def write_cm_matrix(conn, out):
+    # `out` is a path or a binary file; fills/fonts are created once and shared
+    # by every cell so write-only rendering stays fast for large fleets
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment, Font, PatternFill
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(MATRIX_SHEET)
+    fills = {sev: PatternFill(fill_type='solid', start_color='FF' + hexv, end_color='FF' + hexv)
+             for sev, hexv in SEVERITY_FILLS.items()}
+    bold = Font(bold=True)
+    wrap = Alignment(wrap_text=True, vertical='top')
+
+    def cell(value, severity=None, header=False, wrapped=False):
+        c = WriteOnlyCell(ws, value=value)
+        if header:
+            c.font = bold
+        if severity in fills:
+            c.fill = fills[severity]
+        if wrapped:
+            c.alignment = wrap
+        return c
+
+    # same column order the importer detects: blank A, ids, one pair per tool, comments
+    header = [None, 'AREA', 'Código HAC', 'Denominación', 'Tipo equipo']
+    for tool_name in EXCEL_TOOL_COLUMNS:
+        header += [tool_name, None]
+    header += ['Comentarios', 'Fecha intervención y alcance']
+    ws.append([cell(v, header=True) for v in header])
+
+    tool_ids = {}
+    for r in conn.execute("SELECT id, name FROM tools"):
+        key = (r[1] or '').strip().upper()
+        if key in EXCEL_TOOL_COLUMNS:
+            tool_ids[r[0]] = key
+
+    # latest measurement per machine/tool, one pass ordered by machine
+    latest = conn.execute("""
+        SELECT machine_id, tool_id, note, severity, criticality FROM (
+            SELECT machine_id, tool_id, note, severity, criticality,
+                   ROW_NUMBER() OVER (PARTITION BY machine_id, tool_id ORDER BY date DESC, id DESC) AS rn
+            FROM measurements
+        ) WHERE rn = 1 ORDER BY machine_id
+    """)
+    status = {}
+    for machine_id, tool_id, note, severity, criticality in latest:
+        tool_name = tool_ids.get(tool_id)
+        if tool_name:
+            status.setdefault(machine_id, {})[tool_name] = (note, severity_for(severity, criticality))
+
+    machines = conn.execute(f"""
+        SELECT id, area, hac_code, name, machine_type, COALESCE({maquinas_notes.full_text_sql("machines.id")}, notes) FROM machines
+        ORDER BY COALESCE(area,''), COALESCE(hac_code, name)
+    """)
+    for mid, area, hac, name, machine_type, notes in machines:
+        row = [None, area, hac, name, machine_type]
+        by_tool = status.get(mid, {})
+        for tool_name in EXCEL_TOOL_COLUMNS:
+            note, severity = by_tool.get(tool_name, (None, None))
+            row += [cell(None, severity), cell(note or None, wrapped=bool(note))]
+        row += [cell(notes or None, wrapped=bool(notes)), None]
+        ws.append(row)
+
+    wb.save(out)
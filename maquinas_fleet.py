@@ -0,0 +1,261 @@
+"""
+Foto compacta de la flota en memoria para la página de inicio
+- un registro con __slots__ por máquina (id, nombre, prioridad, grupo, color, tipo, HAC, resumen de notas)
+- índices precalculados por tipo, color, prioridad y grupo: filtrar es intersectar conjuntos de ids
+- se mantiene al día con el registro de cambios (maquinas_events): solo se releen las máquinas
+  que tienen eventos nuevos, así un worker ve lo que escribió otro o un script
+
+Uso:
+    python maquinas_fleet.py [machines.db] [--repeat 1000]
+"""
+
+import argparse
+import bisect
+import os
+import sqlite3
+import threading
+import time
+
+import maquinas_archive
+
+# more machines than this share touched since the last look -> one full rebuild instead of row reads
+REBUILD_SHARE = float(os.environ.get("MAQUINAS_FLEET_REBUILD_SHARE", "0.25"))
+NO_TYPE = 'Sin tipo'
+# filter combinations kept per snapshot until the next change
+MEMO_SIZE = 64
+
+_FLEET_QUERY = """
+    SELECT m.id, m.name, m.notes, m.priority, m.machine_group, m.color, m.color_hex, m.machine_type, m.hac_code,
+           (SELECT criticality FROM measurements WHERE machine_id = m.id ORDER BY date DESC LIMIT 1) AS latest_crit
+    FROM machines m
+"""
+
+_fleets = {}
+_fleets_lock = threading.Lock()
+
+
+def crit_color(crit):
+    # machines without an Excel color take it from their latest criticality
+    if crit is None:
+        return 'green'
+    try:
+        crit = int(crit)
+    except (TypeError, ValueError):
+        crit = 0
+    if crit >= 8:
+        return 'red'
+    if crit >= 5:
+        return 'yellow'
+    if crit >= 3:
+        return 'blue'
+    return 'green'
+
+
+def color_sql(id_col="id"):
+    # the same fallback as SQL, for queries that filter machines by color without the snapshot (exports)
+    latest = f"(SELECT CAST(criticality AS INTEGER) FROM measurements WHERE machine_id = {id_col} ORDER BY date DESC LIMIT 1)"
+    return (f"COALESCE(NULLIF(color, ''), CASE WHEN {latest} IS NULL THEN 'green' WHEN {latest} >= 8 THEN 'red' "
+            f"WHEN {latest} >= 5 THEN 'yellow' WHEN {latest} >= 3 THEN 'blue' ELSE 'green' END)")
+
+
+class Machine:
+    # read-only once built: an update replaces the record, so a page being rendered keeps a consistent one
+    __slots__ = ('id', 'name', 'name_lower', 'notes', 'priority', 'machine_group', 'color', 'color_hex',
+                 'machine_type', 'hac_code', 'latest_crit', 'key')
+
+    def __init__(self, row):
+        self.id = row[0]
+        self.name = row[1]
+        self.name_lower = (row[1] or '').lower()
+        self.notes = row[2]
+        self.priority = row[3]
+        self.machine_group = row[4] if row[4] is not None else 1
+        self.latest_crit = row[9]
+        self.color = row[5] or crit_color(row[9])
+        self.color_hex = row[6]
+        self.machine_type = row[7] or NO_TYPE
+        self.hac_code = row[8]
+        # same order as "ORDER BY priority DESC, name" (NULL priorities last)
+        self.key = (self.priority is None, -(self.priority or 0), self.name or '', self.id)
+
+
+class Fleet:
+    def __init__(self):
+        self.seq = None
+        self.by_id = {}
+        self.by_type = {}
+        self.by_color = {}
+        self.by_priority = {}
+        self.by_group = {}
+        self.order = []
+        self.lock = threading.Lock()
+        self.catch_up = threading.Lock()
+        self._memo = {}
+        self._rank = None
+
+    def build(self, conn, seq):
+        machines = [Machine(r) for r in conn.execute(_FLEET_QUERY)]
+        with self.lock:
+            self.by_id = {}
+            for index in (self.by_type, self.by_color, self.by_priority, self.by_group):
+                index.clear()
+            self.order = []
+            for m in machines:
+                self._add(m, ordered=False)
+            self.order.sort()
+            for keys in self.by_type.values():
+                keys.sort()
+            self._changed()
+            self.seq = seq
+
+    def refresh(self, conn, machine_ids, seq):
+        # only the machines with new events; deleted ones just leave the indexes
+        ids = list(machine_ids)
+        rows = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            for r in conn.execute(_FLEET_QUERY + f" WHERE m.id IN ({','.join('?' * len(chunk))})", chunk):
+                rows[r[0]] = Machine(r)
+        with self.lock:
+            for mid in ids:
+                old = self.by_id.get(mid)
+                if old is not None:
+                    self._remove(old)
+                if mid in rows:
+                    self._add(rows[mid])
+            self._changed()
+            self.seq = seq
+        return len(ids)
+
+    def _changed(self):
+        self._memo = {}
+        self._rank = None
+
+    def _add(self, m, ordered=True):
+        self.by_id[m.id] = m
+        self.by_color.setdefault(m.color, set()).add(m.id)
+        self.by_priority.setdefault(m.priority, set()).add(m.id)
+        self.by_group.setdefault(m.machine_group, set()).add(m.id)
+        keys = self.by_type.setdefault(m.machine_type, [])
+        if ordered:
+            bisect.insort(self.order, m.key)
+            bisect.insort(keys, m.key)
+        else:
+            self.order.append(m.key)
+            keys.append(m.key)
+
+    def _remove(self, m):
+        del self.by_id[m.id]
+        self.by_color[m.color].discard(m.id)
+        self.by_priority[m.priority].discard(m.id)
+        self.by_group[m.machine_group].discard(m.id)
+        for keys in (self.order, self.by_type[m.machine_type]):
+            i = bisect.bisect_left(keys, m.key)
+            if i < len(keys) and keys[i] == m.key:
+                del keys[i]
+        if not self.by_type[m.machine_type]:
+            del self.by_type[m.machine_type]
+
+    def select(self, search='', priority=None, group=None, color=None, ids=None, machine_type=None):
+        # -> ([Machine] in list order, {machine_type: [Machine]}); filters are ANDed, None = any
+        ids = frozenset(ids) if ids is not None else None
+        args = (search, priority, group, color, ids, machine_type)
+        with self.lock:
+            hit = self._memo.get(args)
+            if hit is not None:
+                return hit
+            if self._rank is None:
+                # position in list order; rebuilt once after a change, then sorting a selection is int compares
+                self._rank = {k[-1]: i for i, k in enumerate(self.order)}
+            sets = []
+            if priority is not None:
+                sets.append(self.by_priority.get(priority, set()))
+            if group is not None:
+                sets.append(self.by_group.get(group, set()))
+            if color:
+                sets.append(self.by_color.get(color, set()))
+            if machine_type:
+                sets.append({k[-1] for k in self.by_type.get(machine_type, ())})
+            if ids is not None:
+                sets.append(ids)
+            by_id = self.by_id
+            if sets:
+                sets.sort(key=len)
+                selected = sets[0].intersection(*sets[1:])
+            elif search:
+                selected = by_id.keys()
+            else:
+                selected = None
+            if search:
+                selected = [mid for mid in selected if mid in by_id and search in by_id[mid].name_lower]
+            if selected is None:
+                machines = [by_id[k[-1]] for k in self.order]
+            else:
+                machines = [by_id[mid] for mid in sorted((mid for mid in selected if mid in by_id), key=self._rank.__getitem__)]
+            groups = {}
+            for m in machines:
+                groups.setdefault(m.machine_type, []).append(m)
+            if len(self._memo) >= MEMO_SIZE:
+                self._memo.clear()
+            self._memo[args] = (machines, groups)
+            return machines, groups
+
+
+def _last_seq(conn):
+    return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM events").fetchone()[0]
+
+
+def fleet(conn):
+    # the process-wide snapshot of this database, caught up with the change log
+    path = maquinas_archive.db_path(conn)
+    with _fleets_lock:
+        f = _fleets.get(path)
+        if f is None:
+            f = _fleets[path] = Fleet()
+    if f.seq == _last_seq(conn):
+        return f
+    with f.catch_up:
+        # re-read under the lock: another thread may have caught up meanwhile
+        seq = _last_seq(conn)
+        if f.seq is None or seq < f.seq:
+            # first use, or the database was replaced (snapshot restore)
+            f.build(conn, seq)
+        elif seq != f.seq:
+            changed = [r[0] for r in conn.execute(
+                "SELECT DISTINCT machine_id FROM events WHERE seq > ? AND seq <= ? AND machine_id IS NOT NULL", (f.seq, seq))]
+            if len(changed) > max(50, len(f.by_id) * REBUILD_SHARE):
+                f.build(conn, seq)
+            else:
+                f.refresh(conn, changed, seq)
+    return f
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Construye la foto de la flota y mide los filtros de la página de inicio")
+    p.add_argument("db", nargs="?", default="machines.db")
+    p.add_argument("--repeat", type=int, default=1000)
+    args = p.parse_args(argv)
+    conn = sqlite3.connect(args.db)
+    started = time.perf_counter()
+    f = fleet(conn)
+    print(f"✓ {len(f.by_id)} máquinas, {len(f.by_type)} tipos en {(time.perf_counter() - started) * 1000:.1f} ms")
+    for label, kwargs in (("sin filtro", {}), ("color rojo", {'color': 'red'}),
+                          ("prioridad 5", {'priority': 5}), ("búsqueda 'cinta'", {'search': 'cinta'})):
+        # first call after a change (indexes only) and repeated calls (memoized)
+        timings = []
+        for _ in range(args.repeat):
+            f._memo = {}
+            started = time.perf_counter()
+            machines, _ = f.select(**kwargs)
+            timings.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            f.select(**kwargs)
+        warm = (time.perf_counter() - started) / args.repeat * 1e6
+        print(f"  {label:<18} {len(machines):6d} máquinas  {sorted(timings)[len(timings) // 2] * 1e6:9.1f} µs"
+              f"  (repetido {warm:.1f} µs)")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
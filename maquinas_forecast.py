@@ -0,0 +1,260 @@
+"""
+Pronóstico de criticidad por serie máquina/herramienta
+- recta de regresión ponderada (olvido exponencial) guardada como estadísticos suficientes por serie
+- los reajustes son incrementales: solo se suman las mediciones con id mayor a la marca de agua
+- proyecta cuándo cada serie cruza amarillo (5) y rojo (8), con banda de confianza
+
+Uso:
+    python maquinas_forecast.py [machines.db] [--full]
+"""
+
+import argparse
+import math
+import os
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+
+import maquinas_analytics
+
+YELLOW = 5
+RED = 8
+# older readings weigh half every HALF_LIFE days, so repairs fade out of the trend
+HALF_LIFE_DAYS = float(os.environ.get("MAQUINAS_FORECAST_HALFLIFE", "180"))
+MIN_POINTS = 3
+# two-sided ~90% band on the slope
+BAND_Z = 1.645
+# projections further out than this are reported as "no crossing"
+HORIZON_DAYS = 3650
+# julianday of 2000-01-01; keeps t small so the sums don't lose precision
+_EPOCH = 2451544.5
+_STATS = ('n', 'sw', 'sww', 'st', 'sy', 'stt', 'sty', 'syy')
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS forecast_stats (
+        machine_id INTEGER NOT NULL,
+        tool_id INTEGER NOT NULL,
+        n INTEGER NOT NULL,
+        sw REAL, sww REAL, st REAL, sy REAL, stt REAL, sty REAL, syy REAL,
+        last_t REAL,
+        last_y REAL,
+        PRIMARY KEY (machine_id, tool_id)
+    );
+    CREATE TABLE IF NOT EXISTS forecast_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        last_measurement_id INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS forecasts (
+        machine_id INTEGER NOT NULL,
+        tool_id INTEGER NOT NULL,
+        level REAL,
+        slope REAL,
+        yellow_at TEXT, yellow_lo TEXT, yellow_hi TEXT,
+        red_at TEXT, red_lo TEXT, red_hi TEXT,
+        updated_at TEXT,
+        PRIMARY KEY (machine_id, tool_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_forecasts_red_at ON forecasts(red_at);
+    """)
+
+
+def _watermark(conn):
+    row = conn.execute("SELECT last_measurement_id FROM forecast_state WHERE id=1").fetchone()
+    return row[0] if row else 0
+
+
+def _load_rows(conn, where, params):
+    value = maquinas_analytics._series_value_sql()
+    rows = conn.execute(f"""
+        SELECT m.machine_id, m.tool_id, julianday(m.date) - {_EPOCH}, {value}
+        FROM measurements m
+        {where} AND m.date IS NOT NULL AND julianday(m.date) IS NOT NULL AND {value} IS NOT NULL
+        ORDER BY m.machine_id, m.tool_id, m.date, m.id
+    """, params).fetchall()
+    return np.array([tuple(r) for r in rows], dtype=float).reshape(-1, 4)
+
+
+def _fold(conn, arr):
+    # add new readings to the stored sums of their series; returns {key: stats dict}
+    mid = arr[:, 0].astype(np.int64)
+    tid = arr[:, 1].astype(np.int64)
+    t, y = arr[:, 2], arr[:, 3]
+    starts = np.flatnonzero(np.r_[True, (mid[1:] != mid[:-1]) | (tid[1:] != tid[:-1])])
+    ends = np.r_[starts[1:], len(arr)]
+    keys = list(zip(mid[starts].tolist(), tid[starts].tolist()))
+
+    old = {}
+    for m, tl in keys:
+        r = conn.execute(f"SELECT {', '.join(_STATS)}, last_t, last_y FROM forecast_stats WHERE machine_id=? AND tool_id=?", (m, tl)).fetchone()
+        if r:
+            old[(m, tl)] = tuple(r)
+    exists = np.array([k in old for k in keys])
+    prev = np.array([old.get(k, (0,) * (len(_STATS) + 2)) for k in keys], dtype=float).reshape(len(keys), -1)
+    prev_last_t, prev_last_y = prev[:, -2], prev[:, -1]
+
+    # readings inside a series are sorted by date: the last one is the newest
+    new_last_t = np.where(exists, np.maximum(prev_last_t, t[ends - 1]), t[ends - 1])
+    new_last_y = np.where(exists & (prev_last_t > t[ends - 1]), prev_last_y, y[ends - 1])
+    decay = math.log(2) / HALF_LIFE_DAYS
+    group = np.repeat(np.arange(len(keys)), ends - starts)
+    w = np.exp(-decay * (new_last_t[group] - t))
+    sums = [np.add.reduceat(v, starts) for v in (np.ones_like(w), w, w * w, w * t, w * y, w * t * t, w * t * y, w * y * y)]
+
+    scale = np.where(exists, np.exp(-decay * (new_last_t - prev_last_t)), 0.0)
+    stats = {}
+    for i, col in enumerate(_STATS):
+        factor = 1.0 if col == 'n' else scale ** 2 if col == 'sww' else scale
+        stats[col] = prev[:, i] * factor + sums[i]
+    stats['last_t'], stats['last_y'] = new_last_t, new_last_y
+
+    conn.executemany(f"INSERT OR REPLACE INTO forecast_stats (machine_id, tool_id, {', '.join(_STATS)}, last_t, last_y) VALUES ({','.join('?' * (len(_STATS) + 4))})",
+                     [(m, tl, *[float(stats[c][i]) for c in _STATS + ('last_t', 'last_y')]) for i, (m, tl) in enumerate(keys)])
+    return keys, stats
+
+
+def _crossing(level, slope, threshold, last_y):
+    # days after the last reading until the fitted line reaches `threshold`
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days = np.where(slope > 0, (threshold - level) / slope, np.inf)
+    days = np.where((level >= threshold) | (last_y >= threshold), 0.0, days)
+    return np.where(days > HORIZON_DAYS, np.inf, days)
+
+
+def project(stats):
+    # weighted least squares for every series at once
+    sw, sww, st, sy = stats['sw'], stats['sww'], stats['st'], stats['sy']
+    stt, sty, syy = stats['stt'], stats['sty'], stats['syy']
+    last_t, last_y = stats['last_t'], stats['last_y']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sxx = stt - st * st / sw
+        sxy = sty - st * sy / sw
+        valid = (stats['n'] >= MIN_POINTS) & (sxx > 1e-9)
+        slope = np.where(valid, sxy / sxx, 0.0)
+        level = np.where(valid, sy / sw + slope * (last_t - st / sw), last_y)
+        sse = np.maximum(syy - sy * sy / sw - slope * sxy, 0.0)
+        n_eff = sw * sw / sww
+        se = np.where(valid, np.sqrt(sse / np.maximum(n_eff - 2, 1) / sxx), 0.0)
+
+    out = {'level': level, 'slope': np.where(valid, slope * 30, np.nan)}
+    for name, threshold in (('yellow', YELLOW), ('red', RED)):
+        out[f'{name}_at'] = last_t + _crossing(level, slope, threshold, last_y)
+        # steeper slope = earlier crossing
+        out[f'{name}_lo'] = last_t + _crossing(level, slope + BAND_Z * se, threshold, last_y)
+        out[f'{name}_hi'] = last_t + _crossing(level, slope - BAND_Z * se, threshold, last_y)
+    return out
+
+
+def _date(t):
+    if not np.isfinite(t):
+        return None
+    return str(np.datetime64('2000-01-01') + np.timedelta64(int(t), 'D'))
+
+
+def _store(conn, keys, stats):
+    proj = project(stats)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    cols = ('yellow_at', 'yellow_lo', 'yellow_hi', 'red_at', 'red_lo', 'red_hi')
+    rows = []
+    for i, (m, tl) in enumerate(keys):
+        slope = proj['slope'][i]
+        rows.append((m, tl, float(proj['level'][i]), None if np.isnan(slope) else float(slope),
+                     *[_date(proj[c][i]) for c in cols], now))
+    conn.executemany(f"INSERT OR REPLACE INTO forecasts (machine_id, tool_id, level, slope, {', '.join(cols)}, updated_at) VALUES ({','.join('?' * 11)})", rows)
+
+
+def refit(conn, full=False):
+    # nightly and after data entry: only readings newer than the watermark are read
+    conn.commit()
+    # IMMEDIATE: two workers refitting at once would add the same readings twice
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if full:
+            conn.execute("DELETE FROM forecast_stats")
+            conn.execute("DELETE FROM forecasts")
+            conn.execute("DELETE FROM forecast_state")
+        low = _watermark(conn)
+        high = conn.execute("SELECT COALESCE(MAX(id), 0) FROM measurements").fetchone()[0]
+        refitted = 0
+        if high > low:
+            arr = _load_rows(conn, "WHERE m.id > ? AND m.id <= ?", (low, high))
+            if len(arr):
+                keys, stats = _fold(conn, arr)
+                _store(conn, keys, stats)
+                refitted = len(keys)
+            conn.execute("INSERT OR REPLACE INTO forecast_state (id, last_measurement_id) VALUES (1, ?)", (high,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return refitted
+
+
+def invalidate(conn, machine_id=None, tool_id=None, pairs=None):
+    # sums can't un-add a reading: after deletes the affected series are rebuilt
+    # from their remaining history (deleted machines/tools just disappear)
+    if pairs is None:
+        where, params = [], []
+        for col, value in (('machine_id', machine_id), ('tool_id', tool_id)):
+            if value is not None:
+                where.append(f"{col}=?")
+                params.append(value)
+        for table in ('forecast_stats', 'forecasts'):
+            conn.execute(f"DELETE FROM {table} WHERE {' AND '.join(where) or '1=1'}", params)
+        return
+    pairs = list({(int(m), int(t)) for m, t in pairs})
+    for table in ('forecast_stats', 'forecasts'):
+        conn.executemany(f"DELETE FROM {table} WHERE machine_id=? AND tool_id=?", pairs)
+    low = _watermark(conn)
+    for m, tl in pairs:
+        arr = _load_rows(conn, "WHERE m.machine_id=? AND m.tool_id=? AND m.id <= ?", (m, tl, low))
+        if len(arr):
+            _store(conn, *_fold(conn, arr))
+
+
+def machine_forecasts(conn, machine_ids=None):
+    # {machine_id: earliest projected red/yellow over its tools} for the home page
+    rows = conn.execute("""
+        SELECT machine_id, MIN(red_at) AS red_at, MIN(red_lo) AS red_lo, MIN(yellow_at) AS yellow_at,
+               CAST(julianday(MIN(red_at)) - julianday(date('now', 'localtime')) AS INTEGER) AS days_to_red
+        FROM forecasts GROUP BY machine_id
+    """).fetchall()
+    wanted = None if machine_ids is None else set(machine_ids)
+    return {r['machine_id']: dict(r) for r in rows if wanted is None or r['machine_id'] in wanted}
+
+
+def list_forecasts(conn, machine_id=None, tool_id=None, sort='red', limit=500):
+    where, params = ["1=1"], []
+    if machine_id is not None:
+        where.append("f.machine_id=?")
+        params.append(machine_id)
+    if tool_id is not None:
+        where.append("f.tool_id=?")
+        params.append(tool_id)
+    order = {'red': 'f.red_at', 'yellow': 'f.yellow_at', 'slope': '-f.slope'}.get(sort, 'f.red_at')
+    return conn.execute(f"""
+        SELECT f.machine_id, mac.name AS machine, mac.hac_code, f.tool_id, t.name AS tool,
+               f.level, f.slope, f.yellow_at, f.yellow_lo, f.yellow_hi, f.red_at, f.red_lo, f.red_hi,
+               CAST(julianday(f.red_at) - julianday(date('now', 'localtime')) AS INTEGER) AS days_to_red,
+               f.updated_at
+        FROM forecasts f
+        LEFT JOIN machines mac ON mac.id = f.machine_id
+        LEFT JOIN tools t ON t.id = f.tool_id
+        WHERE {' AND '.join(where)}
+        ORDER BY {order} IS NULL, {order}, mac.name
+        LIMIT ?
+    """, params + [limit]).fetchall()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reajusta los pronósticos de criticidad")
+    parser.add_argument("db", nargs="?", default="machines.db")
+    parser.add_argument("--full", action="store_true", help="recalcular todas las series desde cero")
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.db, timeout=30)
+    conn.row_factory = sqlite3.Row
+    ensure_schema(conn)
+    print(f"✓ Series reajustadas: {refit(conn, args.full)}")
+    conn.close()
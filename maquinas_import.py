@@ -0,0 +1,331 @@
+"""
+Importación de la matriz de condición (hoja 'CM Matrix equipos principales') como servicio
+- la usan la ruta /import_excel y `maquinas_cli.py import`, con la misma conexión que reciben
+- máquinas por código HAC normalizado o denominación (maquinas_match); las dudosas quedan para revisar
+- color de la fila, puntaje por la hoja 'Criterios',
+  estado por herramienta (nota + color de la celda), notas y hojas "Plan ..."
+"""
+
+import os
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+from openpyxl import load_workbook
+
+import maquinas_analytics
+import maquinas_assets
+import maquinas_criteria
+import maquinas_events
+import maquinas_export
+import maquinas_forecast
+import maquinas_match
+import maquinas_notes
+import maquinas_orders
+import maquinas_plan
+import maquinas_refcache
+import maquinas_sparklines
+
+MAIN_SHEET = maquinas_export.MATRIX_SHEET
+DEFAULT_EXCEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Matriz de condición de equipos principales excel.xlsx')
+
+
+def detect_header_row(excel_path, sheet_name, max_scan=10):
+    try:
+        xls = pd.read_excel(excel_path, sheet_name=sheet_name, header=None)
+    except Exception:
+        return 0
+    for i in range(min(max_scan, len(xls))):
+        row = xls.iloc[i].fillna("").astype(str).str.upper().tolist()
+        if any('AREA' == v or (isinstance(v, str) and v.strip().startswith('AREA')) for v in row if v and v != 'nan'):
+            return i
+    for i in range(min(max_scan, len(xls))):
+        row = xls.iloc[i].fillna("").astype(str).str.upper().tolist()
+        if any('CÓDIGO' in v or 'CODIGO' in v or 'DENOMIN' in v for v in row if v and v != 'nan'):
+            return i
+    return 0
+
+
+def cell_fill_hex(cell):
+    # normalize an openpyxl fill to 'RRGGBB' (or None)
+    fg = None
+    if cell.fill and hasattr(cell.fill, 'fgColor'):
+        fg = cell.fill.fgColor.rgb or cell.fill.start_color.index
+    if not fg:
+        return None
+    # normalize hex like 'FF00FF00' or '00FF00'
+    hexv = str(fg)
+    if len(hexv) == 8 and hexv.startswith('FF'):
+        return hexv[2:]
+    elif len(hexv) >= 6:
+        return hexv[-6:]
+    return None
+
+
+def excel_text(value):
+    # AREA codes come back from pandas as floats (200.0)
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def score_row_by_criteria(row, criteria):
+    # criteria: maquinas_criteria.compiled(); the whole row's text is matched against the option labels
+    joined = ' '.join([str(x) for x in row.values if not pd.isna(x)])
+    return maquinas_criteria.score_text(criteria, joined)
+
+
+def import_excel(conn, excel_path=DEFAULT_EXCEL):
+    # -> {'inserted', 'planned', 'review', 'warnings'}; commits as it goes. ValueError if the main sheet can't be read
+    # parse (dataframe) and openpyxl workbook for formatting
+    header = detect_header_row(excel_path, MAIN_SHEET)
+    try:
+      df = pd.read_excel(excel_path, sheet_name=MAIN_SHEET, header=header)
+      wb = load_workbook(excel_path, data_only=True)
+      ws = wb[MAIN_SHEET]
+    except Exception as e:
+      raise ValueError(f"Error leyendo hoja principal: {e}")
+
+    warnings = []
+    # a new criteria version only when the 'Criterios' sheet changed; otherwise the cached compiled form
+    try:
+      maquinas_criteria.import_workbook(conn, wb, source=os.path.basename(excel_path))
+    except ValueError as e:
+      warnings.append(str(e))
+    conn.commit()
+    criteria = maquinas_refcache.criteria(conn)
+    # ensure a tool exists to tag imports
+    tool = conn.execute("SELECT * FROM tools WHERE name=?", ('AutoImport',)).fetchone()
+    if not tool:
+        cur = conn.execute("INSERT INTO tools (name, description) VALUES (?,?)", ('AutoImport', 'Mediciones importadas desde Excel'))
+        maquinas_events.tool_changed(conn, cur.lastrowid, source='import')
+        conn.commit()
+        tool = conn.execute("SELECT * FROM tools WHERE name=?", ('AutoImport',)).fetchone()
+    tool_id = tool['id']
+
+    # find likely column names and tool columns to read colors from
+    cols_upper = [str(c).upper() for c in df.columns]
+    codigo_col = None
+    denom_col = None
+    comments_col = None
+    machine_type_col = None
+    area_col = None
+    tool_names = maquinas_export.EXCEL_TOOL_COLUMNS
+    tool_cols_idx = []
+    for i, cu in enumerate(cols_upper):
+      if 'CÓDIGO' in cu or 'CODIGO' in cu:
+        codigo_col = df.columns[i]
+      if 'DENOMIN' in cu:
+        denom_col = df.columns[i]
+      if 'TIPO' in cu or 'TIPO EQU' in cu:
+        machine_type_col = df.columns[i]
+      if 'COMENT' in cu or 'OBSERV' in cu:
+        comments_col = df.columns[i]
+      if cu.strip() == 'AREA':
+        area_col = df.columns[i]
+      # detect tool columns
+      for tn in tool_names:
+        if tn in cu:
+          tool_cols_idx.append(i)
+          break
+
+    # each tool is a pair: the status cell (header = tool name) and the note cell next to it
+    tool_pairs = []
+    for i in tool_cols_idx:
+      tool_name = cols_upper[i].strip()
+      if tool_name not in tool_names:
+        continue
+      note_idx = i + 1 if i + 1 < len(cols_upper) and cols_upper[i + 1].startswith('UNNAMED') else None
+      tool_pairs.append((tool_name, i, note_idx))
+    tool_ids = {t['name'].strip().upper(): t['id'] for t in maquinas_refcache.tools(conn)}
+    for tool_name, _, _ in tool_pairs:
+      if tool_name not in tool_ids:
+        cur = conn.execute("INSERT INTO tools (name, description) VALUES (?,?)", (tool_name, 'Columna de la matriz de condición'))
+        maquinas_events.tool_changed(conn, cur.lastrowid, source='import')
+        tool_ids[tool_name] = cur.lastrowid
+
+    inserted = 0
+    queued = 0
+    # compute excel header row (1-based) and starting data row
+    excel_header_row = header + 1
+    data_start_row = excel_header_row + 1
+    index = maquinas_match.load_index(conn)
+    for idx, row in df.iterrows():
+        name = None
+        code = None
+        notes = ''
+        try:
+            if denom_col:
+                name = str(row.get(denom_col, '')).strip()
+            if codigo_col and pd.notna(row.get(codigo_col)):
+                code = str(row.get(codigo_col)).strip()
+            if comments_col and pd.notna(row.get(comments_col)):
+                notes = str(row.get(comments_col)).strip()
+        except Exception:
+            continue
+
+        if not name and not code:
+            continue
+        # corresponding excel row number
+        excel_row_num = data_start_row + idx
+        if name == 'nan':
+            name = None
+
+        mid, method, candidates = maquinas_match.match(conn, index, code, name)
+        if method == 'review':
+            # nothing written for this row until someone picks the machine in /match/reviews
+            maquinas_match.queue_review(conn, code, name, excel_row_num, candidates)
+            queued += 1
+            continue
+
+        # determine color from excel cell fills if possible
+        detected_color = None
+        detected_hex = None
+        # check all columns for cell fill colors (some headers are merged and show as Unnamed)
+        for col_idx in range(len(df.columns)):
+          try:
+            hex6 = cell_fill_hex(ws.cell(row=excel_row_num, column=col_idx+1))
+            if hex6:
+              try:
+                r = int(hex6[0:2], 16)
+                g = int(hex6[2:4], 16)
+                b = int(hex6[4:6], 16)
+              except Exception:
+                r,g,b = 0,0,0
+              # decide color by dominant channel and keep exact hex
+              hex_exact = hex6
+              # ignore pure white/black
+              if (r, g, b) in ((0,0,0),(255,255,255)):
+                pass
+              elif r > 200 and g < 120 and b < 120:
+                detected_color = 'red'
+                detected_hex = hex_exact
+                break
+              elif r > 200 and g > 150 and b < 150:
+                detected_color = 'yellow'
+                detected_hex = hex_exact
+              elif b > max(r,g) and b > 140:
+                detected_color = 'blue'
+                detected_hex = hex_exact
+              elif g > max(r,b) and g > 140:
+                detected_color = 'green'
+                detected_hex = hex_exact
+          except Exception:
+            continue
+
+        # fallback to criteria-based score if no color detected
+        score, matches = score_row_by_criteria(row, criteria)
+        # scale to 0-10
+        crit_val = maquinas_criteria.criticality(criteria, score)
+
+        # map to priority 1-5
+        priority = 1 + (crit_val * 4 // 10)
+        # if detected_color, override priority with color mapping and record hex
+        if detected_color == 'red':
+          priority = 5
+        elif detected_color == 'yellow':
+          priority = 4
+        elif detected_color == 'blue':
+          priority = 3
+        elif detected_color == 'green':
+          priority = 1
+
+        # upsert machine: the id maquinas_match chose (None = new machine)
+        existing = conn.execute("SELECT * FROM machines WHERE id=?", (mid,)).fetchone() if mid else None
+
+        # determine machine_type value from the row if present
+        machine_type_val = None
+        try:
+          if machine_type_col and pd.notna(row.get(machine_type_col)):
+            machine_type_val = str(row.get(machine_type_col)).strip()
+        except Exception:
+          machine_type_val = None
+        area_val = None
+        if area_col is not None and pd.notna(row.get(area_col)):
+          area_val = excel_text(row.get(area_col))
+
+        if existing:
+          mid = existing['id']
+          # update priority/notes/color unconditionally to reflect Excel exactly
+          try:
+            conn.execute("UPDATE machines SET priority=? WHERE id=?", (priority, mid))
+            # comments already stored (same text) are not added again
+            maquinas_notes.add(conn, mid, notes, source='import')
+            # update color and color_hex
+            if detected_color:
+              conn.execute("UPDATE machines SET color=?, color_hex=? WHERE id=?", (detected_color, detected_hex, mid))
+            else:
+              conn.execute("UPDATE machines SET color=?, color_hex=? WHERE id=?", (None, None, mid))
+            # update machine_type if available
+            if machine_type_val:
+              conn.execute("UPDATE machines SET machine_type=? WHERE id=?", (machine_type_val, mid))
+            # update hac_code if present; the normalized code is unique, so another machine may already own it
+            if code:
+              try:
+                conn.execute("UPDATE machines SET hac_code=? WHERE id=?", (code, mid))
+                maquinas_match.remember(index, mid, code)
+              except sqlite3.IntegrityError:
+                owner = conn.execute(f"SELECT name FROM machines WHERE {maquinas_match.HAC_NORM_SQL.format(col='hac_code')} = ?",
+                                     (maquinas_match.normalize_hac(code),)).fetchone()
+                warnings.append(f"Fila {excel_row_num}: el código HAC {code} ya es de '{owner[0] if owner else '?'}', "
+                                f"no se asignó a '{existing['name']}'")
+            if area_val:
+              conn.execute("UPDATE machines SET area=? WHERE id=?", (area_val, mid))
+          except Exception:
+            pass
+          maquinas_events.machine_changed(conn, mid, existing, source='import')
+        else:
+          # insert
+          name_to_insert = name or code
+          if code and name and conn.execute("SELECT 1 FROM machines WHERE name=?", (name,)).fetchone():
+            # same denomination, different HAC code (e.g. two "TRANSPORTADOR DE CADENA."): names are unique
+            name_to_insert = f"{name} ({code})"
+          cur = conn.execute("INSERT INTO machines (name, priority, machine_group, color, color_hex, machine_type, hac_code, area) VALUES (?,?,?,?,?,?,?,?)", (name_to_insert, priority, 1, detected_color, detected_hex, machine_type_val, code, area_val))
+          mid = cur.lastrowid
+          maquinas_match.remember(index, mid, code, name_to_insert)
+          maquinas_notes.add(conn, mid, notes, source='import')
+          maquinas_events.machine_changed(conn, mid, source='import')
+
+        # insert a measurement marking the computed criticity
+        date = datetime.now().strftime("%Y-%m-%d %H:%M")
+        matches_note = ';'.join([f"{m[0]}:{m[1]}" for m in matches])
+        try:
+          cur = conn.execute("INSERT INTO measurements (machine_id, tool_id, date, criticality, note, criteria_version) VALUES (?,?,?,?,?,?)", (mid, tool_id, date, crit_val, matches_note, criteria.version))
+          maquinas_events.measurement_inserted(conn, cur.lastrowid, source='import')
+          inserted += 1
+        except Exception:
+          pass
+
+        # per-tool status: note text from the pair and severity from its fill
+        for tool_name, status_idx, note_idx in tool_pairs:
+          tool_note = None
+          for i in (note_idx, status_idx):
+            if i is not None and pd.notna(row.iloc[i]) and str(row.iloc[i]).strip():
+              tool_note = str(row.iloc[i]).strip()
+              break
+          tool_severity = None
+          for i in (status_idx, note_idx):
+            if i is not None:
+              tool_severity = maquinas_export.severity_from_hex(cell_fill_hex(ws.cell(row=excel_row_num, column=i+1)))
+              if tool_severity:
+                break
+          if not tool_note and not tool_severity:
+            continue
+          cur = conn.execute("INSERT INTO measurements (machine_id, tool_id, date, criticality, note, severity, repair_time) VALUES (?,?,?,?,?,?,?)",
+                             (mid, tool_ids[tool_name], date, None, tool_note, tool_severity, maquinas_export.REPAIR_TIMES.get(tool_severity)))
+          maquinas_events.measurement_inserted(conn, cur.lastrowid, source='import')
+          inserted += 1
+
+    maquinas_match.close_settled(conn)
+    maquinas_orders.process(conn)
+    maquinas_sparklines.invalidate(conn)
+    maquinas_assets.sync(conn)
+    # "Plan ..." sheets: replaced as a whole, matched to the machines just imported
+    plans = maquinas_plan.import_workbook(conn, wb)
+    conn.commit()
+    maquinas_refcache.written(conn, 'tools', 'machines')
+    # a bulk import touches most series: one batch pass over the whole fleet
+    maquinas_analytics.run_detection(conn)
+    maquinas_forecast.refit(conn)
+    planned = sum(total for total, _ in plans.values())
+    return {'inserted': inserted, 'planned': planned, 'review': queued, 'warnings': warnings}
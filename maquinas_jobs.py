@@ -0,0 +1,500 @@
+"""
+Tareas programadas (snapshot, archivo, alertas, pronósticos, agregados, órdenes de trabajo, informe PDF)
+- horarios tipo cron ("min hora día mes día_semana"), configurables con MAQUINAS_JOB_<NOMBRE> ("off" la desactiva)
+- el estado de cada tarea vive en la tabla jobs de cada planta; cada ejecución queda en job_runs con su duración
+- cada worker del servidor revisa las tareas pendientes, pero solo uno toma cada ejecución: la fila de la tarea
+  funciona de bloqueo (locked_by / locked_until), y si el worker muere el bloqueo vence solo
+- la tarea corre en un proceso aparte con prioridad baja y tiempo máximo; al vencer se termina el proceso,
+  así el lote nocturno no compite con las requests por el GIL
+
+Uso:
+    python maquinas_jobs.py [machines.db] [--run NOMBRE] [--loop]    (sin opciones: estado de cada tarea)
+"""
+
+import argparse
+import importlib.util
+import multiprocessing
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+POLL_SECONDS = int(os.environ.get("MAQUINAS_JOBS_POLL", "30"))
+# extra lease over the job's timeout before another worker may take a stuck lock
+LOCK_GRACE = 120
+RUNS_KEEP = 200
+TS = "%Y-%m-%d %H:%M:%S"
+
+Job = namedtuple('Job', 'schedule timeout description run')
+
+_CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+_CRON_ALIASES = {'@hourly': '0 * * * *', '@daily': '0 0 * * *', '@nightly': '0 0 * * *',
+                 '@weekly': '0 0 * * 0', '@monthly': '0 0 1 * *'}
+
+_thread = None
+_stop = threading.Event()
+_state_lock = threading.Lock()
+_running = None
+
+
+# ---- cron ----
+
+def parse_cron(expr):
+    # -> (minutes, hours, days, months, weekdays, day_any, weekday_any); weekday 0 and 7 = domingo
+    parts = _CRON_ALIASES.get(expr.strip(), expr).split()
+    if len(parts) != 5:
+        raise ValueError(f"horario inválido '{expr}': se esperan 5 campos")
+    sets = []
+    for part, (lo, hi) in zip(parts, _CRON_FIELDS):
+        values = set()
+        for item in part.split(','):
+            rng, _, step = item.partition('/')
+            step = int(step) if step else 1
+            if rng == '*':
+                a, b = lo, hi
+            elif '-' in rng:
+                a, b = (int(x) for x in rng.split('-', 1))
+            else:
+                a = int(rng)
+                b = hi if step > 1 else a
+            if step < 1 or a < lo or b > hi or a > b:
+                raise ValueError(f"horario inválido '{expr}': '{item}' fuera de rango")
+            values.update(range(a, b + 1, step))
+        sets.append(values)
+    if 7 in sets[4]:
+        sets[4] = (sets[4] - {7}) | {0}
+    return (*(frozenset(s) for s in sets), parts[2] == '*', parts[4] == '*')
+
+
+def _day_matches(cron, dt):
+    _, _, days, _, weekdays, day_any, weekday_any = cron
+    in_days = dt.day in days
+    in_weekdays = (dt.weekday() + 1) % 7 in weekdays
+    # cron rule: with both fields restricted, either one is enough
+    if not day_any and not weekday_any:
+        return in_days or in_weekdays
+    return in_days and in_weekdays
+
+
+def next_run(expr, after):
+    # first minute strictly after `after` that matches; skips whole months/days/hours that can't match
+    cron = parse_cron(expr) if isinstance(expr, str) else expr
+    minutes, hours, _, months = cron[:4]
+    dt = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = dt + timedelta(days=366 * 5)
+    while dt < limit:
+        if dt.month not in months:
+            dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+        elif not _day_matches(cron, dt):
+            dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+        elif dt.hour not in hours:
+            dt = dt.replace(minute=0) + timedelta(hours=1)
+        elif dt.minute not in minutes:
+            dt += timedelta(minutes=1)
+        else:
+            return dt
+    raise ValueError(f"el horario '{expr}' nunca se cumple")
+
+
+# ---- tareas ----
+
+def _connect(db_file):
+    conn = sqlite3.connect(db_file, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _job_snapshot(db_file):
+    import maquinas_snapshot
+    path, archives, removed = maquinas_snapshot.scheduled_snapshot(db_file)
+    return f"{os.path.basename(path)} + {len(archives)} archivos, {len(removed)} eliminados"
+
+
+def _job_archive(db_file):
+    import maquinas_archive
+    conn = _connect(db_file)
+    try:
+        moved = maquinas_archive.archive_measurements(conn)
+    finally:
+        conn.close()
+    return f"{sum(moved.values())} mediciones archivadas"
+
+
+def _job_analytics(db_file):
+    import maquinas_analytics
+    conn = _connect(db_file)
+    try:
+        opened, closed = maquinas_analytics.run_detection(conn)
+    finally:
+        conn.close()
+    return f"{opened} alertas nuevas, {closed} cerradas"
+
+
+def _job_forecast(db_file):
+    import maquinas_forecast
+    conn = _connect(db_file)
+    try:
+        refitted = maquinas_forecast.refit(conn, full=True)
+    finally:
+        conn.close()
+    return f"{refitted} series recalculadas"
+
+
+def _job_rollups(db_file):
+    import maquinas_assets
+    conn = _connect(db_file)
+    try:
+        # whole plant, so "overdue" ages even without new measurements
+        maquinas_assets.refresh_rollups(conn)
+        conn.commit()
+    finally:
+        conn.close()
+    return "agregados recalculados"
+
+
+def _job_attachments(db_file):
+    import maquinas_attachments
+    conn = _connect(db_file)
+    try:
+        removed = maquinas_attachments.gc(conn, sweep=True)
+    finally:
+        conn.close()
+    return f"{removed} archivos adjuntos sin uso eliminados"
+
+
+def _job_orders(db_file):
+    import maquinas_orders
+    conn = _connect(db_file)
+    try:
+        # readings written by scripts or tools that bypass the web routes
+        opened, closed = maquinas_orders.process(conn)
+        conn.commit()
+        c = maquinas_orders.counts(conn)
+    finally:
+        conn.close()
+    return f"{opened} órdenes abiertas, {closed} cerradas, {c['overdue']} vencidas"
+
+
+def report_dir(db_file):
+    default = os.path.join(os.path.dirname(os.path.abspath(db_file)), "reports")
+    return os.environ.get("MAQUINAS_REPORT_DIR", default)
+
+
+def _job_report(db_file):
+    # scripts/ is not a package; load generate_report.py from its path
+    spec = importlib.util.spec_from_file_location("generate_report", os.path.join(ROOT, "scripts", "generate_report.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    base = os.path.splitext(os.path.basename(db_file))[0]
+    out = os.path.join(report_dir(db_file), f"{base}_{datetime.now().strftime('%Y%m%d')}.pdf")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    # in-memory copy of the DB and a single render process: the web workers keep the CPUs
+    code = module.main(['--db', db_file, '--memory', '--out', out, '--jobs', '1'])
+    if code:
+        raise RuntimeError(f"generate_report terminó con código {code}")
+    return os.path.basename(out)
+
+
+JOBS = {
+    'snapshot': Job('30 2 * * *', 1800, "Snapshot de la base con retención", _job_snapshot),
+    'archive': Job('0 3 * * 0', 3600, "Archivo por año de mediciones antiguas", _job_archive),
+    'analytics': Job('15 3 * * *', 1800, "Detección de problemas emergentes en toda la flota", _job_analytics),
+    'forecast': Job('30 3 * * *', 1800, "Recalcular todos los pronósticos", _job_forecast),
+    'rollups': Job('45 3 * * *', 900, "Agregados de la jerarquía de activos", _job_rollups),
+    'attachments': Job('0 4 * * *', 900, "Limpieza de archivos adjuntos sin uso", _job_attachments),
+    'orders': Job('*/15 * * * *', 300, "Órdenes de trabajo de mediciones escritas fuera de la web", _job_orders),
+    'report': Job('0 5 * * 1', 3600, "Informe PDF semanal", _job_report),
+}
+
+
+def schedule_for(name):
+    # MAQUINAS_JOB_SNAPSHOT="0 1 * * *" changes the time, "off" disables it
+    value = os.environ.get(f"MAQUINAS_JOB_{name.upper()}", JOBS[name].schedule).strip()
+    return None if value.lower() in ("off", "0", "") else value
+
+
+# ---- estado en la base ----
+
+def ensure_schema(conn):
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        name TEXT PRIMARY KEY,
+        schedule TEXT NOT NULL,
+        enabled INTEGER NOT NULL DEFAULT 1,
+        timeout INTEGER NOT NULL,
+        next_run_at TEXT,
+        locked_by TEXT,
+        locked_until TEXT,
+        last_status TEXT,
+        last_started_at TEXT,
+        last_finished_at TEXT,
+        last_duration REAL,
+        last_message TEXT
+    );
+    CREATE TABLE IF NOT EXISTS job_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job TEXT NOT NULL,
+        worker TEXT,
+        started_at TEXT NOT NULL,
+        finished_at TEXT,
+        status TEXT NOT NULL,
+        duration REAL,
+        message TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_job_runs_job ON job_runs(job, id);
+    """)
+    register(conn)
+
+
+def register(conn, now=None):
+    # code defines the jobs; a changed schedule gets a new next_run_at, state is kept
+    now = now or datetime.now()
+    for name, job in JOBS.items():
+        schedule = schedule_for(name)
+        row = conn.execute("SELECT schedule, enabled FROM jobs WHERE name=?", (name,)).fetchone()
+        enabled = 1 if schedule else 0
+        schedule = schedule or job.schedule
+        if row is None:
+            conn.execute("INSERT INTO jobs (name, schedule, enabled, timeout, next_run_at) VALUES (?,?,?,?,?)",
+                         (name, schedule, enabled, job.timeout, next_run(schedule, now).strftime(TS)))
+        elif row[0] != schedule or row[1] != enabled:
+            conn.execute("UPDATE jobs SET schedule=?, enabled=?, timeout=?, next_run_at=? WHERE name=?",
+                         (schedule, enabled, job.timeout, next_run(schedule, now).strftime(TS), name))
+        else:
+            conn.execute("UPDATE jobs SET timeout=? WHERE name=?", (job.timeout, name))
+
+
+def due(conn, now=None):
+    now = (now or datetime.now()).strftime(TS)
+    return [r[0] for r in conn.execute(
+        "SELECT name FROM jobs WHERE enabled=1 AND next_run_at <= ? AND (locked_until IS NULL OR locked_until < ?) ORDER BY next_run_at",
+        (now, now))]
+
+
+def claim(conn, name, worker, now=None):
+    # the conditional UPDATE is the lock: of all workers polling, exactly one gets rowcount 1
+    now = now or datetime.now()
+    timeout = conn.execute("SELECT timeout FROM jobs WHERE name=?", (name,)).fetchone()[0]
+    cur = conn.execute("""
+        UPDATE jobs SET locked_by=?, locked_until=?, last_started_at=?
+        WHERE name=? AND enabled=1 AND next_run_at <= ? AND (locked_until IS NULL OR locked_until < ?)
+    """, (worker, (now + timedelta(seconds=timeout + LOCK_GRACE)).strftime(TS), now.strftime(TS),
+          name, now.strftime(TS), now.strftime(TS)))
+    if cur.rowcount != 1:
+        conn.rollback()
+        return None
+    run_id = conn.execute("INSERT INTO job_runs (job, worker, started_at, status) VALUES (?,?,?,'running')",
+                          (name, worker, now.strftime(TS))).lastrowid
+    conn.commit()
+    return run_id
+
+
+def finish(conn, name, run_id, status, duration, message, retry=False):
+    now = datetime.now()
+    schedule = conn.execute("SELECT schedule FROM jobs WHERE name=?", (name,)).fetchone()[0]
+    # an aborted run (worker shutting down) stays due so another worker picks it up
+    next_at = None if retry else next_run(schedule, now).strftime(TS)
+    conn.execute("""
+        UPDATE jobs SET locked_by=NULL, locked_until=NULL, next_run_at=COALESCE(?, next_run_at),
+               last_status=?, last_finished_at=?, last_duration=?, last_message=?
+        WHERE name=?
+    """, (next_at, status, now.strftime(TS), duration, message, name))
+    conn.execute("UPDATE job_runs SET finished_at=?, status=?, duration=?, message=? WHERE id=?",
+                 (now.strftime(TS), status, duration, message, run_id))
+    conn.execute("DELETE FROM job_runs WHERE job=? AND id <= (SELECT id FROM job_runs WHERE job=? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                 (name, name, RUNS_KEEP))
+    conn.commit()
+
+
+def run_now(conn, name):
+    # "ejecutar ahora": the next poll of any worker takes it
+    cur = conn.execute("UPDATE jobs SET next_run_at=? WHERE name=? AND enabled=1", (datetime.now().strftime(TS), name))
+    conn.commit()
+    return cur.rowcount == 1
+
+
+def status(conn):
+    # one row per job with duration metrics over the kept runs
+    rows = conn.execute("""
+        SELECT j.name, j.schedule, j.enabled, j.timeout, j.next_run_at, j.locked_by, j.locked_until,
+               j.last_status, j.last_started_at, j.last_finished_at, j.last_duration, j.last_message,
+               COALESCE(r.runs, 0) AS runs, COALESCE(r.failures, 0) AS failures,
+               r.avg_duration, r.max_duration
+        FROM jobs j
+        LEFT JOIN (
+            SELECT job, COUNT(*) AS runs, SUM(status != 'ok') AS failures,
+                   ROUND(AVG(duration), 3) AS avg_duration, ROUND(MAX(duration), 3) AS max_duration
+            FROM job_runs WHERE status != 'running' GROUP BY job
+        ) r ON r.job = j.name
+        ORDER BY j.next_run_at
+    """).fetchall()
+    out = []
+    for r in rows:
+        d = dict(r)
+        d['description'] = JOBS[r['name']].description if r['name'] in JOBS else None
+        d['running'] = r['locked_by'] is not None
+        out.append(d)
+    return out
+
+
+def runs(conn, name, limit=50):
+    return conn.execute("SELECT id, worker, started_at, finished_at, status, duration, message FROM job_runs "
+                        "WHERE job=? ORDER BY id DESC LIMIT ?", (name, limit)).fetchall()
+
+
+# ---- ejecución ----
+
+def _child(name, db_file, pipe):
+    # separate process: its own GIL and lower CPU priority than the web workers
+    if hasattr(os, "nice"):
+        os.nice(10)
+    try:
+        pipe.send(('ok', JOBS[name].run(db_file)))
+    except Exception as e:
+        pipe.send(('error', f"{type(e).__name__}: {e}"))
+    finally:
+        pipe.close()
+
+
+def execute(db_file, name, timeout):
+    # -> (status, message); status: ok | error | timeout | aborted
+    global _running
+    ctx = multiprocessing.get_context("spawn")
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_child, args=(name, db_file, send), name=f"maquinas-job-{name}")
+    with _state_lock:
+        if _stop.is_set():
+            return 'aborted', "worker apagándose"
+        proc.start()
+        _running = proc
+    send.close()
+    try:
+        proc.join(timeout)
+        if proc.is_alive():
+            proc.terminate()
+            proc.join(10)
+            if _stop.is_set():
+                return 'aborted', "worker apagándose"
+            return 'timeout', f"superó {timeout} s"
+        if recv.poll():
+            try:
+                return recv.recv()
+            except EOFError:
+                # the child died (terminated by stop(), os._exit, a crash) before sending a result
+                pass
+        if _stop.is_set():
+            return 'aborted', "worker apagándose"
+        return 'error', f"el proceso terminó con código {proc.exitcode}"
+    finally:
+        with _state_lock:
+            _running = None
+        recv.close()
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def tick(db_file, worker=None, now=None):
+    # one pass: run every due job this worker manages to claim; -> [(name, status, message)]
+    worker = worker or worker_id()
+    done = []
+    conn = _connect(db_file)
+    try:
+        for name in due(conn, now):
+            if name not in JOBS or _stop.is_set():
+                continue
+            run_id = claim(conn, name, worker, now)
+            if run_id is None:
+                continue
+            timeout = conn.execute("SELECT timeout FROM jobs WHERE name=?", (name,)).fetchone()[0]
+            started = time.perf_counter()
+            result, message = execute(db_file, name, timeout)
+            duration = round(time.perf_counter() - started, 3)
+            finish(conn, name, run_id, result, duration, message, retry=(result == 'aborted'))
+            done.append((name, result, message))
+    finally:
+        conn.close()
+    return done
+
+
+def _loop(db_files, worker, poll):
+    while not _stop.wait(poll):
+        for db_file in db_files:
+            try:
+                tick(db_file, worker)
+            except sqlite3.Error as e:
+                # busy database or missing file: try again on the next poll
+                print(f"Tareas programadas ({db_file}): {e}")
+            except Exception as e:
+                # anything else must not kill the scheduler thread for the life of the worker
+                print(f"Tareas programadas ({db_file}): {type(e).__name__}: {e}")
+
+
+def start(db_files, poll=POLL_SECONDS):
+    # one scheduler thread per web worker process; the lock rows keep runs unique
+    global _thread
+    with _state_lock:
+        if _thread is not None and _thread.is_alive():
+            return _thread
+        _stop.clear()
+        _thread = threading.Thread(target=_loop, args=(list(db_files), worker_id(), poll), name="maquinas-jobs", daemon=True)
+        _thread.start()
+        return _thread
+
+
+def stop(timeout=10):
+    # worker shutdown: a running job is terminated and stays due for another worker
+    _stop.set()
+    with _state_lock:
+        proc = _running
+    if proc is not None and proc.is_alive():
+        proc.terminate()
+    if _thread is not None:
+        _thread.join(timeout)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Tareas programadas del Monitor de Condición")
+    p.add_argument("db", nargs="?", default="machines.db")
+    p.add_argument("--run", metavar="NOMBRE", help="ejecutar una tarea ahora (respeta el bloqueo)")
+    p.add_argument("--loop", action="store_true", help="quedar revisando las tareas pendientes (sin servidor web)")
+    args = p.parse_args(argv)
+    conn = _connect(args.db)
+    ensure_schema(conn)
+    conn.commit()
+    if args.run:
+        if args.run not in JOBS:
+            print(f"Tarea desconocida: {args.run} ({', '.join(JOBS)})")
+            return 2
+        run_now(conn, args.run)
+        conn.close()
+        for name, result, message in tick(args.db):
+            print(f"{'✓' if result == 'ok' else '✗'} {name}: {result} - {message}")
+        return 0
+    if args.loop:
+        conn.close()
+        print(f"Revisando tareas cada {POLL_SECONDS} s (Ctrl+C para salir)")
+        try:
+            while True:
+                for name, result, message in tick(args.db):
+                    print(f"{datetime.now().strftime(TS)} {name}: {result} - {message}")
+                time.sleep(POLL_SECONDS)
+        except KeyboardInterrupt:
+            return 0
+    for job in status(conn):
+        state = "en curso" if job['running'] else (job['last_status'] or "-")
+        enabled = job['schedule'] if job['enabled'] else "desactivada"
+        print(f"{job['name']:<10} {enabled:<14} próxima {job['next_run_at'] or '-':<19}  última {state}"
+              f" ({job['last_duration'] if job['last_duration'] is not None else '-'} s, promedio {job['avg_duration'] or '-'} s)")
+    conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
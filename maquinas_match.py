@@ -0,0 +1,385 @@
+"""
+Asociación de filas del Excel con máquinas
+- código HAC normalizado (sin espacios, mayúsculas) con índice único: "CS.211-TP1" ya no coincide con "CS.211-TP10"
+- denominación normalizada (sin tildes, signos ni espacios repetidos) para la coincidencia exacta por nombre
+- índice de trigramas de las denominaciones para proponer candidatos parecidos, con puntaje
+- un código HAC que ninguna máquina tiene es una máquina nueva (salvo una sin código casi idéntica)
+- las filas sin código con coincidencia dudosa van a una cola de revisión; la decisión queda guardada
+
+Uso:
+    python maquinas_match.py [machines.db] [--reindex]
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import sqlite3
+import string
+import unicodedata
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+
+# same expression in the index and in every lookup, so SQLite can use the index
+HAC_NORM_SQL = "NULLIF(UPPER(REPLACE({col}, ' ', '')), '')"
+# fuzzy: best candidate taken as is above AUTO_SCORE and MARGIN ahead of the second; review above MIN_SCORE
+AUTO_SCORE = float(os.environ.get("MAQUINAS_MATCH_AUTO", "0.9"))
+MIN_SCORE = float(os.environ.get("MAQUINAS_MATCH_MIN", "0.5"))
+MARGIN = 0.1
+CANDIDATES = 5
+# SQLite's UPPER() only folds ASCII; the Python side must fold exactly the same letters
+_ASCII_UPPER = str.maketrans(string.ascii_lowercase, string.ascii_uppercase)
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+Index = namedtuple('Index', 'by_hac by_name hac_of aliases postings open_postings grams arrays')
+_EMPTY = np.zeros(0, dtype=np.int64)
+
+
+def normalize_hac(code):
+    if code is None:
+        return None
+    return str(code).replace(" ", "").translate(_ASCII_UPPER) or None
+
+
+def normalize_name(text):
+    # "Cinta  transportadora Nº 3 " -> "cinta transportadora n 3"
+    text = unicodedata.normalize("NFKD", str(text or "")).encode("ascii", "ignore").decode().lower()
+    return _NON_ALNUM.sub(" ", text).strip()
+
+
+def trigrams(norm):
+    padded = f"  {norm} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)} if norm else set()
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS machine_names (
+        machine_id INTEGER PRIMARY KEY,
+        norm TEXT NOT NULL,
+        grams INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_machine_names_norm ON machine_names(norm);
+    CREATE TABLE IF NOT EXISTS machine_trigrams (
+        trigram TEXT NOT NULL,
+        machine_id INTEGER NOT NULL,
+        PRIMARY KEY (trigram, machine_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS match_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        machines_version INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS match_aliases (
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL,
+        machine_id INTEGER,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (kind, key)
+    );
+    CREATE TABLE IF NOT EXISTS match_reviews (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        hac_code TEXT,
+        name TEXT,
+        key TEXT NOT NULL UNIQUE,
+        source_row INTEGER,
+        candidates TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        machine_id INTEGER,
+        created_at TEXT NOT NULL,
+        resolved_at TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_match_reviews_status ON match_reviews(status, id);
+    """)
+    expr = HAC_NORM_SQL.format(col="hac_code")
+    if not duplicate_codes(conn):
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_machines_hac_unique ON machines({expr})")
+        conn.execute("DROP INDEX IF EXISTS idx_machines_hac_norm")
+    elif not conn.execute("SELECT 1 FROM sqlite_master WHERE name='idx_machines_hac_unique'").fetchone():
+        # existing duplicates must be fixed by hand first; lookups stay indexed meanwhile
+        conn.execute("DROP INDEX IF EXISTS idx_machines_hac_norm")
+        conn.execute(f"CREATE INDEX idx_machines_hac_norm ON machines({expr})")
+        print("! Códigos HAC repetidos, índice único pendiente: " + ", ".join(duplicate_codes(conn)[:10]))
+
+
+def duplicate_codes(conn):
+    expr = HAC_NORM_SQL.format(col="hac_code")
+    return [r[0] for r in conn.execute(
+        f"SELECT {expr} AS code FROM machines WHERE {expr} IS NOT NULL GROUP BY code HAVING COUNT(*) > 1 ORDER BY code")]
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _machines_version(conn):
+    # counter kept by the maquinas_refcache triggers (name, HAC, type or area changed)
+    row = conn.execute("SELECT version FROM ref_versions WHERE name='machines'").fetchone()
+    return row[0] if row else 0
+
+
+def index_machine(conn, machine_id, name):
+    norm = normalize_name(name)
+    grams = trigrams(norm)
+    conn.execute("DELETE FROM machine_trigrams WHERE machine_id=?", (machine_id,))
+    conn.execute("INSERT OR REPLACE INTO machine_names (machine_id, norm, grams) VALUES (?,?,?)", (machine_id, norm, len(grams)))
+    conn.executemany("INSERT INTO machine_trigrams (trigram, machine_id) VALUES (?,?)", [(g, machine_id) for g in grams])
+
+
+def reindex(conn):
+    conn.execute("DELETE FROM machine_trigrams")
+    conn.execute("DELETE FROM machine_names")
+    rows = conn.execute("SELECT id, name FROM machines").fetchall()
+    names, grams = [], []
+    for mid, name in rows:
+        norm = normalize_name(name)
+        g = trigrams(norm)
+        names.append((mid, norm, len(g)))
+        grams.extend((t, mid) for t in g)
+    conn.executemany("INSERT INTO machine_names (machine_id, norm, grams) VALUES (?,?,?)", names)
+    conn.executemany("INSERT INTO machine_trigrams (trigram, machine_id) VALUES (?,?)", grams)
+    mark_indexed(conn)
+    return len(rows)
+
+
+def mark_indexed(conn):
+    conn.execute("INSERT OR REPLACE INTO match_state (id, machines_version) VALUES (1, ?)", (_machines_version(conn),))
+
+
+def ensure_index(conn):
+    # machines renamed, added or deleted anywhere since the last build -> rebuild (one pass, no per-row work)
+    row = conn.execute("SELECT machines_version FROM match_state WHERE id=1").fetchone()
+    if row is None or row[0] != _machines_version(conn):
+        return reindex(conn)
+    return 0
+
+
+def load_index(conn):
+    # in-memory maps for a whole import: exact lookups are dict probes, fuzzy ones walk the trigram postings.
+    # postings: every machine (rows without a code); open_postings: machines without a code, the only
+    # fuzzy candidates for a row whose code no machine has
+    ensure_index(conn)
+    by_hac, hac_of, by_name = {}, {}, {}
+    for mid, code, norm in conn.execute(f"""
+            SELECT m.id, {HAC_NORM_SQL.format(col='m.hac_code')}, n.norm
+            FROM machines m LEFT JOIN machine_names n ON n.machine_id = m.id"""):
+        if code:
+            by_hac.setdefault(code, mid)
+            hac_of[mid] = code
+        if norm:
+            by_name.setdefault(norm, []).append(mid)
+    grams = {}
+    for gram, mid in conn.execute("SELECT trigram, machine_id FROM machine_trigrams"):
+        grams.setdefault(mid, set()).add(gram)
+    postings, open_postings = {}, {}
+    for mid, gs in grams.items():
+        for gram in gs:
+            postings.setdefault(gram, set()).add(mid)
+            if mid not in hac_of:
+                open_postings.setdefault(gram, set()).add(mid)
+    aliases = {(kind, key): mid for kind, key, mid in conn.execute("SELECT kind, key, machine_id FROM match_aliases")}
+    return Index(by_hac, by_name, hac_of, aliases, postings, open_postings, grams, {})
+
+
+def remember(index, machine_id, code, name=None):
+    # a machine created or given its HAC code during the import: later rows of the same workbook see it
+    code = normalize_hac(code)
+    norm = normalize_name(name)
+    if norm and machine_id not in index.by_name.get(norm, ()):
+        index.by_name.setdefault(norm, []).append(machine_id)
+        index.grams[machine_id] = trigrams(norm)
+        sizes = index.arrays.get('sizes')
+        if sizes is not None:
+            if machine_id >= len(sizes):
+                sizes = index.arrays['sizes'] = np.concatenate([sizes, np.zeros(max(machine_id + 1 - len(sizes), len(sizes)))])
+            sizes[machine_id] = len(index.grams[machine_id])
+        for gram in index.grams[machine_id]:
+            index.postings.setdefault(gram, set()).add(machine_id)
+            _posting_changed(index, 'all', gram, machine_id, True)
+            if not code and machine_id not in index.hac_of:
+                index.open_postings.setdefault(gram, set()).add(machine_id)
+                _posting_changed(index, 'open', gram, machine_id, True)
+    if code:
+        index.by_hac.setdefault(code, machine_id)
+        index.hac_of[machine_id] = code
+        # coded now: no longer a candidate for rows with some other code
+        for gram in index.grams.get(machine_id, ()):
+            if machine_id in index.open_postings.get(gram, ()):
+                index.open_postings[gram].discard(machine_id)
+                _posting_changed(index, 'open', gram, machine_id, False)
+
+
+def _posting_changed(index, which, gram, machine_id, added):
+    # keep an already built array in step (C-level copy) instead of rebuilding it from the set
+    arr = index.arrays.get((which, gram))
+    if arr is not None:
+        index.arrays[(which, gram)] = np.append(arr, machine_id) if added else arr[arr != machine_id]
+
+
+def _posting_array(index, which, gram):
+    # postings as int arrays, built on first use and kept in step by remember()
+    arr = index.arrays.get((which, gram))
+    if arr is None:
+        ids = (index.open_postings if which == 'open' else index.postings).get(gram)
+        arr = index.arrays[(which, gram)] = np.fromiter(ids, dtype=np.int64, count=len(ids)) if ids else _EMPTY
+    return arr
+
+
+def _sizes(index):
+    # trigram count per machine id, as an array the scores can be computed against
+    arr = index.arrays.get('sizes')
+    if arr is None:
+        arr = np.zeros(max(index.grams, default=0) + 1, dtype=np.float64)
+        for mid, gs in index.grams.items():
+            arr[mid] = len(gs)
+        index.arrays['sizes'] = arr
+    return arr
+
+
+def _indexed_candidates(index, grams, code, limit):
+    # shared-trigram counts and scores for every machine at once (bincount over the postings, no
+    # per-machine Python work); rows with a code only look at machines without one, so a first
+    # import of coded rows does next to nothing
+    which = 'open' if code else 'all'
+    arrays = [a for a in (_posting_array(index, which, g) for g in grams) if len(a)]
+    if not arrays:
+        return []
+    counts = np.bincount(np.concatenate(arrays))
+    hits = np.nonzero(counts)[0]
+    scores = np.round(2.0 * counts[hits] / (len(grams) + _sizes(index)[hits]), 3)
+    keep = scores >= MIN_SCORE
+    hits, scores = hits[keep], scores[keep]
+    # best first, ties by id so the order does not depend on set iteration
+    order = np.lexsort((hits, -scores))[:limit]
+    return [(int(hits[i]), float(scores[i])) for i in order]
+
+
+def candidates(conn, name, code=None, limit=CANDIDATES, index=None):
+    # -> [(machine_id, score)] best first; score = Dice coefficient of the name trigrams
+    grams = trigrams(normalize_name(name))
+    if not grams:
+        return []
+    if index is not None:
+        return _indexed_candidates(index, grams, normalize_hac(code), limit)
+    rows = conn.execute(f"""
+        SELECT t.machine_id, COUNT(*), n.grams, {HAC_NORM_SQL.format(col='m.hac_code')}
+        FROM machine_trigrams t
+        JOIN machine_names n ON n.machine_id = t.machine_id
+        JOIN machines m ON m.id = t.machine_id
+        WHERE t.trigram IN ({','.join('?' * len(grams))})
+        GROUP BY t.machine_id
+    """, sorted(grams)).fetchall()
+    code = normalize_hac(code)
+    out = []
+    for mid, count, total, other in rows:
+        # a machine with a different HAC code is a different machine, however similar its name
+        if code and other and other != code:
+            continue
+        out.append((mid, round(2.0 * count / (len(grams) + total), 3)))
+    out.sort(key=lambda c: -c[1])
+    return out[:limit]
+
+
+def review_key(code, name):
+    return f"{normalize_hac(code) or ''}|{normalize_name(name)}"
+
+
+def match(conn, index, code, name):
+    # -> (machine_id or None, method, candidates); method: hac | alias | name | fuzzy | new | review
+    hac = normalize_hac(code)
+    norm = normalize_name(name)
+    if hac and hac in index.by_hac:
+        return index.by_hac[hac], 'hac', []
+    key = review_key(code, name)
+    if ('row', key) in index.aliases:
+        mid = index.aliases[('row', key)]
+        return mid, ('alias' if mid else 'new'), []
+    same_name = [m for m in index.by_name.get(norm, []) if not (hac and index.hac_of.get(m) not in (None, hac))]
+    if len(same_name) == 1:
+        return same_name[0], 'name', []
+    cands = candidates(conn, name, code, index=index) if norm else []
+    if len(same_name) > 1:
+        # two machines with the same denomination: only a person can tell which one
+        return None, 'review', [(m, 1.0) for m in same_name]
+    if not cands or cands[0][1] < MIN_SCORE:
+        return None, 'new', cands
+    second = cands[1][1] if len(cands) > 1 else 0
+    if cands[0][1] >= AUTO_SCORE and cands[0][1] - second >= MARGIN:
+        return cands[0][0], 'fuzzy', cands
+    if hac:
+        # a code no machine has already names a new machine; a merely similar denomination
+        # (possibly of a machine that gets its own code further down the sheet) is not a reason to hold the row
+        return None, 'new', cands
+    return None, 'review', cands
+
+
+def queue_review(conn, code, name, source_row, cands):
+    conn.execute("""
+        INSERT INTO match_reviews (hac_code, name, key, source_row, candidates, created_at) VALUES (?,?,?,?,?,?)
+        ON CONFLICT(key) DO UPDATE SET source_row=excluded.source_row, candidates=excluded.candidates,
+            status='pending', machine_id=NULL, resolved_at=NULL
+    """, (code, name, review_key(code, name), source_row, json.dumps(cands), _now()))
+
+
+def close_settled(conn):
+    # rows queued earlier whose HAC code now belongs to a machine (created or coded since): nothing to decide
+    expr = HAC_NORM_SQL.format(col="hac_code")
+    return conn.execute(f"""
+        UPDATE match_reviews SET status='settled', resolved_at=?
+        WHERE status='pending' AND {expr} IN (SELECT {expr} FROM machines)
+    """, (_now(),)).rowcount
+
+
+def pending_reviews(conn, limit=500):
+    rows = conn.execute("SELECT * FROM match_reviews WHERE status='pending' ORDER BY id LIMIT ?", (limit,)).fetchall()
+    ids = {mid for r in rows for mid, _ in json.loads(r['candidates'])}
+    machines = {}
+    if ids:
+        machines = {m['id']: m for m in conn.execute(
+            f"SELECT id, name, hac_code, machine_type, area FROM machines WHERE id IN ({','.join('?' * len(ids))})", list(ids))}
+    out = []
+    for r in rows:
+        cands = [dict(machines[mid], score=score) for mid, score in json.loads(r['candidates']) if mid in machines]
+        out.append(dict(r, candidates=cands))
+    return out
+
+
+def resolve(conn, review_id, machine_id=None):
+    # machine_id None = "es una máquina nueva": the next import creates it without asking again
+    row = conn.execute("SELECT key FROM match_reviews WHERE id=? AND status='pending'", (review_id,)).fetchone()
+    if row is None:
+        return False
+    conn.execute("INSERT OR REPLACE INTO match_aliases (kind, key, machine_id, created_at) VALUES ('row', ?, ?, ?)",
+                 (row[0], machine_id, _now()))
+    conn.execute("UPDATE match_reviews SET status=?, machine_id=?, resolved_at=? WHERE id=?",
+                 ('matched' if machine_id else 'new', machine_id, _now(), review_id))
+    return True
+
+
+def forget_machine(conn, machine_id):
+    # deleted machine: its index rows and the decisions that pointed to it
+    conn.execute("DELETE FROM machine_trigrams WHERE machine_id=?", (machine_id,))
+    conn.execute("DELETE FROM machine_names WHERE machine_id=?", (machine_id,))
+    conn.execute("DELETE FROM match_aliases WHERE machine_id=?", (machine_id,))
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Índice de códigos HAC y denominaciones para asociar filas del Excel")
+    p.add_argument("db", nargs="?", default="machines.db")
+    p.add_argument("--reindex", action="store_true", help="reconstruir el índice de trigramas")
+    args = p.parse_args(argv)
+    conn = sqlite3.connect(args.db, timeout=30)
+    conn.row_factory = sqlite3.Row
+    ensure_schema(conn)
+    count = reindex(conn) if args.reindex else ensure_index(conn)
+    conn.commit()
+    dups = duplicate_codes(conn)
+    pending = conn.execute("SELECT COUNT(*) FROM match_reviews WHERE status='pending'").fetchone()[0]
+    print(f"✓ {count} máquinas indexadas, {len(dups)} códigos HAC repetidos, {pending} filas para revisar")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Notas de máquinas como entradas separadas (machine_notes)
+- cada comentario del Excel o de la web se parte en entradas ("HECHO: ..." empieza una nueva)
+- cada entrada se guarda una sola vez por máquina (hash del texto normalizado): reimportar no duplica
+- machines.notes queda como resumen corto (la última entrada) para listas y tarjetas
+- compactación única de las notas ya infladas por importaciones anteriores
+
+Uso:
+    python maquinas_notes.py [machines.db] [--vacuum]
+"""
+
+import argparse
+import hashlib
+import re
+import sqlite3
+from datetime import datetime
+
+import maquinas_events
+
+SUMMARY_CHARS = 160
+# an entry starts at each "HECHO:" (any case, start of a line or after a separator)
+_ENTRY_START = re.compile(r"(?:^|(?<=[\n;.]))\s*(?=HECHO\s*:)", re.IGNORECASE)
+_SPACES = re.compile(r"\s+")
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS machine_notes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        machine_id INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        hash TEXT NOT NULL,
+        body TEXT NOT NULL,
+        source TEXT,
+        created_at TEXT NOT NULL,
+        last_seen_at TEXT NOT NULL,
+        UNIQUE (machine_id, hash)
+    );
+    CREATE INDEX IF NOT EXISTS idx_machine_notes_machine ON machine_notes(machine_id, version);
+    """)
+
+
+def split_entries(text):
+    # "obs general\nHECHO: a\nHECHO: b" -> ["obs general", "HECHO: a", "HECHO: b"]
+    text = (text or "").replace("\r\n", "\n").strip()
+    if not text:
+        return []
+    chunks = [p.strip() for p in _ENTRY_START.split(text) if p and p.strip()]
+    # old imports appended the same comment again and again with "\n": a line that repeats the
+    # first line of an entry starts a new entry even without a marker
+    heads = {_norm(c.split("\n", 1)[0]) for c in chunks}
+    out = []
+    for chunk in chunks:
+        lines = chunk.split("\n")
+        start = 0
+        for i in range(1, len(lines)):
+            if _norm(lines[i]) in heads:
+                out.append("\n".join(lines[start:i]).strip())
+                start = i
+        out.append("\n".join(lines[start:]).strip())
+    return [e for e in out if e]
+
+
+def _norm(text):
+    return _SPACES.sub(" ", text).strip().casefold()
+
+
+def entry_hash(body):
+    # whitespace and case don't make a different note
+    return hashlib.sha1(_norm(body).encode()).hexdigest()
+
+
+def summary(body):
+    line = _SPACES.sub(" ", body or "").strip()
+    if len(line) <= SUMMARY_CHARS:
+        return line or None
+    return line[:SUMMARY_CHARS - 1].rstrip() + "…"
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def add(conn, machine_id, text, source=None):
+    # -> number of new entries; known entries only get last_seen_at bumped
+    now = _now()
+    added = 0
+    for body in split_entries(text):
+        h = entry_hash(body)
+        cur = conn.execute("UPDATE machine_notes SET last_seen_at=? WHERE machine_id=? AND hash=?", (now, machine_id, h))
+        if cur.rowcount:
+            continue
+        version = conn.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM machine_notes WHERE machine_id=?", (machine_id,)).fetchone()[0]
+        conn.execute("INSERT INTO machine_notes (machine_id, version, hash, body, source, created_at, last_seen_at) VALUES (?,?,?,?,?,?,?)",
+                     (machine_id, version, h, body, source, now, now))
+        added += 1
+    if added:
+        refresh_summary(conn, machine_id)
+    return added
+
+
+def refresh_summary(conn, machine_id):
+    row = conn.execute("SELECT body FROM machine_notes WHERE machine_id=? ORDER BY version DESC LIMIT 1", (machine_id,)).fetchone()
+    conn.execute("UPDATE machines SET notes=? WHERE id=?", (summary(row[0]) if row else None, machine_id))
+
+
+def entries(conn, machine_id, limit=None):
+    # newest first
+    query = "SELECT id, version, body, source, created_at, last_seen_at FROM machine_notes WHERE machine_id=? ORDER BY version DESC"
+    params = [machine_id]
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+    return conn.execute(query, params).fetchall()
+
+
+def delete_for(conn, machine_id):
+    conn.execute("DELETE FROM machine_notes WHERE machine_id=?", (machine_id,))
+
+
+def full_text_sql(column="id"):
+    # all entries of a machine, oldest first, for exports that round-trip to the Excel comment cell
+    return (f"(SELECT group_concat(body, char(10)) FROM (SELECT body FROM machine_notes "
+            f"WHERE machine_id = {column} ORDER BY version))")
+
+
+def compact(conn, on_change=None):
+    # one-time: machines.notes text that isn't a summary yet is split into entries.
+    # Idempotent: afterwards every non-empty notes value is the summary of an existing entry.
+    pending = conn.execute("""
+        SELECT id, notes FROM machines
+        WHERE notes IS NOT NULL AND TRIM(notes) != ''
+          AND (LENGTH(notes) > ? OR NOT EXISTS (SELECT 1 FROM machine_notes n WHERE n.machine_id = machines.id))
+    """, (SUMMARY_CHARS,)).fetchall()
+    before_bytes = sum(len(n.encode()) for _, n in pending)
+    for mid, notes in pending:
+        before = conn.execute("SELECT * FROM machines WHERE id=?", (mid,)).fetchone()
+        add(conn, mid, notes, source='compaction')
+        # text that was already all known still needs its summary
+        refresh_summary(conn, mid)
+        if on_change:
+            on_change(conn, mid, before)
+    return len(pending), before_bytes
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Compacta machines.notes en entradas de machine_notes")
+    p.add_argument("db", nargs="?", default="machines.db")
+    p.add_argument("--vacuum", action="store_true", help="devolver al disco el espacio liberado")
+    args = p.parse_args(argv)
+    conn = sqlite3.connect(args.db, timeout=30)
+    conn.row_factory = sqlite3.Row
+    ensure_schema(conn)
+    maquinas_events.ensure_schema(conn)
+    machines, size = compact(conn, lambda c, mid, before: maquinas_events.machine_changed(c, mid, before, source='compaction'))
+    conn.commit()
+    entries_count = conn.execute("SELECT COUNT(*) FROM machine_notes").fetchone()[0]
+    print(f"✓ {machines} máquinas compactadas ({size / 1024:.1f} KB de notas), {entries_count} entradas en total")
+    if args.vacuum:
+        conn.execute("VACUUM")
+        print("✓ VACUUM")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
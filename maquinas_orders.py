@@ -0,0 +1,215 @@
+"""
+Órdenes de trabajo por plazo de reparación (rojo 24 h, naranja 48 h, amarillo 72 h)
+- cada nota roja, naranja o amarilla abre una orden para su máquina y herramienta, con vencimiento calculado
+- una orden abierta por máquina/herramienta: una nota repetida no duplica, una más grave acorta el plazo
+- la orden se cierra con una medición posterior de la misma herramienta en verde o gris (o con criticidad
+  bajo la banda amarilla), o a mano desde el tablero; una lectura sin severidad ni criticidad no la cierra
+- se procesan las mediciones nuevas por id (marca de agua), vengan de la web, del Excel, de tablets o de scripts
+- vencidas y por vencer son rangos del índice (status, due_at)
+
+Uso:
+    python maquinas_orders.py [machines.db]
+"""
+
+import argparse
+import sqlite3
+from datetime import datetime, timedelta
+
+import maquinas_export
+import maquinas_forecast
+
+# same windows the calendar writes to repair_time ('24h' -> 24)
+SLA_HOURS = {sev: int(window[:-1]) for sev, window in maquinas_export.REPAIR_TIMES.items() if window.endswith('h')}
+SOON_HOURS = 24
+CLEAR_SEVERITIES = ('verde', 'gris')
+_DATE_FORMATS = ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d")
+_TS = "%Y-%m-%d %H:%M"
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS work_orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        machine_id INTEGER NOT NULL,
+        tool_id INTEGER,
+        measurement_id INTEGER NOT NULL,
+        severity TEXT NOT NULL,
+        note TEXT,
+        opened_at TEXT NOT NULL,
+        due_at TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'open',
+        closed_at TEXT,
+        closed_by TEXT,
+        closing_measurement_id INTEGER,
+        closing_note TEXT
+    );
+    -- overdue / due-soon: one range scan each
+    CREATE INDEX IF NOT EXISTS idx_work_orders_status_due ON work_orders(status, due_at);
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_work_orders_open_series ON work_orders(machine_id, tool_id) WHERE status = 'open';
+    CREATE INDEX IF NOT EXISTS idx_work_orders_machine ON work_orders(machine_id, id);
+    CREATE INDEX IF NOT EXISTS idx_work_orders_closed ON work_orders(status, closed_at);
+    CREATE TABLE IF NOT EXISTS work_order_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        last_measurement_id INTEGER NOT NULL
+    );
+    """)
+
+
+def _now():
+    return datetime.now().strftime(_TS)
+
+
+def _parse(value):
+    value = str(value or '').strip()
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _all_clear(severity, criticality):
+    # only an explicit verde/gris, or a criticality under the yellow band, closes an order;
+    # a reading with neither (an uncolored note, a bare criticality form) says nothing about the repair
+    if severity:
+        return severity in CLEAR_SEVERITIES
+    return criticality is not None and criticality < maquinas_forecast.YELLOW
+
+
+def process(conn, limit=None):
+    # measurements written since the last pass -> opened / escalated / closed orders; caller commits
+    # a write first: the pass holds the write lock, so two workers never process the same rows
+    conn.execute("INSERT OR IGNORE INTO work_order_state (id, last_measurement_id) VALUES (1, 0)")
+    last = conn.execute("SELECT last_measurement_id FROM work_order_state WHERE id=1").fetchone()[0]
+    sql = "SELECT id, machine_id, tool_id, date, severity, note, criticality FROM measurements WHERE id > ? ORDER BY id"
+    params = [last]
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    rows = conn.execute(sql, params).fetchall()
+    if not rows:
+        return 0, 0
+    opened = closed = 0
+    open_orders = {}
+    now = datetime.now()
+    for mid, machine_id, tool_id, date, severity, note, crit in rows:
+        if machine_id is None:
+            continue
+        when = _parse(date) or now
+        key = (machine_id, tool_id)
+        if key not in open_orders:
+            # point lookup on the partial index of open orders
+            open_orders[key] = conn.execute(
+                "SELECT id, machine_id, tool_id, opened_at, due_at FROM work_orders WHERE machine_id=? AND tool_id IS ? AND status='open'",
+                key).fetchone()
+        order = open_orders[key]
+        hours = SLA_HOURS.get(severity)
+        if hours:
+            due = (when + timedelta(hours=hours)).strftime(_TS)
+            if order is None:
+                cur = conn.execute("""
+                    INSERT INTO work_orders (machine_id, tool_id, measurement_id, severity, note, opened_at, due_at)
+                    VALUES (?,?,?,?,?,?,?)
+                """, (machine_id, tool_id, mid, severity, note, when.strftime(_TS), due))
+                open_orders[key] = (cur.lastrowid, machine_id, tool_id, when.strftime(_TS), due)
+                opened += 1
+            elif due < order[4]:
+                # worse note on an open order: tighter deadline
+                conn.execute("UPDATE work_orders SET severity=?, due_at=?, note=COALESCE(?, note) WHERE id=?",
+                             (severity, due, note, order[0]))
+                open_orders[key] = tuple(order)[:4] + (due,)
+        elif order is not None and when.strftime(_TS) >= order[3] and _all_clear(severity, crit):
+            # follow-up reading that says the condition is fine: the repair was checked
+            conn.execute("""
+                UPDATE work_orders SET status='closed', closed_at=?, closed_by='measurement',
+                    closing_measurement_id=?, closing_note=? WHERE id=?
+            """, (when.strftime(_TS), mid, note, order[0]))
+            open_orders[key] = None
+            closed += 1
+    conn.execute("UPDATE work_order_state SET last_measurement_id=? WHERE id=1", (rows[-1][0],))
+    return opened, closed
+
+
+def complete(conn, order_id, note=None):
+    # manual completion from the board; caller commits
+    return conn.execute("""
+        UPDATE work_orders SET status='closed', closed_at=?, closed_by='manual', closing_note=?
+        WHERE id=? AND status='open'
+    """, (_now(), note, order_id)).rowcount > 0
+
+
+def forget(conn, machine_id=None, tool_id=None):
+    # machine or tool deleted: its orders go with its measurements
+    if machine_id is not None:
+        conn.execute("DELETE FROM work_orders WHERE machine_id=?", (machine_id,))
+    if tool_id is not None:
+        conn.execute("DELETE FROM work_orders WHERE tool_id=?", (tool_id,))
+
+
+_BOARD_SQL = """
+    SELECT o.id, o.machine_id, o.tool_id, o.severity, o.note, o.opened_at, o.due_at,
+           mac.name AS machine, mac.hac_code, t.name AS tool
+    FROM work_orders o
+    LEFT JOIN machines mac ON mac.id = o.machine_id
+    LEFT JOIN tools t ON t.id = o.tool_id
+    WHERE o.status = 'open' AND o.due_at >= ? AND o.due_at < ?
+    ORDER BY o.due_at
+    LIMIT ?
+"""
+
+
+def overdue(conn, now=None, limit=500):
+    now = now or datetime.now()
+    return conn.execute(_BOARD_SQL, ('', now.strftime(_TS), limit)).fetchall()
+
+
+def due_soon(conn, now=None, hours=SOON_HOURS, limit=500):
+    now = now or datetime.now()
+    return conn.execute(_BOARD_SQL, (now.strftime(_TS), (now + timedelta(hours=hours)).strftime(_TS), limit)).fetchall()
+
+
+def counts(conn, now=None, hours=SOON_HOURS):
+    # -> {'overdue', 'soon', 'open'}; COUNTs over index ranges, no table rows read
+    now = now or datetime.now()
+    stamp, soon = now.strftime(_TS), (now + timedelta(hours=hours)).strftime(_TS)
+    row = conn.execute("""
+        SELECT (SELECT COUNT(*) FROM work_orders WHERE status='open' AND due_at < ?),
+               (SELECT COUNT(*) FROM work_orders WHERE status='open' AND due_at >= ? AND due_at < ?),
+               (SELECT COUNT(*) FROM work_orders WHERE status='open')
+    """, (stamp, stamp, soon)).fetchone()
+    return {'overdue': row[0], 'soon': row[1], 'open': row[2]}
+
+
+def recently_closed(conn, limit=50):
+    return conn.execute("""
+        SELECT o.id, o.machine_id, o.severity, o.opened_at, o.due_at, o.closed_at, o.closed_by, o.closing_note,
+               mac.name AS machine, t.name AS tool
+        FROM work_orders o
+        LEFT JOIN machines mac ON mac.id = o.machine_id
+        LEFT JOIN tools t ON t.id = o.tool_id
+        WHERE o.status = 'closed'
+        ORDER BY o.closed_at DESC
+        LIMIT ?
+    """, (limit,)).fetchall()
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Procesa las mediciones nuevas y muestra las órdenes vencidas")
+    p.add_argument("db", nargs="?", default="machines.db")
+    args = p.parse_args(argv)
+    conn = sqlite3.connect(args.db, timeout=30)
+    conn.row_factory = sqlite3.Row
+    ensure_schema(conn)
+    opened, closed = process(conn)
+    conn.commit()
+    c = counts(conn)
+    print(f"✓ {opened} órdenes abiertas, {closed} cerradas; {c['open']} abiertas en total, "
+          f"{c['overdue']} vencidas, {c['soon']} vencen en {SOON_HOURS} h")
+    for o in overdue(conn, limit=20):
+        print(f"  ! {o['due_at']}  {o['severity']:<8} {o['machine'] or o['machine_id']} / {o['tool'] or '-'}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+Plan de inspecciones (hoja "Plan 2023 Tolvas y Silos" y similares)
+- cada bloque de la hoja ("PLAN DE INSPECCIÓN DETALLE 2023 CON MOP") tiene código HAC, denominación
+  y una "x" en las columnas de año (2021, 2022...) o de mes (ENERO...DICIEMBRE del año del plan)
+- cada "x" es una fila de planned_inspections (máquina + período), cargadas en una sola transacción
+- cumplimiento: una inspección planificada se cumplió si la máquina tiene alguna medición dentro del período
+  (tabla caliente y archivos por año)
+
+Uso:
+    python maquinas_plan.py [machines.db] [excel.xlsx]
+"""
+
+import argparse
+import re
+import sqlite3
+from datetime import datetime
+
+import maquinas_archive
+import maquinas_match
+
+PLAN_SHEET_PREFIX = "Plan "
+MONTHS = {'ENERO': 1, 'FEBRERO': 2, 'MARZO': 3, 'ABRIL': 4, 'MAYO': 5, 'JUNIO': 6, 'JULIO': 7,
+          'AGOSTO': 8, 'SEPTIEMBRE': 9, 'SETIEMBRE': 9, 'OCTUBRE': 10, 'NOVIEMBRE': 11, 'DICIEMBRE': 12}
+_YEAR = re.compile(r"\b(19|20)\d{2}\b")
+_BLOCK = re.compile(r"\bCON\s+(.+)$", re.IGNORECASE)
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS planned_inspections (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        plan TEXT NOT NULL,
+        block TEXT NOT NULL DEFAULT '',
+        hac_code TEXT NOT NULL,
+        name TEXT,
+        machine_id INTEGER,
+        period TEXT NOT NULL,
+        period_start TEXT NOT NULL,
+        period_end TEXT NOT NULL,
+        source_row INTEGER,
+        imported_at TEXT NOT NULL,
+        UNIQUE (plan, block, hac_code, name, period)
+    );
+    CREATE INDEX IF NOT EXISTS idx_planned_machine_period ON planned_inspections(machine_id, period_start);
+    CREATE INDEX IF NOT EXISTS idx_planned_period ON planned_inspections(plan, period, block);
+    """)
+
+
+def period_bounds(period):
+    # '2023' -> ('2023-01-01', '2024-01-01'); '2023-03' -> ('2023-03-01', '2023-04-01')
+    if len(period) == 4:
+        year = int(period)
+        return f"{year}-01-01", f"{year + 1}-01-01"
+    year, month = int(period[:4]), int(period[5:7])
+    nxt = (year + 1, 1) if month == 12 else (year, month + 1)
+    return f"{year}-{month:02d}-01", f"{nxt[0]}-{nxt[1]:02d}-01"
+
+
+def _header_periods(row, plan_year):
+    # column index -> period for year and month headers
+    periods = {}
+    for i, v in enumerate(row):
+        if isinstance(v, (int, float)) and 1900 < v < 2100:
+            periods[i] = str(int(v))
+        elif isinstance(v, str):
+            text = v.strip()
+            if text.isdigit() and len(text) == 4:
+                periods[i] = text
+            elif text.upper() in MONTHS and plan_year:
+                periods[i] = f"{plan_year}-{MONTHS[text.upper()]:02d}"
+    return periods
+
+
+def parse_plan(rows, sheet_name=""):
+    # rows: iterable of cell-value tuples (openpyxl values_only); -> list of dicts, one per "x"
+    default_year = _YEAR.search(sheet_name)
+    plan_year = default_year.group(0) if default_year else None
+    block, code_col, name_col, periods = "", None, None, {}
+    out = []
+    for rownum, row in enumerate(rows, start=1):
+        texts = [v.strip() for v in row if isinstance(v, str) and v.strip()]
+        title = next((t for t in texts if t.upper().startswith("PLAN DE INSPECC")), None)
+        if title:
+            year = _YEAR.search(title)
+            plan_year = year.group(0) if year else plan_year
+            m = _BLOCK.search(title)
+            block = m.group(1).strip().upper() if m else ""
+            code_col = None
+            continue
+        upper = [str(v).strip().upper() if v is not None else "" for v in row]
+        header_code = next((i for i, v in enumerate(upper) if v.startswith("CÓDIGO") or v.startswith("CODIGO")), None)
+        if header_code is not None:
+            code_col = header_code
+            name_col = next((i for i, v in enumerate(upper) if v.startswith("DENOMIN")), None)
+            periods = _header_periods(row, plan_year)
+            continue
+        if code_col is None or code_col >= len(row) or not isinstance(row[code_col], str) or not row[code_col].strip():
+            continue
+        hac = row[code_col].strip()
+        name = str(row[name_col]).strip() if name_col is not None and row[name_col] is not None else None
+        for i, period in periods.items():
+            v = row[i] if i < len(row) else None
+            if isinstance(v, str) and v.strip().upper() == "X":
+                out.append({'block': block, 'hac_code': hac, 'name': name, 'period': period, 'source_row': rownum})
+    return out
+
+
+def import_plan(conn, items, plan):
+    # replaces the whole plan in the caller's transaction; -> (rows, matched to a machine)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute("DELETE FROM planned_inspections WHERE plan=?", (plan,))
+    conn.executemany("""
+        INSERT OR IGNORE INTO planned_inspections (plan, block, hac_code, name, period, period_start, period_end, source_row, imported_at)
+        VALUES (?,?,?,?,?,?,?,?,?)
+    """, [(plan, it['block'], it['hac_code'], it['name'], it['period'], *period_bounds(it['period']), it['source_row'], now)
+          for it in items])
+    match_machines(conn, plan)
+    total, matched = conn.execute("SELECT COUNT(*), COUNT(machine_id) FROM planned_inspections WHERE plan=?", (plan,)).fetchone()
+    return total, matched
+
+
+def match_machines(conn, plan=None):
+    # set-based: one UPDATE, each lookup is an index probe on the normalized HAC index (maquinas_match)
+    filt, params = "", []
+    if plan is not None:
+        filt, params = "WHERE plan = ?", [plan]
+    conn.execute(f"""
+        UPDATE planned_inspections SET machine_id = (
+            SELECT mac.id FROM machines mac
+            WHERE {maquinas_match.HAC_NORM_SQL.format(col='mac.hac_code')}
+                = {maquinas_match.HAC_NORM_SQL.format(col='planned_inspections.hac_code')}
+            ORDER BY mac.id LIMIT 1
+        ) {filt}
+    """, params)
+
+
+def import_workbook(conn, wb):
+    # every "Plan ..." sheet of an openpyxl workbook; -> {sheet: (rows, matched)}
+    result = {}
+    for name in wb.sheetnames:
+        if name.startswith(PLAN_SHEET_PREFIX):
+            result[name] = import_plan(conn, parse_plan(wb[name].iter_rows(values_only=True), name), name)
+    return result
+
+
+def plans(conn):
+    return [r[0] for r in conn.execute("SELECT DISTINCT plan FROM planned_inspections ORDER BY plan")]
+
+
+def _load_hits(conn, where, params):
+    # temp._plan_hits(id, done_at): first measurement of the machine inside each planned period
+    conn.execute("DROP TABLE IF EXISTS temp._plan_hits")
+    conn.execute("CREATE TEMP TABLE _plan_hits (id INTEGER PRIMARY KEY, done_at TEXT)")
+    span = conn.execute(f"SELECT MIN(period_start), MAX(period_end) FROM planned_inspections p WHERE {where}", params).fetchone()
+    if span[0] is None:
+        return
+    select = f"""
+        INSERT INTO temp._plan_hits (id, done_at)
+        SELECT p.id, MIN(m.date) FROM planned_inspections p
+        JOIN {{schema}}.measurements m ON m.machine_id = p.machine_id AND m.date >= p.period_start AND m.date < p.period_end
+        WHERE p.machine_id IS NOT NULL AND {where}
+        GROUP BY p.id
+        ON CONFLICT(id) DO UPDATE SET done_at = MIN(done_at, excluded.done_at)
+    """
+    # archives first: attaching needs no open transaction, and the upsert keeps the earliest hit either way
+    years = maquinas_archive.archive_years(conn, span[0], span[1])
+    for i in range(0, len(years), maquinas_archive.MAX_ATTACH):
+        with maquinas_archive.attached(conn, years[i:i + maquinas_archive.MAX_ATTACH]) as schemas:
+            for schema in schemas:
+                conn.execute(select.format(schema=schema), params)
+    conn.execute(select.format(schema="main"), params)
+
+
+def _filter(plan=None, block=None, period=None):
+    where, params = "1=1", []
+    for col, val in (('plan', plan), ('block', block), ('period', period)):
+        if val is not None:
+            where += f" AND p.{col} = ?"
+            params.append(val)
+    return where, params
+
+
+def compliance(conn, plan=None, block=None):
+    # one row per plan / block / period: planned, matched to a machine, done
+    where, params = _filter(plan, block)
+    _load_hits(conn, where, params)
+    rows = conn.execute(f"""
+        SELECT p.plan, p.block, p.period, MIN(p.period_start) AS period_start, MIN(p.period_end) AS period_end,
+               COUNT(*) AS planned, COUNT(p.machine_id) AS matched, COUNT(h.id) AS done
+        FROM planned_inspections p LEFT JOIN temp._plan_hits h ON h.id = p.id
+        WHERE {where}
+        GROUP BY p.plan, p.block, p.period
+        ORDER BY p.plan, p.block, period_start, period_end DESC
+    """, params).fetchall()
+    conn.execute("DROP TABLE IF EXISTS temp._plan_hits")
+    today = datetime.now().strftime("%Y-%m-%d")
+    return [dict(r, pct=round(100.0 * r['done'] / r['planned']) if r['planned'] else None,
+                 open=r['period_end'] > today) for r in rows]
+
+
+def period_items(conn, plan, block, period):
+    # detail of one period: each planned machine with the date it was inspected (or None)
+    where, params = _filter(plan, block, period)
+    _load_hits(conn, where, params)
+    rows = conn.execute(f"""
+        SELECT p.id, p.hac_code, p.name, p.machine_id, mac.name AS machine_name, h.done_at
+        FROM planned_inspections p
+        LEFT JOIN temp._plan_hits h ON h.id = p.id
+        LEFT JOIN machines mac ON mac.id = p.machine_id
+        WHERE {where}
+        ORDER BY h.done_at IS NOT NULL, p.hac_code
+    """, params).fetchall()
+    conn.execute("DROP TABLE IF EXISTS temp._plan_hits")
+    return rows
+
+
+def main(argv=None):
+    from openpyxl import load_workbook
+    p = argparse.ArgumentParser(description="Importa las hojas 'Plan ...' del Excel a planned_inspections")
+    p.add_argument("db", nargs="?", default="machines.db")
+    p.add_argument("excel", nargs="?", default="Matriz de condición de equipos principales excel.xlsx")
+    args = p.parse_args(argv)
+    conn = sqlite3.connect(args.db, timeout=30)
+    conn.row_factory = sqlite3.Row
+    ensure_schema(conn)
+    result = import_workbook(conn, load_workbook(args.excel, read_only=True, data_only=True))
+    conn.commit()
+    for name, (total, matched) in result.items():
+        print(f"✓ {name}: {total} inspecciones planificadas, {matched} con máquina")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Caché en memoria de datos de referencia (herramientas, índice de máquinas, criterios compilados)
+- una copia por proceso y por base de datos; las páginas con desplegables no consultan esas tablas
+- cada tabla tiene un contador en ref_versions que suben triggers de SQLite en cada cambio,
+  así un worker ve los cambios hechos por otro (o por un script) con una sola lectura mínima
+- las escrituras de la web recargan la entrada apenas confirman (write-through)
+"""
+
+import threading
+
+import maquinas_archive
+import maquinas_criteria
+
+# index columns for dropdowns and lookups; the full row stays in the machines table
+MACHINE_INDEX = "SELECT id, name, hac_code, machine_type, area FROM machines ORDER BY COALESCE(machine_type,''), name"
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def ensure_schema(conn):
+    # after maquinas_criteria.ensure_schema: the criteria trigger needs criteria_versions
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS ref_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    );
+    INSERT OR IGNORE INTO ref_versions (name, version) VALUES ('tools', 0), ('machines', 0), ('criteria', 0);
+    CREATE TRIGGER IF NOT EXISTS trg_ref_tools_insert AFTER INSERT ON tools
+    BEGIN UPDATE ref_versions SET version = version + 1 WHERE name = 'tools'; END;
+    CREATE TRIGGER IF NOT EXISTS trg_ref_tools_update AFTER UPDATE ON tools
+    BEGIN UPDATE ref_versions SET version = version + 1 WHERE name = 'tools'; END;
+    CREATE TRIGGER IF NOT EXISTS trg_ref_tools_delete AFTER DELETE ON tools
+    BEGIN UPDATE ref_versions SET version = version + 1 WHERE name = 'tools'; END;
+    CREATE TRIGGER IF NOT EXISTS trg_ref_machines_insert AFTER INSERT ON machines
+    BEGIN UPDATE ref_versions SET version = version + 1 WHERE name = 'machines'; END;
+    CREATE TRIGGER IF NOT EXISTS trg_ref_machines_update AFTER UPDATE OF name, hac_code, machine_type, area ON machines
+    BEGIN UPDATE ref_versions SET version = version + 1 WHERE name = 'machines'; END;
+    CREATE TRIGGER IF NOT EXISTS trg_ref_machines_delete AFTER DELETE ON machines
+    BEGIN UPDATE ref_versions SET version = version + 1 WHERE name = 'machines'; END;
+    CREATE TRIGGER IF NOT EXISTS trg_ref_criteria_insert AFTER INSERT ON criteria_versions
+    BEGIN UPDATE ref_versions SET version = version + 1 WHERE name = 'criteria'; END;
+    CREATE TRIGGER IF NOT EXISTS trg_ref_criteria_update AFTER UPDATE OF active ON criteria_versions
+    BEGIN UPDATE ref_versions SET version = version + 1 WHERE name = 'criteria'; END;
+    """)
+
+
+def _load_tools(conn):
+    return tuple(conn.execute("SELECT * FROM tools ORDER BY name").fetchall())
+
+
+def _load_machines(conn):
+    return tuple(conn.execute(MACHINE_INDEX).fetchall())
+
+
+_LOADERS = {
+    'tools': _load_tools,
+    'machines': _load_machines,
+    'criteria': maquinas_criteria.compiled,
+}
+
+
+def _versions(conn, names):
+    marks = ",".join("?" * len(names))
+    return dict(conn.execute(f"SELECT name, version FROM ref_versions WHERE name IN ({marks})", names).fetchall())
+
+
+def get(conn, *names):
+    # -> one value per name; reloads only the entries whose counter moved since they were cached
+    path = maquinas_archive.db_path(conn)
+    versions = _versions(conn, names)
+    out = []
+    for name in names:
+        version = versions.get(name)
+        with _cache_lock:
+            hit = _cache.get((path, name))
+        if hit is None or hit[0] != version:
+            # counter read before the load: a write in between leaves an old version, so it reloads again
+            hit = (version, _LOADERS[name](conn))
+            with _cache_lock:
+                _cache[(path, name)] = hit
+        out.append(hit[1])
+    return out[0] if len(names) == 1 else tuple(out)
+
+
+def written(conn, *names):
+    # after the caller's commit: replace the entries now instead of on the next read
+    path = maquinas_archive.db_path(conn)
+    versions = _versions(conn, names)
+    for name in names:
+        value = _LOADERS[name](conn)
+        with _cache_lock:
+            _cache[(path, name)] = (versions.get(name), value)
+
+
+def tools(conn):
+    return get(conn, 'tools')
+
+
+def machines(conn):
+    return get(conn, 'machines')
+
+
+def criteria(conn):
+    return get(conn, 'criteria')
+
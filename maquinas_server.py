@@ -0,0 +1,157 @@
+"""
+Monitor de Condición - servidor de producción
+- gunicorn (Linux) con varios workers y threads por worker
+- waitress (Windows, o si gunicorn no está instalado) con threads
+- debug desactivado, secret_key desde MAQUINAS_SECRET_KEY
+
+Uso:
+    MAQUINAS_SECRET_KEY=... python maquinas_server.py --workers 4 --threads 8 --bind 0.0.0.0:8000
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import _thread
+
+
+def parse_args(argv=None):
+    env = os.environ.get
+    p = argparse.ArgumentParser(description="Monitor de Condición (modo producción)")
+    p.add_argument("--bind", default=env("MAQUINAS_BIND", "0.0.0.0:8000"), help="host:puerto")
+    p.add_argument("--workers", type=int, default=int(env("MAQUINAS_WORKERS", str(min(multiprocessing.cpu_count() * 2 + 1, 8)))),
+                   help="procesos worker (solo gunicorn)")
+    p.add_argument("--threads", type=int, default=int(env("MAQUINAS_THREADS", "8")), help="threads por worker")
+    p.add_argument("--timeout", type=int, default=int(env("MAQUINAS_TIMEOUT", "120")),
+                   help="segundos antes de reiniciar un worker colgado")
+    p.add_argument("--graceful-timeout", type=int, default=int(env("MAQUINAS_GRACEFUL_TIMEOUT", "60")),
+                   help="segundos para terminar importaciones en curso al apagar")
+    p.add_argument("--server", choices=("auto", "gunicorn", "waitress"), default=env("MAQUINAS_SERVER", "auto"))
+    return p.parse_args(argv)
+
+
+def load_app():
+    import maquinas_app
+    maquinas_app.app.debug = False
+    maquinas_app.warm_caches()
+    return maquinas_app
+
+
+def run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    class MaquinasApplication(BaseApplication):
+        def load_config(self):
+            def post_worker_init(worker):
+                # scheduler threads can't be forked from the preloaded master
+                import maquinas_app
+                maquinas_app.start_jobs()
+
+            def worker_exit(server, worker):
+                # gthread has already waited graceful_timeout for running requests (imports included)
+                import maquinas_jobs
+                maquinas_jobs.stop()
+
+            settings = {
+                "bind": args.bind,
+                "workers": args.workers,
+                "threads": args.threads,
+                "worker_class": "gthread",
+                "timeout": args.timeout,
+                "graceful_timeout": args.graceful_timeout,
+                # load once in the master so warm-up and migrations run a single time
+                "preload_app": True,
+                "post_worker_init": post_worker_init,
+                "worker_exit": worker_exit,
+                "accesslog": "-",
+            }
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return load_app().app
+
+    MaquinasApplication().run()
+
+
+def run_waitress(args):
+    from waitress import create_server, wasyncore
+
+    if args.workers > 1:
+        print(f"waitress no admite varios procesos; se ignora --workers={args.workers}")
+    maquinas_app = load_app()
+    host, _, port = args.bind.rpartition(":")
+    server = create_server(maquinas_app.app, host=host or "0.0.0.0", port=int(port), threads=args.threads,
+                           channel_timeout=args.timeout)
+
+    stopping = threading.Event()
+
+    def stop_accepting():
+        # runs on the I/O loop: closes only the listening socket; the trigger stays open so
+        # requests already in flight (imports included) can still send their responses
+        wasyncore.dispatcher.close(server)
+
+    def busy():
+        # a channel still running a request or holding unsent output
+        return any(getattr(ch, "requests", None) or getattr(ch, "total_outbufs_len", 0)
+                   for ch in list(server._map.values()))
+
+    def drain():
+        deadline = time.monotonic() + args.graceful_timeout
+        server.trigger.pull_trigger(stop_accepting)
+        maquinas_app.maquinas_jobs.stop()
+        if not maquinas_app.drain_imports(timeout=args.graceful_timeout):
+            print("Importación en curso abortada al apagar")
+        # an import is counted done before its response is written: let the loop flush it
+        while busy() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        # wake the I/O loop; the second signal ends run()
+        _thread.interrupt_main()
+
+    def shutdown(signum, frame):
+        if stopping.is_set():
+            raise SystemExit(0)
+        stopping.set()
+        # the handler runs on the I/O loop thread: never block it, the wait happens in another thread
+        print("Apagando: esperando importaciones en curso...")
+        threading.Thread(target=drain, name="maquinas-drain", daemon=True).start()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    maquinas_app.start_jobs()
+    print(f"➜ http://{args.bind} (waitress, {args.threads} threads)")
+    try:
+        server.run()
+    finally:
+        if not stopping.is_set():
+            server.close()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.environ.get("MAQUINAS_SECRET_KEY"):
+        print("ERROR: defina MAQUINAS_SECRET_KEY antes de iniciar en modo producción")
+        return 2
+
+    server = args.server
+    if server == "auto":
+        server = "waitress" if sys.platform == "win32" else "gunicorn"
+        if server == "gunicorn":
+            try:
+                import gunicorn  # noqa: F401
+            except ImportError:
+                server = "waitress"
+
+    print("🚀 Monitor de Condición (producción)")
+    if server == "gunicorn":
+        run_gunicorn(args)
+    else:
+        run_waitress(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
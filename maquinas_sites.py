@@ -0,0 +1,150 @@
+"""
+Una base SQLite por planta (sitio)
+- MAQUINAS_SITES="norte=/datos/norte.db,sur=/datos/sur.db" o MAQUINAS_SITES_DIR con un <sitio>.db por planta
+- sin configuración hay un solo sitio (machines.db), igual que antes
+- consultas de flota: se reparten en paralelo a cada base y se combinan los resultados
+"""
+
+import heapq
+import os
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, wait
+
+DEFAULT_DB_FILE = "machines.db"
+SITE_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+# a slow or locked plant must not hold the fleet page hostage
+FANOUT_TIMEOUT = float(os.environ.get("MAQUINAS_FANOUT_TIMEOUT", "10"))
+FANOUT_WORKERS = int(os.environ.get("MAQUINAS_FANOUT_WORKERS", "8"))
+
+
+def load_sites():
+    # {site: db file}, in configuration order; the first one is the default
+    spec = os.environ.get("MAQUINAS_SITES", "").strip()
+    sites = {}
+    if spec:
+        for item in spec.split(","):
+            if not item.strip():
+                continue
+            name, _, path = item.partition("=")
+            name = name.strip()
+            if not SITE_NAME.match(name):
+                raise ValueError(f"Nombre de sitio inválido: {name!r}")
+            sites[name] = path.strip() or f"{name}.db"
+        return sites
+    directory = os.environ.get("MAQUINAS_SITES_DIR", "").strip()
+    if directory:
+        for fname in sorted(os.listdir(directory)):
+            name, ext = os.path.splitext(fname)
+            if ext == ".db" and SITE_NAME.match(name):
+                sites[name] = os.path.join(directory, fname)
+    return sites or {"default": DEFAULT_DB_FILE}
+
+
+SITES = load_sites()
+DEFAULT_SITE = next(iter(SITES))
+
+
+def db_file(site=None):
+    if site is None:
+        site = DEFAULT_SITE
+    if site not in SITES:
+        raise KeyError(site)
+    return SITES[site]
+
+
+def site_for_path(path):
+    # reverse lookup for modules that only see a connection (asset tree root name)
+    path = os.path.abspath(path)
+    for name, fname in SITES.items():
+        if os.path.abspath(fname) == path:
+            return name
+    return None
+
+
+def connect(site=None, timeout=30):
+    conn = sqlite3.connect(db_file(site), timeout=timeout)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def fan_out(fn, sites=None, timeout=FANOUT_TIMEOUT):
+    # run fn(site, conn) on every shard in parallel, each with its own connection;
+    # returns ({site: result}, {site: error}) so one broken plant doesn't hide the others
+    sites = list(sites or SITES)
+
+    def run(site):
+        conn = connect(site)
+        try:
+            return fn(site, conn)
+        finally:
+            conn.close()
+
+    results, errors = {}, {}
+    pool = ThreadPoolExecutor(max_workers=min(FANOUT_WORKERS, len(sites)) or 1)
+    try:
+        futures = {pool.submit(run, site): site for site in sites}
+        done, pending = wait(futures, timeout=timeout)
+        for fut in done:
+            site = futures[fut]
+            try:
+                results[site] = fut.result()
+            except Exception as e:
+                errors[site] = str(e)
+        for fut in pending:
+            errors[futures[fut]] = "sin respuesta"
+    finally:
+        # don't wait for shards that timed out; their threads finish on their own
+        pool.shutdown(wait=False)
+    return results, errors
+
+
+# ---- per-shard queries (read the precomputed asset rollups, so each is O(1)/O(limit)) ----
+
+def _site_summary(site, conn):
+    row = conn.execute("""
+        SELECT r.machines, r.worst_crit, r.red, r.yellow, r.blue, r.green, r.overdue, r.last_date
+        FROM asset_nodes n JOIN asset_rollups r ON r.node_id = n.id
+        WHERE n.depth = 0 ORDER BY n.id LIMIT 1
+    """).fetchone()
+    alerts = conn.execute("SELECT COUNT(*) FROM alerts WHERE status='open'").fetchone()[0]
+    summary = dict(row) if row else {'machines': 0, 'worst_crit': None, 'red': 0, 'yellow': 0, 'blue': 0,
+                                     'green': 0, 'overdue': 0, 'last_date': None}
+    summary['alerts'] = alerts
+    return summary
+
+
+def _site_worst(limit):
+    def query(site, conn):
+        return [dict(r, site=site) for r in conn.execute("""
+            SELECT n.machine_id, mac.name, mac.hac_code, mac.area, mac.machine_type, r.worst_crit, r.last_date
+            FROM asset_nodes n
+            JOIN asset_rollups r ON r.node_id = n.id
+            JOIN machines mac ON mac.id = n.machine_id
+            WHERE n.kind = 'machine' AND r.worst_crit IS NOT NULL
+            ORDER BY r.worst_crit DESC, r.last_date DESC
+            LIMIT ?
+        """, (limit,))]
+    return query
+
+
+def fleet_summary(sites=None):
+    # per-site rollups plus the fleet total
+    results, errors = fan_out(_site_summary, sites)
+    total = {k: 0 for k in ('machines', 'red', 'yellow', 'blue', 'green', 'overdue', 'alerts')}
+    worst = None
+    for summary in results.values():
+        for k in total:
+            total[k] += summary.get(k) or 0
+        if summary.get('worst_crit') is not None:
+            worst = max(worst if worst is not None else summary['worst_crit'], summary['worst_crit'])
+    total['worst_crit'] = worst
+    return results, total, errors
+
+
+def fleet_worst(limit=20, sites=None):
+    # top-N per shard, merged: the global top-N is always inside the union
+    results, errors = fan_out(_site_worst(limit), sites)
+    merged = heapq.nlargest(limit, (r for rows in results.values() for r in rows),
+                            key=lambda r: (r['worst_crit'], r['last_date'] or ''))
+    return merged, errors
@@ -0,0 +1,181 @@
+"""
+Snapshots consistentes de machines.db (API de backup online de SQLite)
+- copia por páginas sin bloquear a los inspectores que escriben
+- copia en memoria para reportes y análisis
+- snapshots programados que sirven de backup, con retención; incluyen una copia de los archivos
+  anuales de archive/ que figuran en measurement_archives (el archivado mueve ahí la única copia)
+
+Uso:
+    python maquinas_snapshot.py [machines.db] [--keep 14] [--dir snapshots]
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+SNAPSHOT_PAGES = int(os.environ.get("MAQUINAS_SNAPSHOT_PAGES", "256"))
+# pause between backup steps so the copy doesn't saturate the disk
+SNAPSHOT_PAUSE = float(os.environ.get("MAQUINAS_SNAPSHOT_PAUSE", "0.005"))
+SNAPSHOT_KEEP = int(os.environ.get("MAQUINAS_SNAPSHOT_KEEP", "14"))
+
+
+def snapshot_dir(db_file):
+    default = os.path.join(os.path.dirname(os.path.abspath(db_file)), "snapshots")
+    return os.environ.get("MAQUINAS_SNAPSHOT_DIR", default)
+
+
+def _copy(db_file, dest, pages=SNAPSHOT_PAGES, pause=SNAPSHOT_PAUSE):
+    src = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+    try:
+        # an open read transaction pins one point in time for every backup step;
+        # in WAL mode writers keep committing meanwhile and the backup never restarts
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+
+        def progress(status, remaining, total):
+            if pause and remaining:
+                time.sleep(pause)
+
+        src.backup(dest, pages=pages, progress=progress)
+        src.execute("COMMIT")
+    finally:
+        src.close()
+
+
+def take_snapshot(db_file, dest_path=None, pages=SNAPSHOT_PAGES, pause=SNAPSHOT_PAUSE):
+    # point-in-time copy to a file; written under a temp name so a crash never
+    # leaves a half-copied snapshot that looks valid
+    if dest_path is None:
+        base = os.path.splitext(os.path.basename(db_file))[0]
+        dest_path = os.path.join(snapshot_dir(db_file), f"{base}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db")
+    os.makedirs(os.path.dirname(os.path.abspath(dest_path)), exist_ok=True)
+    tmp_path = dest_path + ".part"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    dest = sqlite3.connect(tmp_path)
+    try:
+        _copy(db_file, dest, pages, pause)
+        # snapshots are read by reports, not written: a rollback journal is enough
+        dest.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dest.close()
+    os.replace(tmp_path, dest_path)
+    return dest_path
+
+
+def archive_copy_dir(snapshot_path):
+    # machines_20261019_023000.db -> machines_20261019_023000_archive/
+    return os.path.splitext(snapshot_path)[0] + "_archive"
+
+
+def snapshot_archives(snapshot_path, pages=SNAPSHOT_PAGES, pause=SNAPSHOT_PAUSE):
+    # the per-year archives listed in the snapshot's own catalog, copied next to it with the backup API
+    snap = open_snapshot(snapshot_path)
+    try:
+        listed = snap.execute("SELECT year, path FROM measurement_archives ORDER BY year").fetchall()
+    except sqlite3.OperationalError:
+        # never archived
+        listed = []
+    finally:
+        snap.close()
+    missing = [path for _, path in listed if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"Faltan archivos de mediciones archivadas: {', '.join(missing)}")
+    copies = []
+    for _, path in listed:
+        dest_path = os.path.join(archive_copy_dir(snapshot_path), os.path.basename(path))
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        tmp_path = dest_path + ".part"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        dest = sqlite3.connect(tmp_path)
+        try:
+            _copy(path, dest, pages, pause)
+            # copied after the main file: rows an archive run moved in between are still in the
+            # snapshot's hot table, so they are dropped here and a restore never sees them twice
+            dest.execute("ATTACH DATABASE ? AS snap", (snapshot_path,))
+            dest.execute("DELETE FROM measurements WHERE id IN (SELECT id FROM snap.measurements)")
+            dest.commit()
+            dest.execute("DETACH DATABASE snap")
+            dest.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            dest.close()
+        os.replace(tmp_path, dest_path)
+        copies.append(dest_path)
+    return copies
+
+
+def memory_snapshot(db_file, pages=SNAPSHOT_PAGES, pause=0):
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    _copy(db_file, conn, pages, pause)
+    return conn
+
+
+def open_snapshot(path):
+    conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+@contextmanager
+def snapshot_connection(db_file, path=None, in_memory=False):
+    # what report/analytics jobs use: a given snapshot file, a fresh in-memory
+    # copy, or a fresh snapshot file taken now
+    if path:
+        conn = open_snapshot(path)
+    elif in_memory:
+        conn = memory_snapshot(db_file)
+    else:
+        conn = open_snapshot(take_snapshot(db_file))
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def list_snapshots(db_file, directory=None):
+    base = os.path.splitext(os.path.basename(db_file))[0]
+    directory = directory or snapshot_dir(db_file)
+    # timestamped names sort chronologically
+    return sorted(glob.glob(os.path.join(directory, f"{base}_????????_??????.db")))
+
+
+def prune_snapshots(db_file, keep=SNAPSHOT_KEEP, directory=None):
+    snapshots = list_snapshots(db_file, directory)
+    removed = snapshots[:-keep] if keep > 0 else snapshots
+    for path in removed:
+        os.remove(path)
+        shutil.rmtree(archive_copy_dir(path), ignore_errors=True)
+    return removed
+
+
+def scheduled_snapshot(db_file, keep=SNAPSHOT_KEEP, directory=None):
+    # backup (main file + its archives) + retention in one call, for cron / the job runner
+    dest = None
+    if directory:
+        base = os.path.splitext(os.path.basename(db_file))[0]
+        dest = os.path.join(directory, f"{base}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db")
+    path = take_snapshot(db_file, dest)
+    archives = snapshot_archives(path)
+    removed = prune_snapshots(db_file, keep, directory)
+    return path, archives, removed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snapshot consistente de la base de datos")
+    parser.add_argument("db", nargs="?", default="machines.db")
+    parser.add_argument("--keep", type=int, default=SNAPSHOT_KEEP, help="snapshots a conservar")
+    parser.add_argument("--dir", default=None, help="carpeta de destino (por defecto snapshots/ junto a la base)")
+    args = parser.parse_args()
+    path, archives, removed = scheduled_snapshot(args.db, args.keep, args.dir)
+    print(f"✓ Snapshot: {path}")
+    if archives:
+        print(f"  {len(archives)} archivos de mediciones en {archive_copy_dir(path)}")
+    for old in removed:
+        print(f"  eliminado {old}")
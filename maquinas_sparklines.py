@@ -0,0 +1,169 @@
+"""
+Sparklines SVG de criticidad y severidad
+- se generan en el servidor a partir del historial de mediciones
+- se cachean por máquina en la tabla sparklines y se invalidan cuando llega una medición nueva
+- cada gráfico guarda el seq del registro de cambios con el que se calculó: si la máquina tiene
+  eventos posteriores no se usa, así un GET que calculó antes de una escritura no deja un gráfico viejo
+"""
+
+import os
+
+SPARK_POINTS = int(os.environ.get("MAQUINAS_SPARK_POINTS", "30"))
+SPARK_WIDTH = 120
+SPARK_HEIGHT = 28
+# ordinal scale for the calendar severities
+SEVERITY_LEVELS = {'gris': 0, 'verde': 1, 'amarillo': 2, 'naranja': 3, 'rojo': 4}
+# tool_id used for the machine-level series (worst criticality per day across tools)
+MACHINE_SERIES = 0
+# SQLite's default limit on bound parameters is 999
+_ID_CHUNK = 900
+
+
+def ensure_schema(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sparklines (
+        machine_id INTEGER NOT NULL,
+        tool_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        svg TEXT NOT NULL,
+        seq INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (machine_id, tool_id, kind)
+    )""")
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(sparklines)")}
+    if 'seq' not in cols:
+        # existing charts count as computed before any event: each is rebuilt once
+        conn.execute("ALTER TABLE sparklines ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+        print("✓ Columna seq agregada a sparklines")
+
+
+def _crit_color(value):
+    if value >= 8:
+        return '#dc2626'
+    if value >= 5:
+        return '#eab308'
+    if value >= 3:
+        return '#2563eb'
+    return '#16a34a'
+
+
+def _sev_color(level):
+    return ['#9ca3af', '#16a34a', '#eab308', '#f97316', '#dc2626'][int(level)]
+
+
+def sparkline_svg(values, max_value, color_for, width=SPARK_WIDTH, height=SPARK_HEIGHT):
+    # empty string = cached "no data", so the series isn't recomputed on every request
+    values = [v for v in values if v is not None][-SPARK_POINTS:]
+    if not values:
+        return ''
+    pad = 3
+    n = len(values)
+    step = (width - 2 * pad) / (n - 1) if n > 1 else 0
+    points = []
+    for i, v in enumerate(values):
+        x = pad + i * step if n > 1 else width / 2
+        y = height - pad - (min(max(v, 0), max_value) / max_value) * (height - 2 * pad)
+        points.append((round(x, 1), round(y, 1)))
+    last_x, last_y = points[-1]
+    line = ' '.join(f'{x},{y}' for x, y in points)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}" class="sparkline">'
+            f'<polyline fill="none" stroke="#64748b" stroke-width="1.5" points="{line}"/>'
+            f'<circle cx="{last_x}" cy="{last_y}" r="2.5" fill="{color_for(values[-1])}"/></svg>')
+
+
+def crit_svg(values):
+    return sparkline_svg(values, 10, _crit_color)
+
+
+def sev_svg(severities):
+    return sparkline_svg([SEVERITY_LEVELS.get(s) for s in severities], 4, _sev_color)
+
+
+def invalidate(conn, machine_ids=None):
+    # called on every measurement write; None clears everything (bulk imports, tool deletes)
+    if machine_ids is None:
+        conn.execute("DELETE FROM sparklines")
+        return
+    ids = list(machine_ids)
+    for i in range(0, len(ids), _ID_CHUNK):
+        chunk = ids[i:i + _ID_CHUNK]
+        conn.execute(f"DELETE FROM sparklines WHERE machine_id IN ({','.join('?' * len(chunk))})", chunk)
+
+
+def _last_seq(conn):
+    # read before the measurements: a write committed in between has a later seq, so the chart
+    # built from it is at worst rebuilt once more, never trusted while stale
+    return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM events").fetchone()[0]
+
+
+_FRESH = "NOT EXISTS (SELECT 1 FROM events e WHERE e.machine_id = s.machine_id AND e.seq > s.seq)"
+
+_STORE = """
+    INSERT INTO sparklines (machine_id, tool_id, kind, svg, seq) VALUES (?,?,?,?,?)
+    ON CONFLICT (machine_id, tool_id, kind) DO UPDATE SET svg=excluded.svg, seq=excluded.seq
+    WHERE excluded.seq >= sparklines.seq
+"""
+
+
+def machine_sparklines(conn, machine_ids):
+    # {machine_id: svg} for the home page cards; only machines without a fresh cached
+    # chart are recomputed, all of them in one grouped query
+    ids = list(machine_ids)
+    result = {}
+    for i in range(0, len(ids), _ID_CHUNK):
+        chunk = ids[i:i + _ID_CHUNK]
+        marks = ','.join('?' * len(chunk))
+        for r in conn.execute(f"""
+            SELECT s.machine_id, s.svg FROM sparklines s
+            WHERE s.tool_id=? AND s.kind='crit' AND s.machine_id IN ({marks}) AND {_FRESH}
+        """, [MACHINE_SERIES] + chunk):
+            result[r[0]] = r[1]
+    missing = [mid for mid in ids if mid not in result]
+    if not missing:
+        return result
+
+    seq = _last_seq(conn)
+    for i in range(0, len(missing), _ID_CHUNK):
+        chunk = missing[i:i + _ID_CHUNK]
+        marks = ','.join('?' * len(chunk))
+        series = {mid: [] for mid in chunk}
+        for mid, crit in conn.execute(f"""
+            SELECT machine_id, MAX(criticality) FROM measurements
+            WHERE machine_id IN ({marks}) AND criticality IS NOT NULL AND date IS NOT NULL
+            GROUP BY machine_id, substr(date, 1, 10)
+            ORDER BY machine_id, substr(date, 1, 10)
+        """, chunk):
+            series[mid].append(crit)
+        rows = [(mid, MACHINE_SERIES, 'crit', crit_svg(values), seq) for mid, values in series.items()]
+        conn.executemany(_STORE, rows)
+        result.update({mid: svg for mid, _, _, svg, _ in rows})
+    conn.commit()
+    return result
+
+
+def tool_sparklines(conn, machine_id):
+    # {tool_id: {'crit': svg, 'sev': svg}} for the detail page
+    cached = {}
+    for tool_id, kind, svg in conn.execute(f"""
+        SELECT s.tool_id, s.kind, s.svg FROM sparklines s
+        WHERE s.machine_id=? AND s.tool_id<>? AND {_FRESH}
+    """, (machine_id, MACHINE_SERIES)):
+        cached.setdefault(tool_id, {})[kind] = svg
+    # an empty cache for a machine with measurements means it was invalidated (or is stale)
+    if cached:
+        return cached
+
+    seq = _last_seq(conn)
+    crit, sev = {}, {}
+    for tool_id, criticality, severity in conn.execute("""
+        SELECT tool_id, criticality, severity FROM measurements
+        WHERE machine_id=? AND date IS NOT NULL
+        ORDER BY date, id
+    """, (machine_id,)):
+        crit.setdefault(tool_id, []).append(criticality)
+        sev.setdefault(tool_id, []).append(severity)
+    result = {tid: {'crit': crit_svg(crit[tid]), 'sev': sev_svg(sev[tid])} for tid in crit}
+    # stale charts of tools that no longer have readings go too
+    conn.execute("DELETE FROM sparklines WHERE machine_id=? AND tool_id<>? AND seq < ?", (machine_id, MACHINE_SERIES, seq))
+    conn.executemany(_STORE, [(machine_id, tid, kind, svg, seq) for tid, kinds in result.items() for kind, svg in kinds.items()])
+    conn.commit()
+    return result
@@ -0,0 +1,188 @@
+"""
+Sincronización de tablets de inspección sin conexión
+- pull: máquinas, herramientas y estado actual cambiados desde el último token
+  (el token es el seq del registro de eventos, así un pull después de un turno trae solo el delta)
+- push: lotes de mediciones tomadas sin conexión; el client_id que genera la tablet las hace idempotentes
+- conflictos: la primera subida de un client_id gana; lecturas de la misma serie con la misma fecha
+  se ordenan por criticidad y luego por client_id, igual en todas las tablets
+"""
+
+import os
+from datetime import datetime, timedelta
+
+import maquinas_events
+import maquinas_export
+
+MAX_BATCH = int(os.environ.get("MAQUINAS_SYNC_MAX_BATCH", "500"))
+# tablet clocks drift; readings dated further ahead than this are rejected
+FUTURE_TOLERANCE = timedelta(days=1)
+MACHINE_FIELDS = ('id', 'name', 'hac_code', 'area', 'machine_type', 'priority', 'color', 'color_hex')
+TOOL_FIELDS = ('id', 'name', 'description')
+STATUS_FIELDS = ('machine_id', 'tool_id', 'date', 'criticality', 'severity', 'note')
+MEASUREMENT_FIELDS = ('machine_id', 'tool_id', 'date', 'criticality', 'note', 'severity')
+# latest reading of a series; same-minute readings from different tablets resolve the same way everywhere
+STATUS_ORDER = "date DESC, COALESCE(criticality, -1) DESC, COALESCE(client_id, '') DESC, id DESC"
+_DATE_FORMATS = ("%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d")
+_ID_CHUNK = 900
+
+
+def ensure_schema(conn):
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(measurements)")}
+    if 'client_id' not in cols:
+        conn.execute("ALTER TABLE measurements ADD COLUMN client_id TEXT")
+        print("✓ Columna client_id agregada")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_measurements_client_id ON measurements(client_id) WHERE client_id IS NOT NULL")
+
+
+def current_token(conn):
+    return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM events").fetchone()[0]
+
+
+def _by_ids(conn, table, fields, ids):
+    if ids is None:
+        return [dict(zip(fields, r)) for r in conn.execute(f"SELECT {', '.join(fields)} FROM {table} ORDER BY id")]
+    ids = sorted(ids)
+    out = []
+    for i in range(0, len(ids), _ID_CHUNK):
+        chunk = ids[i:i + _ID_CHUNK]
+        out += [dict(zip(fields, r)) for r in conn.execute(
+            f"SELECT {', '.join(fields)} FROM {table} WHERE id IN ({','.join('?' * len(chunk))}) ORDER BY id", chunk)]
+    return out
+
+
+def latest_status(conn, series=None):
+    # latest reading per (machine, tool); `series` limits it to the pairs that changed
+    join = ""
+    if series is not None:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS _sync_series (machine_id INTEGER, tool_id INTEGER, PRIMARY KEY (machine_id, tool_id))")
+        conn.execute("DELETE FROM temp._sync_series")
+        conn.executemany("INSERT OR IGNORE INTO temp._sync_series VALUES (?,?)", list(series))
+        join = "JOIN temp._sync_series s ON s.machine_id = m.machine_id AND s.tool_id = m.tool_id"
+    return [dict(zip(STATUS_FIELDS, r)) for r in conn.execute(f"""
+        SELECT {', '.join(STATUS_FIELDS)} FROM (
+            SELECT m.*, ROW_NUMBER() OVER (PARTITION BY m.machine_id, m.tool_id ORDER BY {STATUS_ORDER}) AS rn
+            FROM measurements m {join}
+            WHERE m.date IS NOT NULL
+        ) WHERE rn = 1
+    """)]
+
+
+def pull(conn, since=0):
+    token = current_token(conn)
+    # unknown / future tokens (restored backup, other site) get a full resync
+    full = since <= 0 or since > token
+    if full:
+        return {'token': token, 'full': True,
+                'machines': _by_ids(conn, 'machines', MACHINE_FIELDS, None),
+                'tools': _by_ids(conn, 'tools', TOOL_FIELDS, None),
+                'status': latest_status(conn),
+                'deleted_machines': [], 'deleted_tools': [], 'cleared_status': []}
+
+    machine_ids, tool_ids, series = set(), set(), set()
+    for entity, entity_id, machine_id, tool_id in conn.execute(
+            "SELECT entity, entity_id, machine_id, tool_id FROM events WHERE seq > ? AND seq <= ?", (since, token)):
+        if entity == 'machine':
+            machine_ids.add(entity_id)
+        elif entity == 'tool':
+            tool_ids.add(entity_id)
+        elif entity == 'measurement' and machine_id is not None and tool_id is not None:
+            series.add((machine_id, tool_id))
+    machines = _by_ids(conn, 'machines', MACHINE_FIELDS, machine_ids)
+    tools = _by_ids(conn, 'tools', TOOL_FIELDS, tool_ids)
+    status = latest_status(conn, series) if series else []
+    present = {(s['machine_id'], s['tool_id']) for s in status}
+    return {'token': token, 'full': False,
+            'machines': machines, 'tools': tools, 'status': status,
+            'deleted_machines': sorted(machine_ids - {m['id'] for m in machines}),
+            'deleted_tools': sorted(tool_ids - {t['id'] for t in tools}),
+            # every reading of the series was deleted
+            'cleared_status': sorted([m, t] for m, t in series - present)}
+
+
+def _parse_date(value):
+    value = str(value or '').strip()
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _validate(item, machine_ids, tool_ids, now):
+    # -> (row dict, None) or (None, reason)
+    try:
+        machine_id, tool_id = int(item.get('machine_id')), int(item.get('tool_id'))
+    except (TypeError, ValueError):
+        return None, 'machine_id/tool_id inválidos'
+    if machine_id not in machine_ids:
+        return None, 'máquina inexistente o eliminada'
+    if tool_id not in tool_ids:
+        return None, 'herramienta inexistente o eliminada'
+    date = _parse_date(item.get('date'))
+    if date is None:
+        return None, 'fecha inválida'
+    if date > now + FUTURE_TOLERANCE:
+        return None, 'fecha en el futuro'
+    criticality = item.get('criticality')
+    if criticality not in (None, ''):
+        try:
+            criticality = int(criticality)
+        except (TypeError, ValueError):
+            return None, 'criticidad inválida'
+        if not 0 <= criticality <= 10:
+            return None, 'criticidad fuera de rango'
+    else:
+        criticality = None
+    severity = item.get('severity') or None
+    if severity is not None and severity not in maquinas_export.REPAIR_TIMES:
+        return None, 'severidad inválida'
+    if criticality is None and severity is None:
+        return None, 'falta criticidad o severidad'
+    note = (item.get('note') or '').strip()
+    return {'machine_id': machine_id, 'tool_id': tool_id, 'date': date.strftime("%Y-%m-%d %H:%M"),
+            'criticality': criticality, 'note': note, 'severity': severity}, None
+
+
+def _existing(conn, client_id, row):
+    # retried upload: same payload is a no-op; a different payload keeps the first one
+    existing = conn.execute(f"SELECT id, {', '.join(MEASUREMENT_FIELDS)} FROM measurements WHERE client_id=?", (client_id,)).fetchone()
+    if not existing:
+        return None
+    same = row is not None and all(existing[i + 1] == row[f] for i, f in enumerate(MEASUREMENT_FIELDS))
+    return {'client_id': client_id, 'status': 'duplicate' if same else 'conflict', 'id': existing[0]}
+
+
+def push_measurements(conn, items, source='sync', now=None):
+    # one transaction per batch (the caller commits); returns per-item results and the touched series
+    if len(items) > MAX_BATCH:
+        raise ValueError(f"lote demasiado grande ({len(items)} > {MAX_BATCH})")
+    now = now or datetime.now()
+    if not conn.in_transaction:
+        # IMMEDIATE: the client_id lookups below must see what a concurrent retry of this batch commits
+        conn.execute("BEGIN IMMEDIATE")
+    machine_ids = {r[0] for r in conn.execute("SELECT id FROM machines")}
+    tool_ids = {r[0] for r in conn.execute("SELECT id FROM tools")}
+    results, touched = [], set()
+    for item in items:
+        client_id = str(item.get('client_id') or '').strip()
+        if not client_id or len(client_id) > 64:
+            results.append({'client_id': client_id, 'status': 'rejected', 'reason': 'client_id requerido (máx. 64)'})
+            continue
+        row, reason = _validate(item, machine_ids, tool_ids, now)
+        if reason:
+            results.append(_existing(conn, client_id, None) or {'client_id': client_id, 'status': 'rejected', 'reason': reason})
+            continue
+        cur = conn.execute("""
+            INSERT INTO measurements (machine_id, tool_id, date, criticality, note, severity, repair_time, client_id)
+            VALUES (?,?,?,?,?,?,?,?)
+            ON CONFLICT(client_id) WHERE client_id IS NOT NULL DO NOTHING""",
+                           (row['machine_id'], row['tool_id'], row['date'], row['criticality'], row['note'], row['severity'],
+                            maquinas_export.REPAIR_TIMES.get(row['severity']), client_id))
+        if cur.rowcount == 0:
+            results.append(_existing(conn, client_id, row))
+            continue
+        maquinas_events.measurement_inserted(conn, cur.lastrowid, source=source)
+        touched.add((row['machine_id'], row['tool_id']))
+        results.append({'client_id': client_id, 'status': 'created', 'id': cur.lastrowid})
+    return results, touched
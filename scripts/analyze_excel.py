@@ -1,136 +1,246 @@
 import sys
 import os
 import json
-import re
+import glob
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
 import pandas as pd
 
+MAIN_SHEET = 'CM Matrix equipos principales'
+SAMPLE_ROWS = 20
+TOOL_COLUMNS = ['VOSOA', 'RUTI', 'COR', 'ACEITE', 'VIB', 'TERMO', 'DES', 'DUREZA', 'EMD', 'VT / LP', 'PM', 'UT', 'ESPESOR']
+# fixed score bins so histograms from different workbooks can be added up
+SCORE_BINS = list(range(0, 210, 10)) + [float('inf')]
+BATCH_CACHE = 'batch_cache.json'
 
-def detect_header_row(excel_path, sheet_name, max_scan=10):
-    xls = pd.read_excel(excel_path, sheet_name=sheet_name, header=None)
-    for i in range(min(max_scan, len(xls))):
-        row = xls.iloc[i].astype(str).str.upper().tolist()
-        if any('AREA' == v or v.strip().startswith('AREA') for v in row if v and v != 'nan'):
+
+def detect_header_row_frame(raw, max_scan=10):
+    # raw: sheet read with header=None
+    for i in range(min(max_scan, len(raw))):
+        row = raw.iloc[i].fillna("").astype(str).str.upper().tolist()
+        if any('AREA' == v or v.strip().startswith('AREA') for v in row if v and v != 'NAN'):
             return i
     # fallback: try to find a row with 'CÓDIGO' or 'Código' or 'Denominación'
-    for i in range(min(max_scan, len(xls))):
-        row = xls.iloc[i].astype(str).str.upper().tolist()
-        if any('CÓDIGO' in v or 'DENOMINACIÓN' in v or 'DENOMINACION' in v for v in row if v and v != 'nan'):
+    for i in range(min(max_scan, len(raw))):
+        row = raw.iloc[i].fillna("").astype(str).str.upper().tolist()
+        if any('CÓDIGO' in v or 'DENOMINACIÓN' in v or 'DENOMINACION' in v for v in row if v and v != 'NAN'):
             return i
     return 0
 
 
+def detect_header_row(excel_path, sheet_name, max_scan=10):
+    raw = pd.read_excel(excel_path, sheet_name=sheet_name, header=None)
+    return detect_header_row_frame(raw, max_scan)
+
+
+def parse_criteria_frame(crit):
+    mapping = {}
+    # heuristic: for each row, pair every factor (numeric cell) with the nearest text cell
+    values = crit.to_numpy(dtype=object)
+    for row in values:
+        present = ~pd.isna(row)
+        is_num = np.array([isinstance(v, (int, float)) and not isinstance(v, bool) for v in row]) & present
+        cols = np.arange(len(row))
+        text_cols = [c for c in cols[present & ~is_num] if str(row[c]).strip()]
+        if not text_cols:
+            continue
+        text_cols = np.array(text_cols)
+        for fcol in cols[is_num]:
+            # first text cell at minimal distance, same tie-break as the original scan
+            best = text_cols[np.argmin(np.abs(text_cols - fcol))]
+            mapping[str(row[best]).strip()] = float(row[fcol])
+    # normalize keys
+    return {k.upper(): v for k, v in mapping.items()}
+
+
 def parse_criteria(excel_path):
     try:
         crit = pd.read_excel(excel_path, sheet_name='Criterios', header=None)
     except Exception:
         return {}
-    mapping = {}
-    # heuristic: for each row, find text cells and nearby numeric cells (factors)
-    for _, row in crit.iterrows():
-        texts = []
-        factors = []
-        for col_idx, val in enumerate(row):
-            if pd.isna(val):
-                continue
-            if isinstance(val, (int, float)) and not (isinstance(val, bool)):
-                factors.append((col_idx, float(val)))
-            else:
-                s = str(val).strip()
-                if s:
-                    texts.append((col_idx, s))
-        # pair any nearby text with factor: nearest factor to the right or left within 3 cols
-        for fcol, fval in factors:
-            # find nearest text
-            best = None
-            best_dist = 999
-            for tcol, tval in texts:
-                dist = abs(tcol - fcol)
-                if dist < best_dist:
-                    best = tval
-                    best_dist = dist
-            if best:
-                mapping[best] = fval
-    # normalize keys
-    mapping = {k.upper(): v for k, v in mapping.items()}
-    return mapping
+    return parse_criteria_frame(crit)
 
 
-def score_row_by_criteria(row, criteria_map):
-    score = 0.0
-    matches = []
-    joined = ' '.join([str(x) for x in row.values if not pd.isna(x)])
-    joined_u = joined.upper()
+def score_frame(df, criteria_map):
+    # whole-column string matching: one pass per criterion instead of one per row
+    if df.empty:
+        return pd.Series(0.0, index=df.index), pd.Series('', index=df.index)
+    text = df.astype(str).where(df.notna(), '')
+    joined = text.iloc[:, 0].str.cat([text[c] for c in text.columns[1:]], sep=' ').str.upper()
+    scores = np.zeros(len(df))
+    matches = pd.Series('', index=df.index)
     for key, factor in criteria_map.items():
-        if key and key in joined_u:
-            score += factor
-            matches.append((key, factor))
-    return score, matches
+        if not key:
+            continue
+        hits = joined.str.contains(key, regex=False).to_numpy()
+        scores += hits * factor
+        matches = matches + np.where(hits, f";{key}:{factor}", '')
+    return pd.Series(scores, index=df.index), matches.str.lstrip(';')
+
+
+def _column_names(values):
+    # same names pandas gives with header=<row>: 'Unnamed: i' for blanks, '.1' suffix for repeats
+    names, seen = [], {}
+    for i, v in enumerate(values):
+        if pd.isna(v):
+            name = f'Unnamed: {i}'
+        elif isinstance(v, float) and v.is_integer():
+            name = str(int(v))
+        else:
+            name = str(v).strip()
+        if name in seen:
+            seen[name] += 1
+            name = f'{name}.{seen[name]}'
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def frame_with_header(raw, header_row):
+    df = raw.iloc[header_row + 1:].reset_index(drop=True)
+    df.columns = _column_names(raw.iloc[header_row].tolist()) if len(raw) > header_row else list(df.columns)
+    # drop trailing all-empty rows like read_excel does (blank rows inside the
+    # table stay), and re-infer column dtypes
+    filled = df.notna().any(axis=1)
+    end = filled[::-1].idxmax() + 1 if filled.any() else 0
+    return df.iloc[:end].infer_objects()
+
+
+def write_columnar(df, path_base, fmt):
+    # mixed object columns (numbers and text in one column) are stored as text
+    out = df.copy()
+    for c in out.columns:
+        if out[c].dtype == object:
+            out[c] = out[c].astype('string')
+    if fmt == 'feather':
+        path = path_base + '.feather'
+        out.to_feather(path)
+    else:
+        path = path_base + '.parquet'
+        out.to_parquet(path, index=False)
+    return path
+
 
+def analyze_sheet(name, raw, header_row, criteria_map, outdir, fmt):
+    df = frame_with_header(raw, header_row)
+    info = {}
+    df.columns = [str(c).strip() for c in df.columns]
+    info['rows'], info['cols'] = df.shape
+    info['columns'] = list(df.columns)
+    info['dtypes'] = {str(c): str(t) for c, t in df.dtypes.items()}
+    info['null_counts'] = df.isnull().sum().to_dict()
 
-def analyze_excel(path, outdir):
+    # compute score per row if criteria exist
+    if criteria_map:
+        df['_computed_score'], df['_computed_matches'] = score_frame(df, criteria_map)
+
+    # numeric summary where applicable
+    try:
+        info['describe'] = df.select_dtypes(include='number').describe().to_dict()
+    except Exception:
+        info['describe'] = {}
+    if name == MAIN_SHEET:
+        info['stats'] = sheet_stats(df)
+
+    base = os.path.join(outdir, f"sheet_{safe_filename(name)}")
+    sample_csv = base + '_sample.csv'
+    try:
+        df.head(SAMPLE_ROWS).to_csv(sample_csv, index=False, encoding='utf-8')
+        info['sample_csv'] = os.path.relpath(sample_csv)
+    except Exception:
+        info['sample_csv'] = None
+
+    # full sheet as typed columnar file; CSV only if pyarrow is missing
+    info['data_file'] = None
+    try:
+        info['data_file'] = os.path.relpath(write_columnar(df, base, fmt))
+    except ImportError:
+        try:
+            df.to_csv(base + '.csv', index=False, encoding='utf-8')
+            info['data_file'] = os.path.relpath(base + '.csv')
+        except Exception:
+            pass
+    except Exception as e:
+        print(f"No se pudo escribir {base}.{fmt}: {e}")
+    return name, info
+
+
+def sheet_stats(df):
+    # what the batch summary merges across workbooks
+    stats = {'rows': int(len(df))}
+    if '_computed_score' in df.columns:
+        scores = df['_computed_score'].dropna().to_numpy(dtype=float)
+        # last bin is open-ended; negative scores fall into the first one
+        edges = np.array(SCORE_BINS[:-1])
+        bins = np.clip(np.searchsorted(edges, scores, side='right') - 1, 0, len(edges) - 1)
+        hist = np.bincount(bins, minlength=len(edges))
+        stats['score'] = {
+            'count': int(len(scores)),
+            'sum': float(scores.sum()),
+            'min': float(scores.min()) if len(scores) else None,
+            'max': float(scores.max()) if len(scores) else None,
+            'hist': hist.tolist(),
+        }
+    if 'Tipo equipo' in df.columns:
+        stats['tipo_equipo'] = {str(k): int(v) for k, v in df['Tipo equipo'].fillna('Sin tipo').astype(str).str.strip().value_counts().items()}
+    cols = list(df.columns)
+    null_rates = {}
+    for tool in TOOL_COLUMNS:
+        if tool not in cols:
+            continue
+        # a tool is "empty" for a row when both its status and its note cell are blank
+        i = cols.index(tool)
+        empty = df[tool].isna()
+        if i + 1 < len(cols) and cols[i + 1].startswith('Unnamed'):
+            empty &= df[cols[i + 1]].isna()
+        null_rates[tool] = float(empty.mean()) if len(df) else None
+    stats['tool_null_rate'] = null_rates
+    return stats
+
+
+def analyze_excel(path, outdir, jobs=None, fmt='parquet'):
     os.makedirs(outdir, exist_ok=True)
 
     try:
-        # first detect header row for main sheet if possible
-        header_row = detect_header_row(path, sheet_name='CM Matrix equipos principales')
-        sheets = pd.read_excel(path, sheet_name=None, header=header_row)
+        # single read of the workbook; header detection and criteria reuse it
+        raw_sheets = pd.read_excel(path, sheet_name=None, header=None)
     except Exception as e:
         print(f"ERROR leyendo el Excel: {e}")
         return 1
 
     summary = {"file": os.path.basename(path), "sheets": {}}
 
+    # header row per sheet: the plan sheets have a title block above their 'Código HAC' row
+    header_rows = {name: detect_header_row_frame(raw) for name, raw in raw_sheets.items()}
     # parse criterios mapping
-    criteria_map = parse_criteria(path)
-
-    for name, df in sheets.items():
-        info = {}
-        # normalize column names
-        df.columns = [str(c).strip() for c in df.columns]
-        info['rows'], info['cols'] = df.shape
-        info['columns'] = list(df.columns)
-        info['dtypes'] = {str(c): str(t) for c, t in df.dtypes.items()}
-        info['null_counts'] = df.isnull().sum().to_dict()
-
-        # compute score per row if criteria exist
-        if criteria_map:
-            scores = []
-            matches_all = []
-            for _, r in df.iterrows():
-                sc, matches = score_row_by_criteria(r, criteria_map)
-                scores.append(sc)
-                matches_all.append(';'.join([f"{m[0]}:{m[1]}" for m in matches]))
-            df['_computed_score'] = scores
-            df['_computed_matches'] = matches_all
-
-        # numeric summary where applicable
-        try:
-            info['describe'] = df.select_dtypes(include='number').describe().to_dict()
-        except Exception:
-            info['describe'] = {}
+    criteria_map = parse_criteria_frame(raw_sheets['Criterios']) if 'Criterios' in raw_sheets else {}
 
-        # sample and save sheet to CSV
-        sample_csv = os.path.join(outdir, f"sheet_{safe_filename(name)}_sample.csv")
-        try:
-            df.head(20).to_csv(sample_csv, index=False, encoding='utf-8')
-            info['sample_csv'] = os.path.relpath(sample_csv)
-        except Exception:
-            info['sample_csv'] = None
+    args = [(name, raw, header_rows[name], criteria_map, outdir, fmt) for name, raw in raw_sheets.items()]
+    jobs = jobs or min(len(args), os.cpu_count() or 1)
+    if jobs > 1 and len(args) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(analyze_sheet, *zip(*args)))
+    else:
+        results = [analyze_sheet(*a) for a in args]
+    # keep workbook order
+    for name, info in results:
+        summary['sheets'][name] = info
 
-        # save full sheet as CSV
-        full_csv = os.path.join(outdir, f"sheet_{safe_filename(name)}.csv")
-        try:
-            df.to_csv(full_csv, index=False, encoding='utf-8')
-            info['full_csv'] = os.path.relpath(full_csv)
-        except Exception:
-            info['full_csv'] = None
+    write_summary(summary, outdir)
+    print(f"Análisis completado. Salida en: {os.path.abspath(outdir)}")
+    print(f"Resumen JSON: {os.path.join(outdir, 'summary.json')}")
+    return 0
 
-        summary['sheets'][name] = info
 
+def write_summary(summary, outdir):
     # write summary files
     summary_json = os.path.join(outdir, 'summary.json')
     with open(summary_json, 'w', encoding='utf-8') as f:
-        json.dump(summary, f, indent=2, ensure_ascii=False)
+        json.dump(summary, f, indent=2, ensure_ascii=False, default=str)
 
     summary_txt = os.path.join(outdir, 'summary.txt')
     with open(summary_txt, 'w', encoding='utf-8') as f:
@@ -143,20 +253,197 @@ def analyze_excel(path, outdir):
             f.write(f"  Nulos: {s['null_counts']}\n")
             f.write('\n')
 
-    print(f"Análisis completado. Salida en: {os.path.abspath(outdir)}")
-    print(f"Resumen JSON: {summary_json}")
-    return 0
-
 
 def safe_filename(name):
     return ''.join(c if c.isalnum() or c in (' ', '-', '_') else '_' for c in name).replace(' ', '_')
 
 
+# ---- Batch: muchos libros en un pool de procesos ----
+
+def find_workbooks(spec):
+    if os.path.isdir(spec):
+        paths = glob.glob(os.path.join(spec, '**', '*.xls*'), recursive=True)
+    else:
+        paths = glob.glob(spec, recursive=True)
+    # skip Excel lock files (~$libro.xlsx)
+    return sorted(os.path.abspath(p) for p in paths if not os.path.basename(p).startswith('~$'))
+
+
+def file_sha256(path, block=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(block), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_batch_cache(outdir):
+    try:
+        with open(os.path.join(outdir, BATCH_CACHE), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def is_unchanged(path, entry):
+    # mtime+size is the cheap check; if only mtime moved (copied / touched file)
+    # the content hash decides
+    if not entry or not os.path.exists(os.path.join(entry.get('outdir', ''), 'summary.json')):
+        return False
+    st = os.stat(path)
+    if st.st_size != entry.get('size'):
+        return False
+    if st.st_mtime == entry.get('mtime'):
+        return True
+    return file_sha256(path) == entry.get('sha256')
+
+
+def analyze_workbook(path, outdir, fmt):
+    # one workbook per pool worker; sheets run sequentially inside it
+    rc = analyze_excel(path, outdir, jobs=1, fmt=fmt)
+    if rc != 0:
+        return {'status': 'error'}
+    with open(os.path.join(outdir, 'summary.json'), encoding='utf-8') as f:
+        summary = json.load(f)
+    st = os.stat(path)
+    return {
+        'status': 'analyzed',
+        'outdir': outdir,
+        'mtime': st.st_mtime,
+        'size': st.st_size,
+        'sha256': file_sha256(path),
+        'stats': summary['sheets'].get(MAIN_SHEET, {}).get('stats', {}),
+    }
+
+
+def merge_stats(per_file):
+    merged = {'files': 0, 'rows': 0, 'score': {'count': 0, 'sum': 0.0, 'min': None, 'max': None, 'hist': [0] * (len(SCORE_BINS) - 1)},
+              'tipo_equipo': {}, 'tool_null_rate': {}}
+    tool_rows = {}
+    for entry in per_file.values():
+        stats = entry.get('stats') or {}
+        if not stats:
+            continue
+        merged['files'] += 1
+        rows = stats.get('rows', 0)
+        merged['rows'] += rows
+        sc = stats.get('score')
+        if sc and sc['count']:
+            m = merged['score']
+            m['count'] += sc['count']
+            m['sum'] += sc['sum']
+            m['min'] = sc['min'] if m['min'] is None else min(m['min'], sc['min'])
+            m['max'] = sc['max'] if m['max'] is None else max(m['max'], sc['max'])
+            m['hist'] = [a + b for a, b in zip(m['hist'], sc['hist'])]
+        for tipo, n in stats.get('tipo_equipo', {}).items():
+            merged['tipo_equipo'][tipo] = merged['tipo_equipo'].get(tipo, 0) + n
+        # null rates are weighted by each file's row count
+        for tool, rate in stats.get('tool_null_rate', {}).items():
+            if rate is None:
+                continue
+            merged['tool_null_rate'][tool] = merged['tool_null_rate'].get(tool, 0.0) + rate * rows
+            tool_rows[tool] = tool_rows.get(tool, 0) + rows
+    for tool, total in merged['tool_null_rate'].items():
+        merged['tool_null_rate'][tool] = total / tool_rows[tool] if tool_rows[tool] else None
+    sc = merged['score']
+    sc['mean'] = sc['sum'] / sc['count'] if sc['count'] else None
+    sc['bins'] = [str(b) for b in SCORE_BINS]
+    return merged
+
+
+def analyze_batch(spec, outdir, jobs=None, fmt='parquet', force=False):
+    paths = find_workbooks(spec)
+    if not paths:
+        print(f"No se encontraron libros Excel en {spec}")
+        return 1
+    os.makedirs(outdir, exist_ok=True)
+    cache = load_batch_cache(outdir)
+
+    results = {}
+    todo = []
+    for path in paths:
+        # one output folder per workbook, named after its path so same-named files don't collide
+        stem = safe_filename(os.path.splitext(os.path.basename(path))[0])
+        digest = hashlib.sha1(path.encode('utf-8')).hexdigest()[:8]
+        file_out = os.path.join(outdir, f"{stem}_{digest}")
+        entry = cache.get(path)
+        if not force and is_unchanged(path, entry):
+            results[path] = dict(entry, status='cached')
+        else:
+            todo.append((path, file_out))
+
+    if todo:
+        jobs = jobs or min(len(todo), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(analyze_workbook, path, file_out, fmt): path for path, file_out in todo}
+            for fut in as_completed(futures):
+                path = futures[fut]
+                try:
+                    results[path] = fut.result()
+                except Exception as e:
+                    print(f"ERROR en {path}: {e}")
+                    results[path] = {'status': 'error', 'error': str(e)}
+
+    # cache only successful analyses
+    cache = {p: {k: v for k, v in r.items() if k != 'status'} for p, r in results.items() if r.get('status') != 'error'}
+    with open(os.path.join(outdir, BATCH_CACHE), 'w', encoding='utf-8') as f:
+        json.dump(cache, f, indent=2, ensure_ascii=False)
+
+    batch = {'spec': spec, 'files': {p: {k: v for k, v in r.items() if k not in ('mtime', 'size', 'sha256')} for p, r in sorted(results.items())},
+             'merged': merge_stats(results)}
+    with open(os.path.join(outdir, 'batch_summary.json'), 'w', encoding='utf-8') as f:
+        json.dump(batch, f, indent=2, ensure_ascii=False)
+    write_batch_txt(batch, os.path.join(outdir, 'batch_summary.txt'))
+
+    n_cached = sum(1 for r in results.values() if r['status'] == 'cached')
+    n_error = sum(1 for r in results.values() if r['status'] == 'error')
+    print(f"Batch completado: {len(results)} libros ({len(todo) - n_error} analizados, {n_cached} sin cambios, {n_error} con error)")
+    print(f"Resumen: {os.path.join(outdir, 'batch_summary.json')}")
+    return 1 if n_error else 0
+
+
+def write_batch_txt(batch, path):
+    merged = batch['merged']
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"Batch: {batch['spec']}\n")
+        f.write(f"Libros: {len(batch['files'])}, filas de la matriz: {merged['rows']}\n\n")
+        for p, r in batch['files'].items():
+            stats = r.get('stats') or {}
+            sc = stats.get('score') or {}
+            mean = sc['sum'] / sc['count'] if sc.get('count') else None
+            f.write(f"{os.path.basename(p)} [{r['status']}]: filas={stats.get('rows', 0)}"
+                    f" puntuación media={mean if mean is None else round(mean, 2)}\n")
+        sc = merged['score']
+        f.write(f"\nPuntuación: n={sc['count']} media={sc['mean']} min={sc['min']} max={sc['max']}\n")
+        f.write("Distribución:\n")
+        for lo, hi, n in zip(SCORE_BINS[:-1], SCORE_BINS[1:], sc['hist']):
+            f.write(f"  [{lo}, {hi}): {n}\n")
+        f.write("\nEquipos por Tipo equipo:\n")
+        for tipo, n in sorted(merged['tipo_equipo'].items(), key=lambda kv: -kv[1]):
+            f.write(f"  {tipo}: {n}\n")
+        f.write("\nTasa de vacíos por herramienta:\n")
+        for tool, rate in merged['tool_null_rate'].items():
+            f.write(f"  {tool}: {rate:.1%}\n" if rate is not None else f"  {tool}: -\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Analiza la matriz de condición (Excel)')
+    parser.add_argument('path', nargs='?', help='ruta del Excel')
+    parser.add_argument('outdir', nargs='?', default=None, help='carpeta de salida (por defecto analysis_output junto al Excel)')
+    parser.add_argument('--batch', metavar='DIR_O_GLOB', help='analizar todos los libros de una carpeta o patrón glob')
+    parser.add_argument('--jobs', type=int, default=None, help='procesos en paralelo (hojas, o libros con --batch)')
+    parser.add_argument('--format', choices=('parquet', 'feather'), default='parquet', help='formato columnar de salida')
+    parser.add_argument('--force', action='store_true', help='con --batch: reanalizar aunque el libro no haya cambiado')
+    args = parser.parse_args(argv)
+    if args.batch:
+        # with --batch the single positional is the output folder
+        outdir = args.outdir or args.path or os.path.join(os.getcwd(), 'analysis_output')
+        return analyze_batch(args.batch, outdir, args.jobs, args.format, args.force)
+    if not args.path:
+        parser.error('falta la ruta del Excel (o --batch)')
+    outdir = args.outdir or os.path.join(os.path.dirname(args.path), 'analysis_output')
+    return analyze_excel(args.path, outdir, args.jobs, args.format)
+
+
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print('Uso: analyze_excel.py <ruta_excel> [outdir]')
-        sys.exit(2)
-    path = sys.argv[1]
-    outdir = sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.path.dirname(path), 'analysis_output')
-    rc = analyze_excel(path, outdir)
-    sys.exit(rc)
+    sys.exit(main())
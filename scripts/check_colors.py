@@ -1,11 +1,29 @@
-from maquinas_app import get_db
-conn = get_db()
-rows = conn.execute("SELECT color, COUNT(*) as c FROM machines GROUP BY color").fetchall()
-for r in rows:
-    print(r['color'], r['c'])
-# show sample machines with non-null color
-rows2 = conn.execute("SELECT id,name,priority,color FROM machines LIMIT 20").fetchall()
-print('\nSample:')
-for r in rows2:
-    print(r['id'], r['name'], r['priority'], r['color'])
-conn.close()
\ No newline at end of file
+import argparse
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+# plain connection: no Flask app, no init_db()
+import maquinas_db
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Colores guardados por máquina')
+    parser.add_argument('--site', default=None, help='planta (por defecto la primera configurada)')
+    args = parser.parse_args(argv)
+    conn = maquinas_db.connect(args.site)
+    rows = conn.execute("SELECT color, COUNT(*) as c FROM machines GROUP BY color").fetchall()
+    for r in rows:
+        print(r['color'], r['c'])
+    # show sample machines with non-null color
+    rows2 = conn.execute("SELECT id,name,priority,color FROM machines LIMIT 20").fetchall()
+    print('\nSample:')
+    for r in rows2:
+        print(r['id'], r['name'], r['priority'], r['color'])
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
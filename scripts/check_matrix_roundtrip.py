@@ -0,0 +1,86 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+
+def _severities(ws, header_row, hex_of):
+    # {(hac, tool): severity} for codes that appear once; status cell first, then its note cell
+    from maquinas_export import EXCEL_TOOL_COLUMNS, severity_from_hex
+    headers = [str(c.value or '').strip().upper() for c in ws[header_row]]
+    code_col = next(i for i, h in enumerate(headers) if 'CÓDIGO' in h or 'CODIGO' in h)
+    tools = [(h, i) for i, h in enumerate(headers) if h in EXCEL_TOOL_COLUMNS]
+    out, seen = {}, {}
+    for row in ws.iter_rows(min_row=header_row + 1):
+        code = str(row[code_col].value or '').strip()
+        if not code:
+            continue
+        seen[code] = seen.get(code, 0) + 1
+        for tool, i in tools:
+            sev = None
+            for j in (i, i + 1):
+                if j < len(row):
+                    sev = severity_from_hex(hex_of(row[j]))
+                    if sev:
+                        break
+            out[(code, tool)] = (sev, hex_of(row[i]))
+    return {k: v for k, v in out.items() if seen[k[0]] == 1}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Importa la matriz del Excel en una base temporal, la exporta y compara los colores celda por celda')
+    parser.add_argument('excel', nargs='?', default=None)
+    parser.add_argument('--db', default=os.path.join(ROOT, 'machines.db'), help='base de partida (se copia, no se modifica)')
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix='roundtrip_')
+    db = os.path.join(tmp, 'check.db')
+    shutil.copy(args.db, db)
+    # the temporary copy is the only configured site for this process
+    os.environ['MAQUINAS_SITES'] = f'check={db}'
+    import maquinas_db
+    import maquinas_export
+    import maquinas_import
+    from openpyxl import load_workbook
+
+    excel = args.excel or maquinas_import.DEFAULT_EXCEL
+    try:
+        maquinas_db.init_db('check')
+        conn = maquinas_db.connect('check')
+        result = maquinas_import.import_excel(conn, excel)
+        out = os.path.join(tmp, 'matriz.xlsx')
+        maquinas_export.write_cm_matrix(conn, out)
+        conn.close()
+
+        header = maquinas_import.detect_header_row(excel, maquinas_import.MAIN_SHEET) + 1
+        original = _severities(load_workbook(excel, data_only=True)[maquinas_import.MAIN_SHEET], header, maquinas_import.cell_fill_hex)
+        exported = _severities(load_workbook(out)[maquinas_export.MATRIX_SHEET], 1, maquinas_import.cell_fill_hex)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    changed = []
+    for key, (sev, hexv) in sorted(original.items()):
+        if key not in exported:
+            continue
+        out_sev, out_hex = exported[key]
+        # the export writes the Criterios legend fill, so a legend-colored cell comes back with the same hex
+        expected_hex = maquinas_export.SEVERITY_FILLS.get(sev)
+        if out_sev != sev or (hexv == expected_hex and out_hex != hexv):
+            changed.append((key, sev, hexv, out_sev, out_hex))
+    by_sev = {}
+    for sev, _ in original.values():
+        by_sev[sev] = by_sev.get(sev, 0) + 1
+    print(f"{result['inserted']} mediciones importadas; celdas por severidad: "
+          + ", ".join(f"{k or 'sin color'}: {v}" for k, v in sorted(by_sev.items(), key=lambda kv: str(kv[0]))))
+    print(f"{len(original)} celdas comparadas, {len(changed)} cambian en la ida y vuelta")
+    for (code, tool), sev, hexv, out_sev, out_hex in changed[:30]:
+        print(f"  {code} {tool}: {sev} ({hexv}) -> {out_sev} ({out_hex})")
+    return 1 if changed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
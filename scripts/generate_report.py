@@ -1,72 +1,369 @@
+import argparse
+import hashlib
+import io
+import json
 import os
 import sys
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+import pandas as pd
 from matplotlib.backends.backend_pdf import PdfPages
 
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+A4 = (8.27, 11.69)
+DPI = int(os.environ.get('MAQUINAS_REPORT_DPI', '120'))
+# bump when chart rendering changes so cached figures are not reused
+RENDER_VERSION = 2
+INSPECTION_INTERVAL_DAYS = int(os.environ.get('MAQUINAS_INSPECTION_DAYS', '365'))
+TABLE_ROWS = 40
+TRENDS_PER_PAGE = 12
+COLOR_HEX = {'red': '#dc2626', 'yellow': '#facc15', 'blue': '#2563eb', 'green': '#16a34a'}
+COLOR_LABELS = {'red': 'Rojo', 'yellow': 'Amarillo', 'blue': 'Azul', 'green': 'Verde'}
+MAIN_BASE = 'sheet_cm_matrix_equipos_principales'
+
+
+# ---- Datos ----
+
+def load_analysis_frame(input_dir):
+    # typed columnar output of analyze_excel.py first; full CSV from older runs as fallback
+    files = {f.lower(): os.path.join(input_dir, f) for f in os.listdir(input_dir)}
+    if MAIN_BASE + '.parquet' in files:
+        return pd.read_parquet(files[MAIN_BASE + '.parquet'])
+    if MAIN_BASE + '.feather' in files:
+        return pd.read_feather(files[MAIN_BASE + '.feather'])
+    if MAIN_BASE + '.csv' in files:
+        return pd.read_csv(files[MAIN_BASE + '.csv'], encoding='utf-8')
+    print('No se encontró la hoja principal analizada en', input_dir)
+    return None
+
+
+def load_db_frames(conn):
+    # one row per machine with its worst current criticality and last inspection date
+    machines = pd.read_sql_query("""
+        SELECT mac.id, COALESCE(mac.area, 'Sin área') AS area, mac.hac_code, mac.name,
+               COALESCE(mac.machine_type, 'Sin tipo') AS machine_type, mac.priority, mac.color,
+               MAX(l.criticality) AS worst, MAX(l.date) AS last_date
+        FROM machines mac
+        LEFT JOIN (
+            SELECT machine_id, criticality, date, ROW_NUMBER() OVER (
+                PARTITION BY machine_id, tool_id ORDER BY date DESC, id DESC) AS rn
+            FROM measurements
+        ) l ON l.machine_id = mac.id AND l.rn = 1
+        GROUP BY mac.id
+    """, conn)
+    machines['color'] = [fleet_color(c, w) for c, w in zip(machines['color'], machines['worst'])]
+    # per-date worst criticality, the series the trend charts plot
+    history = pd.read_sql_query("""
+        SELECT machine_id, substr(date, 1, 10) AS day, MAX(criticality) AS criticality
+        FROM measurements
+        WHERE criticality IS NOT NULL AND date IS NOT NULL
+        GROUP BY machine_id, day
+        ORDER BY machine_id, day
+    """, conn)
+    return machines, history
+
+
+def fleet_color(color, worst):
+    # same rule as the home page: persisted color first, else from criticality
+    if isinstance(color, str) and color:
+        return color
+    if worst is None or pd.isna(worst):
+        return 'green'
+    if worst >= 8:
+        return 'red'
+    if worst >= 5:
+        return 'yellow'
+    if worst >= 3:
+        return 'blue'
+    return 'green'
+
 
-def make_report(input_dir, out_pdf):
-    # locate main sheet CSV
-    main_csv = None
-    criterios_csv = None
-    for f in os.listdir(input_dir):
-        if f.lower().startswith('sheet_cm_matrix_equipos_principales') and f.lower().endswith('.csv'):
-            main_csv = os.path.join(input_dir, f)
-        if f.lower().startswith('sheet_criterios') and f.lower().endswith('.csv'):
-            criterios_csv = os.path.join(input_dir, f)
+# ---- Páginas (specs serializables: sus gráficos se renderizan en otro proceso y se cachean) ----
 
-    if main_csv is None:
-        print('No se encontró el CSV principal en', input_dir)
-        return 2
+def _cell(v):
+    if v is None or (isinstance(v, float) and pd.isna(v)):
+        return ''
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
 
-    df = pd.read_csv(main_csv, encoding='utf-8')
 
-    # ensure computed score exists
+def _table_pages(title, columns, rows, colors=None):
+    pages = []
+    for i in range(0, max(len(rows), 1), TABLE_ROWS):
+        chunk = rows[i:i + TABLE_ROWS]
+        suffix = f' ({i // TABLE_ROWS + 1})' if len(rows) > TABLE_ROWS else ''
+        pages.append({'kind': 'table', 'title': title + suffix, 'columns': columns,
+                      'rows': [[_cell(v) for v in r] for r in chunk],
+                      'colors': colors[i:i + TABLE_ROWS] if colors else None})
+    return pages
+
+
+def _group_pages(machines, key, label):
+    pages = []
+    columns = ['HAC', 'Denominación', 'Tipo', 'Prior.', 'Crit.', 'Última insp.']
+    if key == 'machine_type':
+        columns[2] = 'Área'
+    for group, df in machines.groupby(key, sort=True):
+        df = df.sort_values(['worst', 'name'], ascending=[False, True], na_position='last')
+        counts = df['color'].value_counts()
+        lines = [
+            f'Equipos: {len(df)}',
+            f'Criticidad media: {df["worst"].mean():.1f}' if df['worst'].notna().any() else 'Criticidad media: -',
+            f'Sin inspección en {INSPECTION_INTERVAL_DAYS} días: {int(df["overdue"].sum())}',
+        ]
+        pages.append({'kind': 'section', 'title': f'{label} {group}', 'lines': lines,
+                      'labels': [COLOR_LABELS[c] for c in COLOR_HEX],
+                      'values': [int(counts.get(c, 0)) for c in COLOR_HEX],
+                      'bar_colors': list(COLOR_HEX.values())})
+        other = 'machine_type' if key == 'area' else 'area'
+        rows = df[['hac_code', 'name', other, 'priority', 'worst', 'last_date']].values.tolist()
+        pages += _table_pages(f'{label} {group} - equipos', columns, rows, df['color'].tolist())
+    return pages
+
+
+def _trend_pages(machines, history):
+    pages = []
+    names = machines.set_index('id')['name'].to_dict()
+    order = machines.sort_values(['area', 'name'])['id'].tolist()
+    series = {mid: grp for mid, grp in history.groupby('machine_id')}
+    batch = []
+    for mid in order:
+        grp = series.get(mid)
+        if grp is None or len(grp) < 2:
+            continue
+        batch.append([names.get(mid, str(mid)), grp['day'].tolist(), [float(v) for v in grp['criticality']]])
+        if len(batch) == TRENDS_PER_PAGE:
+            pages.append({'kind': 'trends', 'title': 'Tendencia de criticidad por máquina', 'series': batch})
+            batch = []
+    if batch:
+        pages.append({'kind': 'trends', 'title': 'Tendencia de criticidad por máquina', 'series': batch})
+    return pages
+
+
+def build_db_pages(machines, history, now=None):
+    now = now or datetime.now()
+    cutoff = (now - timedelta(days=INSPECTION_INTERVAL_DAYS)).strftime('%Y-%m-%d')
+    machines = machines.copy()
+    machines['overdue'] = machines['last_date'].isna() | (machines['last_date'].fillna('') < cutoff)
+
+    counts = machines['color'].value_counts()
+    lines = [
+        f'Generado: {now.strftime("%Y-%m-%d %H:%M")}',
+        f'Equipos: {len(machines)}',
+        f'Áreas: {machines["area"].nunique()}   Tipos de equipo: {machines["machine_type"].nunique()}',
+        f'Inspecciones vencidas (> {INSPECTION_INTERVAL_DAYS} días o nunca): {int(machines["overdue"].sum())}',
+        '',
+    ] + [f'{COLOR_LABELS[c]}: {int(counts.get(c, 0))}' for c in COLOR_HEX]
+    pages = [{'kind': 'section', 'title': 'Informe: Matriz de condición', 'lines': lines,
+              'labels': [COLOR_LABELS[c] for c in COLOR_HEX], 'values': [int(counts.get(c, 0)) for c in COLOR_HEX],
+              'bar_colors': list(COLOR_HEX.values())}]
+
+    pages += _group_pages(machines, 'area', 'Área')
+    pages += _group_pages(machines, 'machine_type', 'Tipo equipo')
+    pages += _trend_pages(machines, history)
+
+    overdue = machines[machines['overdue']].sort_values(['last_date', 'area', 'name'], na_position='first')
+    pages += _table_pages('Inspecciones vencidas', ['Área', 'HAC', 'Denominación', 'Tipo', 'Crit.', 'Última insp.'],
+                          overdue[['area', 'hac_code', 'name', 'machine_type', 'worst', 'last_date']].values.tolist(),
+                          overdue['color'].tolist())
+    return pages
+
+
+def build_analysis_pages(df):
+    # legacy report over analyze_excel.py output
     if '_computed_score' not in df.columns:
         df['_computed_score'] = 0.0
+    scores = df['_computed_score'].dropna()
+    lines = [f'Filas analizadas: {len(df)}', f'Puntuación media: {scores.mean():.2f}',
+             f'Top 5 puntuaciones: {scores.nlargest(5).tolist()}']
+    top10 = df.sort_values('_computed_score', ascending=False).head(10)
+    # a handful of readable columns instead of the whole sheet
+    cols = [c for c in ('AREA', 'Código HAC', 'Denominación', 'Tipo equipo', '_computed_score') if c in df.columns]
+    return [
+        {'kind': 'section', 'title': 'Informe: Matriz de condición', 'lines': lines},
+        {'kind': 'hist', 'title': 'Distribución de _computed_score', 'values': [float(v) for v in scores], 'bins': 20},
+    ] + _table_pages('Top 10 filas por _computed_score', cols, top10[cols].values.tolist())
 
-    # Prepare PDF
-    with PdfPages(out_pdf) as pdf:
-        # page 1: summary
-        fig, ax = plt.subplots(figsize=(8.27, 11.69))  # A4
-        ax.axis('off')
-        total_rows = len(df)
-        avg_score = df['_computed_score'].mean()
-        top_scores = df['_computed_score'].nlargest(5).tolist()
-        summary_text = f"Informe: Matriz de condición\n\nFilas analizadas: {total_rows}\nPuntuación media: {avg_score:.2f}\nTop 5 puntuaciones: {top_scores}"
-        ax.text(0.01, 0.95, summary_text, va='top', fontsize=12, wrap=True)
-        pdf.savefig(fig)
-        plt.close(fig)
-
-        # page 2: histogram of computed scores
-        fig, ax = plt.subplots(figsize=(8.27, 11.69))
-        ax.hist(df['_computed_score'].dropna(), bins=20, color='C0', edgecolor='black')
-        ax.set_title('Distribución de _computed_score')
+
+# ---- Render ----
+# Titles, text and tables are drawn as vector text in this process; only the
+# charts are rasterized, in the pool, and cached by content.
+
+# where a page's chart image sits (figure fraction: left, bottom, width, height)
+CHART_RECT = {'section': (0.04, 0.04, 0.92, 0.46), 'hist': (0.04, 0.04, 0.92, 0.88), 'trends': (0.0, 0.02, 1.0, 0.92)}
+
+
+def chart_spec(spec):
+    # the part of a page that goes to the pool, or None for text-only pages
+    kind = spec['kind']
+    if kind == 'section' and spec.get('values'):
+        return {'kind': kind, 'labels': spec['labels'], 'values': spec['values'], 'bar_colors': spec.get('bar_colors')}
+    if kind == 'hist':
+        return {'kind': kind, 'values': spec['values'], 'bins': spec.get('bins', 20)}
+    if kind == 'trends':
+        return {'kind': kind, 'series': spec['series']}
+    return None
+
+
+def chart_key(chart):
+    payload = json.dumps([RENDER_VERSION, DPI, chart], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def render_chart(chart):
+    kind = chart['kind']
+    rect = CHART_RECT[kind]
+    fig = plt.figure(figsize=(A4[0] * rect[2], A4[1] * rect[3]))
+    if kind == 'section':
+        bx = fig.add_axes([0.1, 0.08, 0.87, 0.88])
+        bx.bar(chart['labels'], chart['values'], color=chart.get('bar_colors'), edgecolor='black')
+        bx.set_ylabel('Equipos')
+    elif kind == 'hist':
+        ax = fig.add_axes([0.08, 0.06, 0.89, 0.92])
+        ax.hist(chart['values'], bins=chart['bins'], color='C0', edgecolor='black')
         ax.set_xlabel('Score')
         ax.set_ylabel('Frecuencia')
-        pdf.savefig(fig)
-        plt.close(fig)
+    elif kind == 'trends':
+        axes = fig.subplots(TRENDS_PER_PAGE // 3, 3, sharey=True, gridspec_kw={'hspace': 0.6, 'wspace': 0.15, 'top': 0.97, 'bottom': 0.06})
+        for ax, (name, days, values) in zip(axes.flat, chart['series']):
+            x = pd.to_datetime(days)
+            ax.plot(x, values, marker='o', markersize=3, color='#1e40af')
+            ax.axhline(8, color=COLOR_HEX['red'], linewidth=0.8, linestyle='--')
+            ax.axhline(5, color=COLOR_HEX['yellow'], linewidth=0.8, linestyle='--')
+            ax.set_ylim(0, 10.5)
+            ax.set_title(name[:32], fontsize=7)
+            ax.tick_params(labelsize=6)
+            ax.tick_params(axis='x', rotation=45)
+        for ax in list(axes.flat)[len(chart['series']):]:
+            ax.axis('off')
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=DPI)
+    plt.close(fig)
+    return buf.getvalue()
+
+
+def render_cached(chart, cache_dir):
+    # runs in the pool; a chart whose data is unchanged is read back from disk
+    path = os.path.join(cache_dir, chart_key(chart) + '.png') if cache_dir else None
+    if path and os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    png = render_chart(chart)
+    if path:
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(png)
+        os.replace(tmp, path)
+    return png
+
 
-        # page 3: top 10 rows table
-        top10 = df.sort_values('_computed_score', ascending=False).head(10)
-        # render table
-        fig, ax = plt.subplots(figsize=(8.27, 11.69))
+def prune_cache(cache_dir, keep):
+    # charts this run did not use belong to older data (or an older RENDER_VERSION / DPI)
+    removed = 0
+    for name in os.listdir(cache_dir):
+        if name.endswith(('.png', '.tmp')) and name.split('.', 1)[0] not in keep:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def draw_page(pdf, spec, png=None):
+    fig = plt.figure(figsize=A4)
+    kind = spec['kind']
+    fig.suptitle(spec.get('title', ''), fontsize=14, fontweight='bold', y=0.98)
+    if kind == 'section':
+        ax = fig.add_axes([0.06, 0.55, 0.88, 0.38])
+        ax.axis('off')
+        ax.text(0, 1, '\n'.join(spec.get('lines', [])), va='top', fontsize=12)
+    elif kind == 'table':
+        ax = fig.add_axes([0.03, 0.03, 0.94, 0.9])
         ax.axis('off')
-        tbl = ax.table(cellText=top10.fillna('').values, colLabels=top10.columns, loc='center')
-        tbl.auto_set_font_size(False)
-        tbl.set_fontsize(8)
-        tbl.scale(1, 1.2)
-        ax.set_title('Top 10 filas por _computed_score')
-        pdf.savefig(fig, bbox_inches='tight')
-        plt.close(fig)
-
-    print('Reporte generado en', out_pdf)
+        if spec['rows']:
+            tbl = ax.table(cellText=spec['rows'], colLabels=spec['columns'], loc='upper center', cellLoc='left')
+            tbl.auto_set_font_size(False)
+            tbl.set_fontsize(7)
+            tbl.scale(1, 1.25)
+            for (r, c), cell in tbl.get_celld().items():
+                if r == 0:
+                    cell.set_facecolor('#2563eb')
+                    cell.get_text().set_color('white')
+                elif spec.get('colors') and c == 0:
+                    cell.set_facecolor(COLOR_HEX.get(spec['colors'][r - 1], 'white'))
+            tbl.auto_set_column_width(list(range(len(spec['columns']))))
+        else:
+            ax.text(0.5, 0.9, 'Sin datos', ha='center', fontsize=12)
+    if png is not None:
+        ax = fig.add_axes(CHART_RECT[kind])
+        ax.imshow(plt.imread(io.BytesIO(png), format='png'), aspect='auto')
+        ax.axis('off')
+    # dpi only sets the resolution the chart image is embedded at
+    pdf.savefig(fig, dpi=DPI)
+    plt.close(fig)
+
+
+def make_report(pages, out_pdf, jobs=None, cache_dir=None):
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    jobs = jobs or os.cpu_count() or 1
+    charts = [chart_spec(spec) for spec in pages]
+    todo = [c for c in charts if c]
+    with PdfPages(out_pdf) as pdf:
+        if jobs > 1 and len(todo) > 1:
+            # map() yields in submission order, so pages are drawn in order
+            # while later charts are still rendering
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                pngs = pool.map(render_cached, todo, [cache_dir] * len(todo), chunksize=4)
+                for spec, chart in zip(pages, charts):
+                    draw_page(pdf, spec, next(pngs) if chart else None)
+        else:
+            for spec, chart in zip(pages, charts):
+                draw_page(pdf, spec, render_cached(chart, cache_dir) if chart else None)
+    if cache_dir:
+        prune_cache(cache_dir, {chart_key(c) for c in todo})
+
+    print('Reporte generado en', out_pdf, f'({len(pages)} páginas)')
     return 0
 
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Genera el informe PDF de la matriz de condición')
+    parser.add_argument('--input-dir', default=os.path.join(ROOT, 'analysis_output'), help='carpeta de salida de analyze_excel.py')
+    parser.add_argument('--out', default=None, help='PDF de salida')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--snapshot', nargs='?', const='', default=None, metavar='RUTA',
+                        help='leer de un snapshot de machines.db (sin ruta: tomar uno nuevo ahora)')
+    source.add_argument('--memory', action='store_true', help='leer de una copia en memoria de machines.db')
+    parser.add_argument('--db', default=os.path.join(ROOT, 'machines.db'))
+    parser.add_argument('--jobs', type=int, default=None, help='procesos para renderizar gráficos')
+    parser.add_argument('--cache-dir', default=None, help='caché de figuras (por defecto report_cache/ junto al PDF)')
+    parser.add_argument('--no-cache', action='store_true')
+    args = parser.parse_args(argv)
+
+    out_pdf = args.out or os.path.join(os.path.abspath(args.input_dir), 'report.pdf')
+    cache_dir = None if args.no_cache else (args.cache_dir or os.path.join(os.path.dirname(os.path.abspath(out_pdf)), 'report_cache'))
+    if args.snapshot is not None or args.memory:
+        # never query the live DB: the inspectors' writes keep going meanwhile
+        from maquinas_snapshot import snapshot_connection
+        with snapshot_connection(args.db, path=args.snapshot or None, in_memory=args.memory) as conn:
+            machines, history = load_db_frames(conn)
+        pages = build_db_pages(machines, history)
+    else:
+        df = load_analysis_frame(os.path.abspath(args.input_dir))
+        if df is None:
+            return 2
+        pages = build_analysis_pages(df)
+    return make_report(pages, out_pdf, args.jobs, cache_dir)
+
+
 if __name__ == '__main__':
-    input_dir = os.path.join(os.path.dirname(__file__), '..', 'analysis_output')
-    input_dir = os.path.abspath(input_dir)
-    out_pdf = os.path.join(input_dir, 'report.pdf')
-    rc = make_report(input_dir, out_pdf)
-    sys.exit(rc)
+    sys.exit(main())
@@ -1,19 +1,29 @@
+import argparse
+import os
 import sys
-sys.path.append(r'c:\Users\Propietario\Downloads\makinas')
-from maquinas_app import detect_header_row
+
 import pandas as pd
 from openpyxl import load_workbook
 
-path = r'c:\Users\Propietario\Downloads\makinas\Matriz de condición de equipos principales excel.xlsx'
-header = detect_header_row(path, 'CM Matrix equipos principales')
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+# the import service only: no Flask app, no database
+from maquinas_import import DEFAULT_EXCEL, MAIN_SHEET, detect_header_row
+
+parser = argparse.ArgumentParser(description='Encabezados y colores de las primeras filas de la matriz')
+parser.add_argument('excel', nargs='?', default=DEFAULT_EXCEL)
+path = parser.parse_args().excel
+
+header = detect_header_row(path, MAIN_SHEET)
 print('Detected header row (0-based):', header)
-df = pd.read_excel(path, sheet_name='CM Matrix equipos principales', header=header)
+df = pd.read_excel(path, sheet_name=MAIN_SHEET, header=header)
 print('Columns:')
 for i,c in enumerate(df.columns):
     print(i, repr(str(c)))
 
 wb = load_workbook(path, data_only=True)
-ws = wb['CM Matrix equipos principales']
+ws = wb[MAIN_SHEET]
 # show first 5 data rows cell fills for columns 0..15
 excel_header_row = header+1
 start = excel_header_row+1